@@ -29,12 +29,28 @@ GISTS_DIR = APP_DIR / 'gists'
 #: and contain symbolic links to executable files inside gist repos.
 BIN_DIR = APP_DIR / 'bin'
 
+#: File with the index of downloaded gists.
+#:
+#: It maps gist references (<owner>/<name>) to gist IDs and other
+#: information about the gists, so that they can be found without
+#: looking through :data:`BIN_DIR` or asking GitHub.
+GIST_INDEX = APP_DIR / 'index.json'
+
+#: Bare git repository with objects shared by the repositories of gists.
+#:
+#: Gist repositories refer to it through git alternates,
+#: so that the objects common to many gists (e.g. forks) are stored once.
+GIST_OBJECTS_DIR = APP_DIR / 'objects.git'
+
 #: Directory where the request cache resides.
 #:
-#: Subdirectories contain pickled :class:`Response` objects
-#: (from :module:`requests`) inside directory paths corresponding to URL paths.
+#: It contains SQLite databases with serialized
+#: :class:`gisht.httpcache.CacheRecord` objects, keyed by URL paths.
 CACHE_DIR = APP_DIR / 'cache'
 
+#: File where the output of background processes is logged.
+BACKGROUND_LOG = APP_DIR / 'background.log'
+
 
 #: Logger object used by the application.
 logger = logging.getLogger(__name__)
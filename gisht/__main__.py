@@ -11,10 +11,13 @@ import sys
 
 from gisht import APP_DIR, flags, logger
 from gisht.args import parse_argv
-from gisht.data import GistCommand
-from gisht.gists import (ensure_gist,
+from gisht.data import GistCommand, MaintenanceCommand
+from gisht.gists import (ensure_gist, export_bundle, import_bundle,
+                         install_manifest, sync_gists, update_all_gists,
                          open_gist_page, output_gist_binary_path,
                          print_gist, run_gist, show_gist_info)
+from gisht.maintenance import (collect_cache_garbage, rebuild_index,
+                               repack_gists)
 from gisht.util import error
 
 
@@ -35,6 +38,25 @@ def main(argv=sys.argv):
                 return 2
         APP_DIR.mkdir(parents=True)
 
+    # maintenance commands don't operate on any particular gist
+    if args.maintenance is not None:
+        maintenance_func = {
+            MaintenanceCommand.CACHE_GC: collect_cache_garbage,
+            MaintenanceCommand.REINDEX: rebuild_index,
+            MaintenanceCommand.REPACK: repack_gists,
+            MaintenanceCommand.SYNC: sync_gists,
+            MaintenanceCommand.UPDATE_ALL: update_all_gists,
+            MaintenanceCommand.INSTALL: install_manifest,
+            MaintenanceCommand.EXPORT_BUNDLE: export_bundle,
+            MaintenanceCommand.IMPORT_BUNDLE: import_bundle,
+        }.get(args.maintenance)
+
+        assert maintenance_func is not None, (
+            "unsupported maintenance command: %s" % args.maintenance)
+        if args.maintenance_arg is not None:
+            return maintenance_func(args.maintenance_arg)
+        return maintenance_func()
+
     gist = args.gist
     gist_args = args.gist_args
 
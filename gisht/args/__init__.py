@@ -38,4 +38,12 @@ def parse_argv(argv, namespace=None):
     # TODO(xion): support reading default parameter values from ~/.gishtrc
     result = parser.parse_args(argv[1:], namespace)
     result.gist_args = gist_args
+
+    # GIST is required unless a maintenance command has been given
+    if result.maintenance is None:
+        if result.gist is None:
+            parser.error("the GIST argument is required")
+    elif result.gist is not None or gist_args:
+        parser.error("%s doesn't operate on a gist" % result.maintenance.flag)
+
     return result
@@ -6,8 +6,8 @@ import argcomplete
 from furl import furl
 import requests
 
-from gisht import BIN_DIR
-from gisht.github import iter_gists
+from gisht.gists.index import get_gist_index
+from gisht.github import list_gists
 
 
 __all__ = [
@@ -42,13 +42,11 @@ def gist_completer(prefix, parsed_args, **kwargs):
     # start with the locally available gists, possibly including entries
     # for GitHub users whose gists we have cached (if autocomplete prefix
     # does not include a slash)
-    for entry in BIN_DIR.rglob('*'):
-        entry = '/'.join(entry.relative_to(BIN_DIR).parts)
-        if not entry.startswith(prefix):
-            continue
-        if '/' not in entry:
-            entry = entry + '/'
-        results.add(entry)
+    for gist_ref in get_gist_index().refs():
+        owner = gist_ref.split('/', 1)[0]
+        for entry in (owner + '/', gist_ref):
+            if entry.startswith(prefix):
+                results.add(entry)
     # TODO(xion): the above is somewhat redundant in typical case, when GitHub
     # is available and user typed the owner part fully; elide it in this case
 
@@ -58,7 +56,7 @@ def gist_completer(prefix, parsed_args, **kwargs):
     if '/' in prefix and not local:
         owner, name_prefix = prefix.split('/')
         try:
-            for gist_json in iter_gists(owner):  # TODO(xion): cache this LOL
+            for gist_json in list_gists(owner):
                 for filename in gist_json['files'].keys():
                     if filename.startswith(name_prefix):
                         results.add(owner + '/' + filename)
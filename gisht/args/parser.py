@@ -2,12 +2,15 @@
 Module containing code for creating the command line argument parser.
 """
 import argparse
+from datetime import timedelta
 from itertools import chain
 import logging
+import re
 
 from gisht import __version__
 from gisht.args.autocomplete import gist_completer
-from gisht.data import Gist, GistError, GistCommand
+from gisht.data import (CloneStrategy, Gist, GistError, GistCommand,
+                        MaintenanceCommand)
 
 
 __all__ = ['create_argv_parser']
@@ -26,16 +29,23 @@ def create_argv_parser():
     add_gist_command_group(parser)
     add_logging_group(parser)
 
+    maintenance_group = add_maintenance_group(parser)
     misc_group = add_misc_group(parser)
 
     # get the autogenerated usage string and tweak it a little
     # to include gist arguments that are handled separately
-    # and exclude the miscellaneous flags which aren't part of a normal usage
-    usage = parser.format_usage()
+    # and exclude the maintenance & miscellaneous flags
+    # which aren't part of a normal usage
+    excluded_actions = set(chain.from_iterable(
+        group._group_actions for group in (maintenance_group, misc_group)))
+    formatter = parser._get_formatter()
+    formatter.add_usage(None, [action for action in parser._actions
+                               if action not in excluded_actions],
+                        parser._mutually_exclusive_groups)
+    usage = formatter.format_help()
     usage = usage[usage.find(parser.prog):].rstrip("\n")  # remove cruft
-    for misc_flag in chain.from_iterable(a.option_strings
-                                         for a in misc_group._group_actions):
-        usage = usage.replace(" [%s]" % misc_flag, "")
+    usage = "\n".join(line for line in usage.splitlines() if line.strip())
+    usage = usage.replace("[GIST]", "GIST")  # only optional for maintenance
     parser.usage = usage + " [-- GIST_ARGS]"
     return parser
 
@@ -50,7 +60,7 @@ def add_gist_group(parser):
     group = parser.add_argument_group(
         "Gist", "Specifies the gist, optionally with flags")
 
-    group.add_argument('gist', type=gist,
+    group.add_argument('gist', type=gist, nargs='?',
                        help="GitHub gist, specified as <owner>/<name> "
                             "(e.g. Octocat/foo), or a GitHub URL",
                        metavar="GIST").completer = gist_completer
@@ -66,6 +76,25 @@ def add_gist_group(parser):
                              help="always fetch the gist from GitHub, "
                                   "possibly updating it to latest version")
 
+    group.add_argument('--clone', type=clone_strategy, default=None,
+                       metavar="STRATEGY",
+                       help="how to clone the repository of a gist that's "
+                            "downloaded for the first time (or one that's "
+                            "been downloaded raw): %s "
+                            "(default: %s)" % (
+                                ", ".join(map(str, CloneStrategy)),
+                                CloneStrategy.default()))
+    group.add_argument('--max-age', type=duration, default=None,
+                       metavar="DURATION",
+                       help="update the downloaded gist if it has been "
+                            "fetched longer ago than that, e.g. 30m, 12h "
+                            "or 7d (default: 1d)")
+    group.add_argument('--no-background-update', action='store_false',
+                       dest='background_update', default=True,
+                       help="update a gist older than --max-age before "
+                            "running it, rather than run it as it is and "
+                            "update it in the background for the next time")
+
     return group
 
 
@@ -77,6 +106,35 @@ def gist(value):
         raise argparse.ArgumentTypeError(str(e))
 
 
+def clone_strategy(value):
+    """Converter/validator for the --clone command line argument."""
+    try:
+        return CloneStrategy(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid clone strategy %r (choose from: %s)" % (
+                value, ", ".join(map(str, CloneStrategy))))
+
+
+def duration(value):
+    """Converter/validator for command line arguments with time durations,
+    specified as a number of seconds, minutes, hours or days (e.g. 30m).
+    """
+    match = DURATION_RE.match(value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "invalid duration %r (expected e.g. 90s, 30m, 12h or 7d)" % value)
+    amount, unit = match.groups()
+    return timedelta(**{DURATION_UNITS[unit or 's']: int(amount)})
+
+#: Regular expression for durations in command line arguments.
+DURATION_RE = re.compile(r'^(\d+)([smhd]?)$')
+
+#: Units of durations in command line arguments,
+#: mapped to :class:`timedelta` constructor arguments.
+DURATION_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+
 # Gist command
 
 def add_gist_command_group(parser):
@@ -193,6 +251,95 @@ class LogLevelAction(argparse.Action):
         setattr(namespace, self.dest, new)
 
 
+# Maintenance commands
+
+def add_maintenance_group(parser):
+    """Include an argument group with commands that operate
+    on the application's local data, rather than on a single gist.
+
+    :param parser: :class:`argparse.ArgumentParser`
+    :return: Resulting argument group
+    """
+    arg_group = parser.add_argument_group(
+        "Maintenance", "Actions that don't take a GIST argument")
+    group = arg_group.add_mutually_exclusive_group()
+    group.set_defaults(maintenance=None, maintenance_arg=None)
+
+    maintenance_commands = {
+        MaintenanceCommand.CACHE_GC: "remove stale entries from the cache "
+                                     "of GitHub responses, and compact it",
+        MaintenanceCommand.REINDEX: "rebuild the index of downloaded gists",
+        MaintenanceCommand.REPACK: "deduplicate the repositories of "
+                                   "downloaded gists by moving their "
+                                   "objects to a shared store",
+        MaintenanceCommand.UPDATE_ALL: "update all downloaded gists that "
+                                       "have been fetched longer ago than "
+                                       "--max-age",
+    }
+    for cmd, help in maintenance_commands.items():
+        group.add_argument(cmd.flag, dest='maintenance',
+                           action='store_const', const=cmd, help=help)
+
+    maintenance_arg_commands = {
+        MaintenanceCommand.SYNC: (
+            "OWNER", "download all gists of given GitHub user, "
+                     "or update those which are already downloaded"),
+        MaintenanceCommand.INSTALL: (
+            "MANIFEST", "install the gists listed in given manifest file, "
+                        "in the revisions recorded by its lockfile "
+                        "(which is created if necessary)"),
+        MaintenanceCommand.EXPORT_BUNDLE: (
+            "FILE", "export the downloaded gists to given bundle file, "
+                    "so that they can be imported on another host"),
+        MaintenanceCommand.IMPORT_BUNDLE: (
+            "FILE", "import the gists from given bundle file"),
+    }
+    for cmd, (metavar, help) in maintenance_arg_commands.items():
+        group.add_argument(cmd.flag, dest='maintenance',
+                           action=MaintenanceArgumentAction, const=cmd,
+                           metavar=metavar, help=help)
+
+    arg_group.add_argument('-j', '--jobs', type=positive_int, default=None,
+                           metavar="N",
+                           help="how many gists to download at once "
+                                "with --sync, --update-all or --install "
+                                "(default: 4)")
+    arg_group.add_argument('--only', action='append', default=None,
+                           metavar="PATTERN",
+                           help="with --export-bundle, only export the gists "
+                                "whose <owner>/<name> matches given "
+                                "shell-style pattern (can be repeated)")
+
+    return arg_group
+
+
+class MaintenanceArgumentAction(argparse.Action):
+    """Custom argument parser's :class:`Action` for handling
+    maintenance command flags that take an argument.
+
+    The argument is stored as ``maintenance_arg``.
+    """
+    def __init__(self, **kwargs):
+        super(MaintenanceArgumentAction, self).__init__(nargs=None, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, self.const)
+        setattr(namespace, 'maintenance_arg', values)
+
+
+def positive_int(value):
+    """Converter/validator for command line arguments with positive numbers.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            "invalid value %r (expected a positive number)" % value)
+    return number
+
+
 # Miscellaneous options
 
 def add_misc_group(parser):
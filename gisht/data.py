@@ -8,7 +8,8 @@ from furl import furl
 
 __all__ = [
     'Gist', 'GistError',
-    'GistCommand',
+    'GistCommand', 'MaintenanceCommand',
+    'CloneStrategy',
 ]
 
 
@@ -156,3 +157,73 @@ class GistCommand(Enum):
         for cmd in cls:
             if flag in (cmd.short_flag, cmd.long_flag):
                 return cmd
+
+
+class MaintenanceCommand(Enum):
+    """Command that operates on the application's local data,
+    rather than on a single gist.
+    """
+
+    #: Purge stale entries from the GitHub response cache and compact it.
+    CACHE_GC = 'cache-gc'
+
+    #: Rebuild the index of downloaded gists from their repositories.
+    REINDEX = 'reindex'
+
+    #: Move the objects of gist repositories to the shared object store,
+    #: removing their duplicates.
+    REPACK = 'repack'
+
+    #: Download all gists of a GitHub user, or update the downloaded ones.
+    SYNC = 'sync'
+
+    #: Update all the downloaded gists which are no longer fresh.
+    UPDATE_ALL = 'update-all'
+
+    #: Install the gists listed in a manifest file, in locked revisions.
+    INSTALL = 'install'
+
+    #: Export the downloaded gists to a bundle file.
+    EXPORT_BUNDLE = 'export-bundle'
+
+    #: Import the gists from a bundle file.
+    IMPORT_BUNDLE = 'import-bundle'
+
+    @property
+    def flag(self):
+        return '--' + self.value
+
+
+class CloneStrategy(Enum):
+    """How the git repositories of gists are cloned (and then updated)."""
+
+    #: Clone the complete revision history of the gist.
+    FULL = 'full'
+
+    #: Clone only the latest revision of the gist.
+    SHALLOW = 'shallow'
+
+    #: Clone the complete revision history, but only download the content
+    #: of files from the past revisions when they're needed.
+    PARTIAL = 'partial'
+
+    #: Clone only the latest revision, and only check out
+    #: the gist's executable file.
+    SPARSE = 'sparse'
+
+    #: Don't clone the repository at all, only download the gist's
+    #: executable file (a gist can still be cloned later if needed).
+    RAW = 'raw'
+
+    @classmethod
+    def default(cls):
+        """Return the strategy to use if none was specified explicitly."""
+        return cls.SHALLOW
+
+    @property
+    def uses_git(self):
+        """Whether the gist is downloaded as a git repository."""
+        return self != CloneStrategy.RAW
+
+    def __str__(self):
+        return self.value
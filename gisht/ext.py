@@ -3,31 +3,101 @@ Module with our custom extensions & enhancements
 to the third party libraries used by the application.
 """
 from datetime import datetime, timedelta
-from pathlib import Path
-import pickle
+import os
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode  # Python 2.x
 
 from hammock import Hammock
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
 
-from gisht.util import ensure_path
+from gisht.httpcache import CacheRecord, DirectoryCacheStore
+from gisht.util import detach, LockTimeout
 
 
-__all__ = ['CachedHammock']
+__all__ = ['CachedHammock', 'create_session']
+
+
+def create_session(pool_size=10, retries=3, backoff=0.5):
+    """Create a :class:`requests.Session` with pooled keep-alive connections
+    that retries idempotent requests after transient failures.
+
+    :param pool_size: Maximum number of connections kept open to a host
+    :param retries: Maximum number of retries of a single request
+    :param backoff: Backoff factor (in seconds) for the delays between
+                    consecutive retries, which grow exponentially
+    """
+    retry_kwargs = dict(total=retries, backoff_factor=backoff,
+                        status_forcelist=(500, 502, 503, 504),
+                        raise_on_status=False)
+    idempotent_methods = frozenset(['GET', 'HEAD', 'OPTIONS'])
+    try:
+        retry = Retry(allowed_methods=idempotent_methods, **retry_kwargs)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=idempotent_methods, **retry_kwargs)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class CachedHammock(Hammock):
     """Custom version of :class:`Hammock` REST client
     that supports caching of GET requests.
     """
+    #: How long (in seconds) to wait for another process that is fetching
+    #: the same URL, before giving up and fetching it ourselves.
+    COALESCE_TIMEOUT = 10
+
+    #: Exceptions from the request that cause a cached response
+    #: to be returned instead, even if it has expired.
+    RESCUED_ERRORS = (requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout,
+                      requests.exceptions.RetryError)
+
+    #: Error statuses of responses that are cached nonetheless,
+    #: unless they would replace a successful response.
+    CACHED_ERROR_STATUSES = (404,)
+
+    #: Whether the requests are being made by a background refresh.
+    _in_background = False
+
     def __init__(self, *args, **kwargs):
         """Constructor.
 
-        :param cache_dir: Directory where the cached responses will be stored
+        :param cache_store: :class:`gisht.httpcache.CacheStore`
+                            where the cached responses will be stored
+        :param cache_dir: Directory where the cached responses will be stored,
+                          as a shorthand for :class:`DirectoryCacheStore`
         :param cache_ttl: :class:`timedelta` with TTL for a cache item
+        :param cache_stale_ttl: :class:`timedelta` with a grace period
+                                after the TTL, when an expired cache item
+                                is still returned while it's being
+                                refreshed in the background
+        :param background_log: File for the output of background refreshes
+        :param session: :class:`requests.Session` to use for the requests,
+                        instead of creating a new one
         """
-        self._cache_dir = kwargs.pop('cache_dir', None)
+        self._cache_store = kwargs.pop('cache_store', None)
+        cache_dir = kwargs.pop('cache_dir', None)
+        if self._cache_store is None and cache_dir:
+            self._cache_store = DirectoryCacheStore(cache_dir)
         self._cache_ttl = kwargs.pop('cache_ttl', timedelta(days=7))
+        self._cache_stale_ttl = kwargs.pop('cache_stale_ttl', timedelta(0))
+        self._background_log = kwargs.pop('background_log', os.devnull)
+        session = kwargs.pop('session', None)
         super(CachedHammock, self).__init__(*args, **kwargs)
+        if session is not None:
+            self._session = session
 
     def _path(self):
         """Return only the path portion of the URL."""
@@ -39,60 +109,185 @@ class CachedHammock(Hammock):
         return result[1:] if len(result) > 1 else result  # no leading slash
 
     def _request(self, method, *args, **kwargs):
-        """Make the HTTP request using :module:`requests` module."""
+        """Make the HTTP request using :module:`requests` module.
+
+        :return: :class:`requests.Response`, or :class:`CacheRecord`
+                 if the response has been served from cache
+        """
         use_cache = (method.upper() == 'GET' and
-                     bool(self._cache_dir) and
+                     self._cache_store is not None and
                      kwargs.pop('cache', True))
+        if not use_cache:
+            return self._send(method, *args, **kwargs)
 
         # try to load the response from cache, if available
-        if use_cache:
-            url_path = self._chain(*args)._path()
-            cache_file = Path(self._cache_dir) / url_path
-            if self._expired(cache_file):
+        url_path = self._cache_key(self._chain(*args)._path(),
+                                   kwargs.get('params'))
+        cached = self._cache_store.get(url_path)
+        if cached is None or self._expired(url_path, cached):
+            # serve the expired response if it's not too old,
+            # and refresh it in the background for the subsequent requests
+            if cached is not None and self._stale(url_path, cached):
+                rv = self._on_cache_stale(url_path, cached)
+                if rv is not False:
+                    self._refresh_in_background(url_path, cached,
+                                                method, *args, **kwargs)
+                    return cached if rv in (None, True) else rv
+
+            # responses that are too old to be served right away are still
+            # better than nothing if the server cannot be reached, so they
+            # are refreshed (or rescued) rather than treated as missing
+            if cached is None:
                 rv = self._on_cache_miss(url_path)
                 if rv is not None:
                     return rv
-            else:
-                with cache_file.open('rb') as f:
-                    cached_response = pickle.load(f)
+        else:
+            # register the cache hit and possibly modify cached response
+            rv = self._on_cache_hit(url_path, cached)
+            if rv is not False:
+                return cached if rv in (None, True) else rv
 
-                # register the cache hit and possibly modify cached response
-                rv = self._on_cache_hit(url_path, cached_response)
-                if rv is not False:
-                    return cached_response if rv in (None, True) else rv
+        return self._refresh(url_path, cached, method, *args, **kwargs)
+
+    def _cache_key(self, path, params=None):
+        """Return the key for caching the response of GET request
+        to given path with given query string parameters.
+        """
+        if not params:
+            return path
+        if isinstance(params, dict):
+            params = params.items()
+        return path + '?' + urlencode(sorted(params))
+
+    def _refresh(self, url_path, cached, method, *args, **kwargs):
+        """Fetch the response from the server and store it in the cache,
+        unless another process has just done the same.
 
-        # issue the request if we couldn't find a cached response
+        :param cached: Previously cached :class:`CacheRecord` (if any)
+        """
+        # only one process at a time should fetch the same URL;
+        # the others wait for it, and then use the response it has cached
         try:
-            response = super(CachedHammock, self) \
-                ._request(method, *args, **kwargs)
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout,
-                requests.exceptions.RetryError):
+            with self._cache_store.lock(url_path,
+                                        timeout=self.COALESCE_TIMEOUT):
+                latest = self._cache_store.get(url_path)
+                if latest is not None:
+                    fetched_meanwhile = (cached is None or
+                                         latest.timestamp > cached.timestamp)
+                    if fetched_meanwhile and \
+                            not self._expired(url_path, latest):
+                        return latest
+                    cached = latest
+                return self._fetch(url_path, cached, method, *args, **kwargs)
+        except LockTimeout:
+            return self._fetch(url_path, cached, method, *args, **kwargs)
+
+    def _refresh_in_background(self, url_path, cached, method,
+                               *args, **kwargs):
+        """Refresh the cached response in a detached background process."""
+        def refresh():
+            # connections pooled by the session are shared with the parent
+            # process, so we mustn't use them here; closing the session
+            # only drops them (on our side), and it will open new ones
+            self._session.close()
+            self._in_background = True
+            self._refresh(url_path, cached, method, *args, **kwargs)
+
+        detach(refresh, log_file=self._background_log)
+
+    def _fetch(self, url_path, cached, method, *args, **kwargs):
+        """Fetch the response from the server and store it in the cache.
+
+        :param cached: Previously cached :class:`CacheRecord` (if any)
+                       that will be revalidated with the server
+        """
+        # make the request conditional if we have anything to revalidate
+        # (which is possible even if the cached response has expired)
+        if cached is not None:
+            headers = dict(kwargs.get('headers') or {})
+            headers.update(self._conditional_headers(cached))
+            kwargs['headers'] = headers
+
+        try:
+            response = self._send(method, *args, **kwargs)
+        except self.RESCUED_ERRORS:
             # if the request has failed due to transient error,
             # by default return the cached response even if it's expired
-            if use_cache and cache_file.exists():
-                with cache_file.open('rb') as f:
-                    cached_response = pickle.load(f)
-                rv = self._on_cache_rescue(url_path, cached_response)
+            if cached is not None:
+                rv = self._on_cache_rescue(url_path, cached)
                 if rv is not False:
-                    return cached_response if rv in (None, True) else rv
+                    return cached if rv in (None, True) else rv
             raise
 
-        # save the obtained response to cache
-        if use_cache:
-            ensure_path(cache_file.parent)
-            with cache_file.open('wb') as f:
-                pickle.dump(response, f)
+        if response.status_code == 304:
+            if cached is None:
+                return response  # conditional request made by the caller
+            cached.refresh(response)
+            self._cache_store.put(url_path, cached)
+            return cached
+
+        # server errors are no less transient than network failures
+        if response.status_code >= 500 and cached is not None and cached.ok:
+            rv = self._on_cache_rescue(url_path, cached)
+            if rv is not False:
+                return cached if rv in (None, True) else rv
 
+        # save the obtained response to cache,
+        # unless it's an error that could replace a valid response
+        if self._cacheable(response, cached):
+            self._cache_store.put(url_path,
+                                  CacheRecord.from_response(response))
         return response
 
-    def _expired(self, cache_file):
-        """Check whether the cached response has expired."""
-        if not cache_file.exists():
+    def _cacheable(self, response, cached):
+        """Check whether given response should be stored in the cache.
+
+        :param cached: Previously cached :class:`CacheRecord` (if any)
+        """
+        if 200 <= response.status_code < 300:
             return True
-        last_modify_timestamp = cache_file.stat().st_mtime
-        last_modify_time = datetime.fromtimestamp(last_modify_timestamp)
-        return last_modify_time + self._cache_ttl <= datetime.now()
+        return (response.status_code in self.CACHED_ERROR_STATUSES and
+                (cached is None or not cached.ok))
+
+    def _send(self, method, *args, **kwargs):
+        """Actually send the request to the server.
+
+        Override in subclasses to e.g. throttle the requests.
+
+        :return: :class:`requests.Response`
+        """
+        return super(CachedHammock, self)._request(method, *args, **kwargs)
+
+    def _conditional_headers(self, cached):
+        """Return the headers for revalidating given cached response."""
+        headers = {}
+        for header, conditional_header in VALIDATOR_HEADERS.items():
+            value = cached.headers.get(header)
+            if value:
+                headers[conditional_header] = value
+        return headers
+
+    def _expired(self, path, cached):
+        """Check whether the cached response for given path has expired."""
+        fetch_time = datetime.fromtimestamp(cached.timestamp)
+        return fetch_time + self._cache_ttl_for(path) <= datetime.now()
+
+    def _stale(self, path, cached):
+        """Check whether the expired response for given path
+        is still within the grace period when it can be served stale.
+        """
+        fetch_time = datetime.fromtimestamp(cached.timestamp)
+        grace_end = fetch_time + self._cache_ttl_for(path) + \
+            self._cache_stale_ttl
+        return datetime.now() < grace_end
+
+    def _cache_ttl_for(self, path):
+        """Return the TTL of cached responses for given request ``path``.
+
+        By default, this is the ``cache_ttl`` passed to the constructor.
+        Override in subclasses to vary the TTL between API endpoints.
+        """
+        return self._cache_ttl
 
     # Caching-related to events
     # (to override in subclasses, if desired)
@@ -110,7 +305,19 @@ class CachedHammock(Hammock):
         that can be returned as a response to the request.
 
         :return: ``True`` or ``None`` if ``content`` shall be used as response.
-                 ``False`` if cache shall not be used for this request at all.
+                 ``False`` if ``content`` shall be revalidated with the server
+                 before it's used (as if it has expired).
+                 Any other value will replace ``content`` as the response.
+        """
+
+    def _on_cache_stale(self, path, content):
+        """Invoked when given request ``path`` has an expired ``content``
+        that is still within the grace period of ``cache_stale_ttl``.
+
+        :return: ``True`` or ``None`` if ``content`` shall be used
+                 as response, while being refreshed in the background.
+                 ``False`` if ``content`` shall be revalidated with the server
+                 before it's used.
                  Any other value will replace ``content`` as the response.
         """
 
@@ -123,3 +330,11 @@ class CachedHammock(Hammock):
                  ``False`` if the error shall be propagated.
                  Any other value will replace ``content`` as the response.
         """
+
+
+#: Mapping of response headers with validators of the cached content
+#: to request headers that are used to make a conditional request.
+VALIDATOR_HEADERS = {
+    'ETag': 'If-None-Match',
+    'Last-Modified': 'If-Modified-Since',
+}
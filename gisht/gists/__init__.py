@@ -1,8 +1,11 @@
 """
 Package containing gist operations' code.
 """
+from gisht.gists.bulk import sync_gists, update_all_gists
+from gisht.gists.bundle import export_bundle, import_bundle
 from gisht.gists.cache import ensure_gist
 from gisht.gists.info import show_gist_info
+from gisht.gists.manifest import install_manifest
 from gisht.gists.misc import (open_gist_page,
                               output_gist_binary_path,
                               print_gist)
@@ -10,7 +13,8 @@ from gisht.gists.run import run_gist
 
 
 __all__ = [
-    'ensure_gist',
+    'ensure_gist', 'sync_gists', 'update_all_gists', 'install_manifest',
+    'export_bundle', 'import_bundle',
 
     'run_gist', 'output_gist_binary_path', 'print_gist',
     'open_gist_page', 'show_gist_info',
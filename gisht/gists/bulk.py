@@ -0,0 +1,192 @@
+"""
+Functions for downloading and updating many gists at once.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import time
+
+import requests
+
+from gisht import flags, logger
+from gisht.gists.cache import (gist_exists, gist_fresh, gist_name_of,
+                               install_gist, update_gist)
+from gisht.gists.index import get_gist_index
+from gisht.github import iter_gists, RateLimitExceeded
+from gisht.util import detach_pending, error
+
+
+__all__ = ['sync_gists', 'update_all_gists']
+
+
+def sync_gists(owner):
+    """Download all gists of given GitHub user,
+    and update those which have been downloaded already.
+
+    The gists are processed concurrently, by as many workers
+    as the ``--jobs`` flag specifies.
+
+    :return: Exit code
+    """
+    try:
+        gists = list_owner_gists(owner)
+    except RateLimitExceeded as e:
+        error("%s", e, exitcode=os.EX_TEMPFAIL)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            error("user '%s' not found", owner, exitcode=os.EX_UNAVAILABLE)
+        error("HTTP error: %s", e, exitcode=os.EX_UNAVAILABLE)
+    if not gists:
+        print("User %s has no gists." % owner)
+        return os.EX_OK
+
+    results = process_gists(list(gists),
+                            lambda gist: sync_gist(gist, gists[gist]))
+    print("Synced %s gist(s) of %s: %s." % (
+        len(gists), owner, format_results(results)))
+    return os.EX_UNAVAILABLE if results[FAILED] else os.EX_OK
+
+
+def update_all_gists():
+    """Update all the downloaded gists which are no longer fresh
+    (see the ``--max-age`` flag).
+
+    The gists are processed concurrently, by as many workers
+    as the ``--jobs`` flag specifies.
+
+    :return: Exit code
+    """
+    index = get_gist_index()
+    gists = [gist for gist in index.refs() if gist_exists(gist)]
+    stale_gists = [gist for gist in gists if not gist_fresh(gist)]
+    if not stale_gists:
+        print("All %s downloaded gist(s) are up to date." % len(gists))
+        return os.EX_OK
+
+    results = process_gists(stale_gists, update_stale_gist)
+    print("Updated %s of %s downloaded gist(s): %s." % (
+        len(stale_gists), len(gists), format_results(results)))
+    return os.EX_UNAVAILABLE if results[FAILED] else os.EX_OK
+
+
+def process_gists(gists, func):
+    """Apply given function to the gists concurrently,
+    reporting the outcome for each of them as it's done.
+
+    :param gists: List of gist references
+    :param func: Function taking a gist reference
+                 and returning one of :data:`SYNC_STATUSES`;
+                 it fails the gist by raising an exception
+
+    :return: Ordered dictionary with the number of gists
+             for every one of :data:`SYNC_STATUSES`
+    """
+    get_gist_index()  # load it before the workers start using it
+
+    def process(gist):
+        try:
+            return gist, func(gist)
+        except SystemExit:
+            # errors while downloading a gist normally end the program
+            # (after they've been reported), but here they mustn't stop
+            # the other gists from being processed
+            return gist, FAILED
+        except Exception as e:
+            logger.error("gist %s failed: %s", gist, e)
+            return gist, FAILED
+
+    results = OrderedDict((status, 0) for status in SYNC_STATUSES)
+    jobs = getattr(flags, 'jobs', None) or SYNC_JOBS
+    pool = ThreadPool(min(jobs, len(gists)))
+    try:
+        for i, (gist, status) in enumerate(
+                pool.imap_unordered(process, gists), 1):
+            results[status] += 1
+            print("[%s/%s] %s: %s" % (i, len(gists), gist, status))
+            sys.stdout.flush()
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    # refreshes of stale responses couldn't be detached by the workers
+    detach_pending()
+    return results
+
+#: Default number of gists that are processed at once.
+SYNC_JOBS = 4
+
+
+def format_results(results):
+    """Format the results of :func:`process_gists` for display."""
+    return ", ".join("%s %s" % (count, status)
+                     for status, count in results.items() if count)
+
+
+def list_owner_gists(owner):
+    """Return the gists owned by given GitHub user.
+
+    :return: Ordered dictionary mapping gist references to gist JSONs
+    :raises: :class:`requests.exception.HTTPError`
+    """
+    gists = OrderedDict()
+    for gist_json in iter_gists(owner):
+        gist = '%s/%s' % (owner, gist_name_of(gist_json))
+        if gist in gists:
+            # same as when a single gist is downloaded, the first one wins
+            logger.warning("user %s has several gists named %s; only the "
+                           "first one (ID=%s) will be synced", owner,
+                           gist_name_of(gist_json), gists[gist]['id'])
+            continue
+        gists[gist] = gist_json
+    return gists
+
+
+#: Possible outcomes of syncing a single gist.
+DOWNLOADED, UPDATED, UNCHANGED, FAILED = \
+    'downloaded', 'updated', 'up to date', 'failed'
+SYNC_STATUSES = (DOWNLOADED, UPDATED, UNCHANGED, FAILED)
+
+
+def sync_gist(gist, gist_json):
+    """Download or update a single gist as part of a bulk sync.
+
+    :return: One of :data:`SYNC_STATUSES`
+    """
+    if not gist_exists(gist):
+        install_gist(gist, gist_json, progress=False)
+        return DOWNLOADED
+
+    # a different gist of the same name may have replaced the downloaded one,
+    # in which case updating the latter wouldn't bring the former
+    entry = get_gist_index().get(gist) or {}
+    if entry.get('id') != str(gist_json['id']):
+        logger.warning("gist %s has been downloaded with ID=%s, but it has "
+                       "ID=%s on GitHub now; not syncing it",
+                       gist, entry.get('id'), gist_json['id'])
+        return FAILED
+
+    # the gist hasn't changed if GitHub's modification time is the same
+    if entry.get('updated_at') and \
+            entry['updated_at'] == gist_json.get('updated_at'):
+        get_gist_index().put(gist, fetched_at=time.time())
+        return UNCHANGED
+
+    status = update_stale_gist(gist)
+    if status != FAILED:
+        get_gist_index().put(gist, updated_at=gist_json.get('updated_at'))
+    return status
+
+
+def update_stale_gist(gist):
+    """Update a single downloaded gist as part of a bulk update.
+
+    :return: One of :data:`SYNC_STATUSES`
+    """
+    revision = (get_gist_index().get(gist) or {}).get('revision')
+    if not update_gist(gist, required=False):
+        return FAILED
+    new_revision = (get_gist_index().get(gist) or {}).get('revision')
+    return UNCHANGED if new_revision == revision else UPDATED
@@ -0,0 +1,394 @@
+"""
+Exporting downloaded gists to a bundle file, and importing them from it.
+
+A bundle is a compressed tarball with the gists' directories,
+their links in :data:`BIN_DIR`, their index entries, and the cached
+GitHub responses about them. It allows to seed the gists on hosts
+that cannot access GitHub themselves, so that they can be run there
+in ``--local`` mode.
+"""
+from __future__ import print_function
+
+from fnmatch import fnmatch
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import posixpath
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+
+from gisht import APP_DIR, BIN_DIR, GISTS_DIR, flags, logger
+from gisht.data import CloneStrategy
+from gisht.gists.cache import (GIST_FETCH_LOCK_TIMEOUT, gist_exists,
+                               gist_fetch_lock_file)
+from gisht.gists.index import get_gist_index
+from gisht.gists.objects import (alternates_file, share_gist_objects,
+                                 unshare_gist_objects)
+from gisht.github import get_cache_store
+from gisht.httpcache import CacheRecord, CacheRecordError
+from gisht.util import (ensure_path, error, file_lock, LockTimeout,
+                        path_vector)
+
+
+__all__ = ['export_bundle', 'import_bundle']
+
+
+def export_bundle(path):
+    """Export the downloaded gists to a bundle file at given path.
+
+    If the ``--only`` flag is given, only the gists whose references
+    match one of its patterns are exported.
+
+    :return: Exit code
+    """
+    path = Path(path)
+    gists = select_gists(getattr(flags, 'only', None))
+    if not gists:
+        error("no downloaded gists to export", exitcode=os.EX_NOINPUT)
+
+    temp_dir = Path(tempfile.mkdtemp(dir=str(ensure_app_dir()),
+                                     prefix='.export-'))
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=str(path.parent),
+                                         prefix='.' + path.name)
+    except (IOError, OSError) as e:
+        shutil.rmtree(str(temp_dir), ignore_errors=True)
+        error("cannot write bundle %s: %s", path, e,
+              exitcode=os.EX_CANTCREAT)
+
+    # the bundle is written to a temporary file first and then renamed,
+    # so that a failed export doesn't leave a truncated bundle behind
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with tarfile.open(fileobj=f, mode='w:gz') as tar:
+                entries = dict((gist, add_gist(tar, gist, temp_dir))
+                               for gist in gists)
+                cache_members = add_cache_records(tar, entries)
+                add_metadata(tar, {'version': BUNDLE_VERSION,
+                                   'created_at': time.time(),
+                                   'gists': entries,
+                                   'cache': cache_members})
+        os.rename(temp_path, str(path))
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    finally:
+        shutil.rmtree(str(temp_dir), ignore_errors=True)
+
+    print("Exported %s gist(s) to %s." % (len(gists), path))
+    return os.EX_OK
+
+
+def import_bundle(path):
+    """Import the gists from a bundle file at given path.
+
+    The whole bundle is verified and unpacked before any gist is imported,
+    and every gist is then moved into place at once. Gists which have
+    already been downloaded are left as they are.
+
+    :return: Exit code
+    """
+    path = Path(path)
+    staging_dir = Path(tempfile.mkdtemp(dir=str(ensure_app_dir()),
+                                        prefix='.import-'))
+    try:
+        try:
+            metadata = extract_bundle(path, staging_dir)
+        except (IOError, OSError, tarfile.TarError) as e:
+            error("cannot read bundle %s: %s", path, e,
+                  exitcode=os.EX_NOINPUT)
+        except BundleError as e:
+            error("invalid bundle %s: %s", path, e, exitcode=os.EX_DATAERR)
+
+        gists = sorted(metadata['gists'].items())
+        imported = [gist for gist, entry in gists
+                    if import_gist(staging_dir, gist, entry)]
+        import_cache_records(staging_dir / 'cache', metadata['cache'])
+    finally:
+        shutil.rmtree(str(staging_dir), ignore_errors=True)
+
+    print("Imported %s gist(s) from %s (%s already present)." % (
+        len(imported), path, len(gists) - len(imported)))
+    return os.EX_OK
+
+
+def select_gists(patterns=None):
+    """Return the references of downloaded gists to export.
+
+    :param patterns: Optional list of shell-style patterns
+                     that the gist references should match
+    """
+    return [gist for gist in get_gist_index().refs()
+            if gist_exists(gist) and
+            (not patterns or any(fnmatch(gist, p) for p in patterns))]
+
+
+def ensure_app_dir():
+    """Make sure the application's directory exists, and return it.
+
+    Temporary files of bundles are kept there, so that they can be
+    moved to their final place by renaming.
+    """
+    ensure_path(APP_DIR)
+    return APP_DIR
+
+#: Version of the bundle format.
+BUNDLE_VERSION = 2
+
+#: Name of the bundle member with its metadata.
+METADATA_FILE = 'bundle.json'
+
+
+class BundleError(ValueError):
+    """Exception raised when the bundle file is invalid."""
+
+
+# Exporting
+
+def add_gist(tar, gist, temp_dir):
+    """Add the downloaded gist (with its link) to the bundle.
+
+    :param tar: :class:`tarfile.TarFile` of the bundle
+    :param temp_dir: Directory for the temporary copy of the gist's
+                     repository, in case it uses the shared object store
+
+    :return: Index entry of the gist
+    """
+    gist_id = get_gist_index().get(gist)['id']
+    try:
+        with file_lock(gist_fetch_lock_file(gist_id),
+                       timeout=GIST_FETCH_LOCK_TIMEOUT):
+            entry = get_gist_index().get(gist)
+            gist_dir = GISTS_DIR / gist_id
+
+            # the objects that the repository borrows from the shared store
+            # have to be included in the bundle, too
+            if alternates_file(gist_dir).exists():
+                repo_copy = temp_dir / gist_id
+                shutil.copytree(str(gist_dir), str(repo_copy), symlinks=True)
+                if unshare_gist_objects(repo_copy):
+                    gist_dir = repo_copy
+                else:
+                    error("cannot export gist %s", gist,
+                          exitcode=os.EX_SOFTWARE)
+
+            tar.add(str(gist_dir), arcname='gists/' + gist_id)
+            gist_link = BIN_DIR / gist
+            if gist_link.is_symlink():
+                tar.add(str(gist_link), arcname='bin/' + gist)
+    except LockTimeout:
+        error("gist %s is still being downloaded by another process", gist,
+              exitcode=os.EX_TEMPFAIL)
+
+    shutil.rmtree(str(temp_dir / gist_id), ignore_errors=True)
+    logger.debug("gist %s added to the bundle", gist)
+    return entry
+
+
+def add_cache_records(tar, entries):
+    """Add the cached GitHub responses about given gists to the bundle.
+
+    :param entries: Dictionary with index entries of the gists
+    :return: Dictionary mapping the keys of the added cache records
+             to the names of their files in the bundle's cache directory
+    """
+    gist_ids = set(entry['id'] for entry in entries.values())
+
+    members = {}
+    for key, record in get_cache_store().items():
+        if not is_gist_cache_key(key, gist_ids):
+            continue
+        # keys cannot be used as file names, since some of them
+        # are prefixes of others (e.g. gists/<id> and gists/<id>/<sha>)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        add_file(tar, 'cache/' + name, record.dumps())
+        members[key] = name
+    return members
+
+
+def is_gist_cache_key(key, gist_ids):
+    """Check whether given cache key is that of a GitHub response
+    about one of the gists with given IDs.
+    """
+    key_parts = key.split('/')
+    return (key_parts[0] == 'gists' and len(key_parts) > 1 and
+            key_parts[1] in gist_ids and
+            not any(part in ('', '.', '..') for part in key_parts))
+
+
+def add_metadata(tar, metadata):
+    """Add the metadata file to the bundle."""
+    data = json.dumps(metadata, indent=2, sort_keys=True)
+    add_file(tar, METADATA_FILE, data.encode('utf-8'))
+
+
+def add_file(tar, name, data):
+    """Add a file with given content to the bundle."""
+    tar_info = tarfile.TarInfo(name)
+    tar_info.size = len(data)
+    tar_info.mtime = time.time()
+    tar.addfile(tar_info, io.BytesIO(data))
+
+
+# Importing
+
+def extract_bundle(path, staging_dir):
+    """Verify the bundle file and unpack it into given directory.
+
+    :return: Bundle metadata
+    :raise: :exc:`BundleError` if the bundle is invalid
+    """
+    with tarfile.open(str(path), 'r:gz') as tar:
+        members = tar.getmembers()
+        for member in members:
+            check_member(member)
+        metadata = read_metadata(tar)
+
+        kwargs = {}
+        if hasattr(tarfile, 'data_filter'):
+            kwargs['filter'] = 'data'
+        tar.extractall(str(staging_dir), members=[
+            member for member in members if member.name != METADATA_FILE],
+            **kwargs)
+
+    for gist, entry in metadata['gists'].items():
+        gist_exec = staging_dir / 'gists' / entry['id'] / gist.split('/')[1]
+        if not gist_exec.is_file():
+            raise BundleError("missing files of gist %s" % gist)
+    return metadata
+
+
+def check_member(member):
+    """Check whether given bundle member can be safely unpacked.
+
+    :param member: :class:`tarfile.TarInfo` of the member
+    :raise: :exc:`BundleError` if it cannot be
+    """
+    name = posixpath.normpath(member.name)
+    if posixpath.isabs(name) or name.split('/')[0] not in BUNDLE_DIRS:
+        raise BundleError("unexpected file %s" % member.name)
+
+    if member.issym():
+        # links may only point to gists' files inside the bundle
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name),
+                                                   member.linkname))
+        if posixpath.isabs(member.linkname) or \
+                not target.startswith('gists/'):
+            raise BundleError("link %s points outside of the bundle "
+                              "(to %s)" % (member.name, member.linkname))
+    elif not (member.isfile() or member.isdir()):
+        raise BundleError("unsupported type of file %s" % member.name)
+
+#: Top-level files and directories of the bundle.
+BUNDLE_DIRS = (METADATA_FILE, 'gists', 'bin', 'cache')
+
+
+def read_metadata(tar):
+    """Read the metadata file of the bundle.
+
+    :param tar: :class:`tarfile.TarFile` of the bundle
+    :raise: :exc:`BundleError` if it's missing or invalid
+    """
+    try:
+        metadata = json.loads(
+            tar.extractfile(METADATA_FILE).read().decode('utf-8'))
+    except KeyError:
+        raise BundleError("missing %s" % METADATA_FILE)
+    except ValueError as e:
+        raise BundleError("malformed %s: %s" % (METADATA_FILE, e))
+
+    if not isinstance(metadata, dict) or \
+            metadata.get('version') != BUNDLE_VERSION:
+        raise BundleError("unsupported bundle version: %r" % (
+            metadata.get('version') if isinstance(metadata, dict) else None,))
+
+    gists = metadata.setdefault('gists', {})
+    if not isinstance(gists, dict):
+        raise BundleError("malformed list of gists")
+    for gist, entry in gists.items():
+        if not (GIST_REF_RE.match(gist) and isinstance(entry, dict) and
+                GIST_ID_RE.match(str(entry.get('id')))):
+            raise BundleError("invalid gist %s" % gist)
+
+    cache = metadata.setdefault('cache', {})
+    if not isinstance(cache, dict):
+        raise BundleError("malformed list of cached responses")
+    gist_ids = set(str(entry['id']) for entry in gists.values())
+    for key, name in cache.items():
+        if not (is_gist_cache_key(key, gist_ids) and
+                CACHE_MEMBER_RE.match(str(name))):
+            raise BundleError("invalid cached response %s" % key)
+    return metadata
+
+#: Regular expressions for the references and IDs of bundled gists.
+GIST_REF_RE = re.compile(r'^(?!\.\.?/)[^/]+/(?!\.\.?$)[^/]+$')
+GIST_ID_RE = re.compile(r'^\w+$')
+
+#: Regular expression for the names of files with cached responses.
+CACHE_MEMBER_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def import_gist(staging_dir, gist, entry):
+    """Import a single gist from the unpacked bundle.
+
+    :return: Whether the gist has been imported,
+             i.e. it hasn't been downloaded already
+    """
+    gist_dir = GISTS_DIR / entry['id']
+    try:
+        with file_lock(gist_fetch_lock_file(entry['id']),
+                       timeout=GIST_FETCH_LOCK_TIMEOUT):
+            if gist_exists(gist) or gist_dir.exists():
+                logger.debug("gist %s already present", gist)
+                return False
+
+            ensure_path(GISTS_DIR)
+            os.rename(str(staging_dir / 'gists' / entry['id']),
+                      str(gist_dir))
+
+            gist_link = BIN_DIR / gist
+            if not os.path.lexists(str(gist_link)):
+                ensure_path(gist_link.parent)
+                bundled_link = staging_dir / 'bin' / gist
+                if bundled_link.is_symlink():
+                    os.rename(str(bundled_link), str(gist_link))
+                else:
+                    gist_link.symlink_to(path_vector(
+                        from_=gist_link, to=gist_dir / gist.split('/')[1]))
+
+            get_gist_index().put(gist, **entry)
+    except LockTimeout:
+        logger.warning("gist %s is being downloaded by another process; "
+                       "not importing it", gist)
+        return False
+
+    share_gist_objects(gist_dir, CloneStrategy(
+        entry.get('clone', CloneStrategy.FULL.value)))
+    logger.info("gist %s imported", gist)
+    return True
+
+
+def import_cache_records(cache_dir, members):
+    """Import the cached GitHub responses from the unpacked bundle,
+    unless newer ones are cached already.
+
+    :param members: Dictionary mapping the keys of the cache records
+                    to the names of their files in ``cache_dir``
+    """
+    cache_store = get_cache_store()
+    for key, name in sorted(members.items()):
+        try:
+            with (cache_dir / name).open('rb') as f:
+                record = CacheRecord.loads(f.read())
+        except (IOError, OSError, CacheRecordError) as e:
+            logger.warning("cannot import cached response for %s: %s",
+                           key, e)
+            continue
+        cached = cache_store.get(key)
+        if cached is None or cached.timestamp < record.timestamp:
+            cache_store.put(key, record)
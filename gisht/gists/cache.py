@@ -1,24 +1,44 @@
 """
 Functions for downloading gists and caching them locally.
 """
+from datetime import datetime, timedelta
 import os
+from pathlib import Path
+import re
+import shutil
 import stat
+import sys
+import tempfile
+import time
 
 import requests
 
-from gisht import BIN_DIR, GISTS_DIR, logger
-from gisht.data import Gist
-from gisht.github import iter_gists
-from gisht.util import ensure_path, error, fatal, join, path_vector, run
+from gisht import APP_DIR, BACKGROUND_LOG, BIN_DIR, GISTS_DIR, flags, logger
+from gisht.data import CloneStrategy, Gist
+from gisht.gists.index import (get_gist_index, git_head, index_entry,
+                               local_revision, RAW_REVISION_FILE)
+from gisht.gists.objects import reference_args, share_gist_objects
+from gisht.github import (get_gist_file, get_gist_info, iter_gist_pages,
+                          RateLimitExceeded)
+from gisht.util import (detach, ensure_path, error, fatal, file_lock,
+                        hold_file_lock, join, LockTimeout, path_vector, run)
 
 
-__all__ = ['ensure_gist', 'get_gist_id']
+__all__ = [
+    'ensure_gist', 'get_gist_id', 'get_gist_executable', 'lock_running_gist',
+]
 
 
-def ensure_gist(gist, local=False):
+def ensure_gist(gist, local=False, gist_json=None):
     """Ensure that given gist is downloaded & cached.
 
     :param gist: Gist as owner/name string, or :class:`Gist` object
+    :param local: Whether to only use the gists available locally (True),
+                  always update them to the latest revision (False),
+                  or update them once they're no longer fresh (None)
+    :param gist_json: Optional JSON of the gist from GitHub API;
+                      if provided, the gist can be downloaded
+                      without searching through all the owner's gists
 
     This, of course, may mean downloading the gist if it hasn't been before,
     or doing nothing if it has.
@@ -29,16 +49,37 @@ def ensure_gist(gist, local=False):
     if gist_exists(gist):
         logger.debug("gist %s found among already downloaded gists", gist)
         if local is False:
-            # take the opportunity to update the gist to latest revision
+            # take the opportunity to update the gist to latest revision;
+            # (failures other than the gist being in use are fatal already)
             if not update_gist(gist):
-                error("failed to update gist %s")
+                logger.warning("couldn't update gist %s -- "
+                               "running the local version", gist)
+        elif local is None and not gist_fresh(gist):
+            if getattr(flags, 'background_update', True):
+                # run the gist as it is now, and update it for the next time
+                logger.debug("gist %s hasn't been updated for more than %s, "
+                             "updating it in the background",
+                             gist, gist_max_age())
+                detach(update_gist_in_background, gist,
+                       log_file=BACKGROUND_LOG)
+            else:
+                logger.debug("gist %s hasn't been updated for more than %s",
+                             gist, gist_max_age())
+                if not update_gist(gist, required=False):
+                    logger.warning("couldn't update gist %s -- "
+                                   "running the local version", gist)
     else:
         if local:
             error("gist %s is not available locally", gist,
                   exitcode=os.EX_NOINPUT)
+        if gist_json is not None:
+            install_gist(gist, gist_json)
+            return
         try:
             if not download_gist(gist):
                 error("gist %s not found", gist, exitcode=os.EX_DATAERR)
+        except RateLimitExceeded as e:
+            error("%s", e, exitcode=os.EX_TEMPFAIL)
         except requests.exceptions.HTTPError as e:
             if e.response.status_code == 404:
                 error("user '%s' not found", gist.split('/')[0],
@@ -57,82 +98,305 @@ def get_gist_id(gist):
             return gist.id
         gist = gist.ref
 
-    if not gist_exists(gist):
-        fatal("unknown gist %s")
+    entry = get_gist_index().get(gist)
+    if entry is None:
+        fatal("unknown gist %s", gist)
 
-    gist_exec = (BIN_DIR / gist).resolve()
-    gist_id = gist_exec.parent.name
+    gist_id = entry['id']
     logger.debug("gist %s found to have ID=%s", gist, gist_id)
 
     return gist_id
 
 
+def get_gist_executable(gist):
+    """Return the path to the executable file of given downloaded gist.
+
+    :param gist: Gist as owner/name string, or :class:`Gist` object
+    :return: :class:`Path` to the file, or None if the gist is unknown
+    """
+    if isinstance(gist, Gist):
+        gist = gist.ref
+
+    entry = get_gist_index().get(gist)
+    if entry is None:
+        return None
+    gist_name = gist.split('/', 1)[1]
+    return GISTS_DIR / entry['id'] / gist_name
+
+
 def gist_exists(gist):
     """Checks if the gist specified by owner/name string exists."""
-    gist_exec_symlink = BIN_DIR / gist
-    return gist_exec_symlink.exists()  # also checks if symlink is not broken
+    gist_exec = get_gist_executable(gist)
+    return gist_exec is not None and gist_exec.exists()
+
+
+def gist_fresh(gist):
+    """Checks if the downloaded gist specified by owner/name string
+    has been fetched from GitHub recently enough to not need an update.
+    """
+    entry = get_gist_index().get(gist) or {}
+    if entry.get('pinned'):
+        return True  # it's not going to be updated anyway
+    fetched_at = entry.get('fetched_at')
+    if fetched_at is None:
+        return False
+    age = datetime.now() - datetime.fromtimestamp(fetched_at)
+    return age < gist_max_age()
+
+
+def gist_max_age():
+    """Return the :class:`timedelta` for how long a downloaded gist
+    stays fresh after it's been fetched from GitHub.
+    """
+    max_age = getattr(flags, 'max_age', None)
+    return GIST_MAX_AGE if max_age is None else max_age
+
+#: How long a downloaded gist stays fresh by default,
+#: i.e. how often is it updated when it's ran.
+GIST_MAX_AGE = timedelta(days=1)
 
 
-def download_gist(gist):
+def download_gist(gist, progress=True):
     """Download the gist specified by owner/name string.
 
+    :param progress: Whether git may show the progress of cloning
     :return: Whether the gist has been successfully downloaded
     """
     logger.debug("downloading gist %s ...", gist)
 
     owner, gist_name = gist.split('/', 1)
-    for gist_json in iter_gists(owner):
-        # GitHub names gists after their first files in alphabetical order
-        # TODO(xion): warn the user when this could create problems,
-        # i.e. when a single owner has two separate gists named the same way
-        filename = list(sorted(gist_json['files'].keys()))[0]
-        if filename != gist_name:
-            continue
-
-        # the gist should be placed inside a directory named after its ID
-        clone_needed = True
-        gist_dir = GISTS_DIR / str(gist_json['id'])
-        if gist_dir.exists():
+
+    # GitHub names gists after their first files in alphabetical order,
+    # so a single owner may have several gists that are named the same way;
+    # we won't look any further than the page with the first one, though
+    matching_gists = []
+    pages = iter_gist_pages(owner)
+    try:
+        for page in pages:
+            matching_gists.extend(gist_json for gist_json in page
+                                  if gist_name_of(gist_json) == gist_name)
+            if matching_gists:
+                break
+    finally:
+        pages.close()  # cancel fetching of the remaining pages
+
+    if not matching_gists:
+        return False
+    if len(matching_gists) > 1:
+        logger.warning("user %s has %s gists named %s; using the first one "
+                       "(ID=%s)", owner, len(matching_gists), gist_name,
+                       matching_gists[0]['id'])
+
+    install_gist(gist, matching_gists[0], progress=progress)
+    return True
+
+
+def install_gist(gist, gist_json, progress=True):
+    """Clone the repository of given gist (or download just its file)
+    and link its executable.
+
+    If another process is downloading the same gist at the same time,
+    this waits for it to finish and uses the gist it has downloaded.
+
+    :param gist: Gist as owner/name string
+    :param gist_json: JSON of the gist from GitHub API
+    :param progress: Whether git may show the progress of cloning
+    """
+    gist_id = str(gist_json['id'])
+    try:
+        with file_lock(gist_fetch_lock_file(gist_id),
+                       timeout=GIST_FETCH_LOCK_TIMEOUT):
+            _install_gist(gist, gist_json, progress)
+    except LockTimeout:
+        error("gist %s is still being downloaded by another process", gist,
+              exitcode=os.EX_TEMPFAIL)
+
+
+def _install_gist(gist, gist_json, progress):
+    owner, filename = gist.split('/', 1)
+
+    # the gist should be placed inside a directory named after its ID
+    clone_needed = True
+    gist_dir = GISTS_DIR / str(gist_json['id'])
+    if gist_dir.exists():
+        if (gist_dir / filename).exists():
+            logger.debug("gist %s has been downloaded by another process",
+                         gist)
+        else:
             # this is an inconsistent state, as it means the binary
             # for a gist is missing, while the repository is not;
             # no real harm in that, but we should report it anyway
-            logger.warning("gist %s already downloaded")
-            clone_needed = False
-
-        # clone it if necessary (which is usually the case)
-        if clone_needed:
-            logger.debug("gist %s found, cloning its repository...", gist)
+            logger.warning("gist %s already downloaded", gist)
+        clone_needed = False
+
+    # clone it if necessary (which is usually the case)
+    strategy = None
+    if clone_needed:
+        strategy = getattr(flags, 'clone', None) or CloneStrategy.default()
+        if strategy.uses_git:
+            logger.debug("gist %s found, cloning its repository (%s)...",
+                         gist, strategy)
             ensure_path(gist_dir)
-            git_clone_run = run('git clone %s %s' % (
-                gist_json['git_pull_url'], gist_dir))
-            if git_clone_run.status_code != 0:
-                logger.error(
-                    "cloning repository for gist %s failed (exitcode %s)",
-                    gist, git_clone_run.status_code)
-                join(git_clone_run)
+            try:
+                clone_gist_repo(gist_json['git_pull_url'], gist_dir,
+                                filename, strategy=strategy,
+                                progress=progress)
+            except BaseException:
+                # don't leave a half-cloned gist behind
+                shutil.rmtree(str(gist_dir), ignore_errors=True)
+                raise
             logger.debug("gist %s successfully cloned", gist)
+            share_gist_objects(gist_dir, strategy)
+        else:
+            logger.debug("gist %s found, downloading its file...", gist)
+            try:
+                content = gist_file_content(gist_json, filename)
+            except requests.exceptions.HTTPError as e:
+                error("downloading gist %s failed: %s", gist, e,
+                      exitcode=os.EX_UNAVAILABLE)
+            ensure_path(gist_dir)
+            write_raw_gist(gist_dir, filename, content,
+                           gist_revision(gist_json))
+
+    # make sure the gist executable is, in fact, executable
+    # TODO(xion): fix the hashbang while we're at it
+    gist_exec = gist_dir / filename
+    gist_exec.chmod(GIST_EXEC_PERMISSIONS)
+    logger.debug("adjusted permissions for gist file %s", gist_exec)
+
+    # create symlink from BIN_DIR/<owner>/<gist_name>
+    # to the gist's executable file
+    gist_owner_bin_dir = BIN_DIR / owner
+    ensure_path(gist_owner_bin_dir)
+    gist_link = gist_owner_bin_dir / filename
+    if not gist_link.exists():
+        gist_link.symlink_to(path_vector(from_=gist_link, to=gist_exec))
+        logger.debug("symlinked gist 'binary' %s to executable %s",
+                     gist_link, gist_exec)
+
+    entry = index_entry(gist_json, revision=local_revision(gist_dir),
+                        fetched_at=time.time())
+    if strategy is not None:
+        entry['clone'] = strategy.value
+    get_gist_index().put(gist, **entry)
+
+    if clone_needed:
+        logger.info("gist %s downloaded sucessfully", gist)
+
+
+def clone_gist_repo(url, gist_dir, filename, strategy=CloneStrategy.FULL,
+                    progress=True):
+    """Clone the git repository of a gist into given directory.
+
+    :param filename: Name of the gist's executable file,
+                     which is the only one checked out by sparse strategy
+    :param strategy: :class:`CloneStrategy` to use
+    :param progress: Whether git may show the progress of cloning
+    """
+    # show git's progress when there's someone to see it
+    progress = progress and sys.stderr.isatty()
+
+    # objects that other gists have already downloaded are borrowed from them
+    commands = [(['git', 'clone'] + CLONE_ARGS[strategy] +
+                 reference_args(strategy) +
+                 (['--progress'] if progress else []) + [url, gist_dir],
+                 None)]
+    if strategy == CloneStrategy.SPARSE:
+        commands.extend([
+            (['git', 'sparse-checkout', 'set', '--no-cone',
+              sparse_checkout_pattern(filename)], gist_dir),
+            (['git', 'checkout'], gist_dir),
+        ])
+
+    for argv, cwd in commands:
+        git_run = run(argv, cwd=cwd, timeout=GIT_FETCH_TIMEOUT,
+                      forward_output=progress)
+        if git_run.status_code != 0:
+            logger.error("cloning repository %s failed (exitcode %s)",
+                         url, git_run.status_code)
+            join(git_run)
+
+#: Arguments to ``git clone`` for every :class:`CloneStrategy`.
+CLONE_ARGS = {
+    CloneStrategy.FULL: [],
+    CloneStrategy.SHALLOW: ['--depth', '1'],
+    CloneStrategy.PARTIAL: ['--filter=blob:none'],
+    CloneStrategy.SPARSE: ['--depth', '1', '--filter=blob:none',
+                           '--no-checkout'],
+}
+
+#: How long (in seconds) may cloning or fetching a gist repository take.
+GIT_FETCH_TIMEOUT = 10 * 60
+
+
+def sparse_checkout_pattern(filename):
+    """Return the sparse checkout pattern that matches exactly
+    the file of given name at the root of the repository.
+    """
+    # (sparse checkout patterns are the same as those of .gitignore,
+    # so both the wildcards and the characters that are special
+    # at the start or the end of a pattern have to be escaped)
+    return '/' + SPARSE_CHECKOUT_SPECIAL_RE.sub(r'\\\g<0>', filename)
+
+#: Regular expression for the characters of a file name which
+#: have to be escaped in a sparse checkout pattern.
+SPARSE_CHECKOUT_SPECIAL_RE = re.compile(r'[\\*?\[!#]| (?= *$)')
 
-        # make sure the gist executable is, in fact, executable
-        # TODO(xion): fix the hashbang while we're at it
-        gist_exec = gist_dir / filename
-        gist_exec.chmod(GIST_EXEC_PERMISSIONS)
-        logger.debug("adjusted permissions for gist file %s", gist_exec)
-
-        # create symlink from BIN_DIR/<owner>/<gist_name>
-        # to the gist's executable file
-        gist_owner_bin_dir = BIN_DIR / owner
-        ensure_path(gist_owner_bin_dir)
-        gist_link = gist_owner_bin_dir / filename
-        if not gist_link.exists():
-            gist_link.symlink_to(path_vector(from_=gist_link, to=gist_exec))
-            logger.debug("symlinked gist 'binary' %s to executable %s",
-                         gist_link, gist_exec)
-
-        if clone_needed:
-            logger.info("gist %s downloaded sucessfully", gist)
-        return True
 
-    return False
+def gist_file_content(gist_json, filename):
+    """Return the content of given file of the gist described by JSON
+    from GitHub API, downloading it if it's not included there in full.
+
+    :return: Content of the file as bytes
+    :raises: :class:`requests.exception.HTTPError`
+    """
+    file_json = gist_json['files'][filename]
+    content = file_json.get('content')
+    if content is not None and not file_json.get('truncated'):
+        return content.encode('utf-8')
+    return get_gist_file(file_json['raw_url'])
+
+
+def gist_revision(gist_json):
+    """Return the latest revision of the gist described by given JSON
+    from GitHub API, or None if it cannot be determined.
+    """
+    history = gist_json.get('history')
+    if history:
+        return history[0]['version']
+
+    # gists listed by owner don't include the history,
+    # but URLs of their files still point to the latest revision
+    for file_json in gist_json['files'].values():
+        match = RAW_URL_REVISION_RE.search(file_json.get('raw_url') or '')
+        if match:
+            return match.group(1)
+    return None
+
+#: Regular expression for the revision in the ``raw_url`` of a gist file.
+RAW_URL_REVISION_RE = re.compile(r'/raw/([0-9a-f]{40})/')
+
+
+def write_raw_gist(gist_dir, filename, content, revision):
+    """Write the executable file of a gist downloaded without git
+    into given directory, along with the gist's revision.
+
+    The file is replaced atomically, so that it's never seen
+    only partially written.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=str(gist_dir), prefix='.' + filename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temp_path, GIST_EXEC_PERMISSIONS)
+        os.rename(temp_path, str(gist_dir / filename))
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+    with open(str(gist_dir / RAW_REVISION_FILE), 'w') as f:
+        f.write((revision or '') + '\n')
+
 
 #: Permission bits we set on the gist executable.
 GIST_EXEC_PERMISSIONS = (
@@ -142,21 +406,389 @@ GIST_EXEC_PERMISSIONS = (
 )
 
 
-def update_gist(gist):
-    """Pull the latest version of the gist specified by owner/name string.
+def gist_name_of(gist_json):
+    """Return the name of the gist described by given JSON from GitHub API,
+    i.e. the name of its first file in alphabetical order.
+    """
+    return list(sorted(gist_json['files'].keys()))[0]
+
+
+def update_gist(gist, required=True):
+    """Bring the gist specified by owner/name string to its latest version.
 
+    If another process is updating the same gist at the same time,
+    this waits for it to finish and uses the result instead.
+
+    :param required: Whether failing to update the gist is a fatal error
     :return: Whether the gist has been successfully updated
     """
+    gist_id = get_gist_id(gist)
+    start_time = time.time()
+    try:
+        with file_lock(gist_fetch_lock_file(gist_id),
+                       timeout=GIST_FETCH_LOCK_TIMEOUT):
+            # another process may have updated the gist while we waited
+            index = get_gist_index()
+            index.reload()
+            fetched_at = (index.get(gist) or {}).get('fetched_at')
+            if fetched_at is not None and fetched_at >= start_time:
+                logger.debug("gist %s has been updated by another process",
+                             gist)
+                return True
+            return _update_gist(gist, required=required)
+    except LockTimeout:
+        logger.warning("gist %s is still being updated by another process",
+                       gist)
+        return False
+
+
+def _update_gist(gist, required=True):
     logger.debug("updating gist %s ...", gist)
 
     gist_id = get_gist_id(gist)
     gist_dir = GISTS_DIR / gist_id
-    git_pull_run = run('git pull', cwd=str(gist_dir))
-    if git_pull_run.status_code != 0:
-        # TODO(xion): detect conflicts and do `git reset --merge` automatically
-        logger.warning("pulling changes to gist %s failed (exitcode %s)",
-                       gist, git_pull_run.status_code)
-        join(git_pull_run)
+
+    # (gists that were downloaded before the clone strategy had been
+    # recorded are full clones)
+    entry = get_gist_index().get(gist) or {}
+    if entry.get('pinned'):
+        logger.debug("gist %s is pinned to revision %s, not updating it",
+                     gist, entry['pinned'])
+        return True
+    strategy = CloneStrategy(entry.get('clone', CloneStrategy.FULL.value))
+    if not strategy.uses_git:
+        return update_raw_gist(gist, required=required)
+
+    # asking for the latest revision is much cheaper than fetching it,
+    # and most of the time it's the one we already have
+    revision = git_head(gist_dir)
+    if revision and remote_revision(gist_dir) == revision:
+        logger.debug("gist %s is already up to date", gist)
+        get_gist_index().put(gist, fetched_at=time.time())
+        return True
+
+    # gists are never modified locally, so instead of merging anything,
+    # the latest revision can simply be checked out;
+    # shallow clones must only fetch that revision, too
+    progress = sys.stderr.isatty() and required
+    git_fetch_run = run(['git', 'fetch'] + FETCH_ARGS[strategy] +
+                        (['--progress'] if progress else []) +
+                        ['origin', 'HEAD'],
+                        cwd=gist_dir, timeout=GIT_FETCH_TIMEOUT,
+                        forward_output=progress)
+    if git_fetch_run.status_code != 0:
+        logger.warning("fetching changes to gist %s failed (exitcode %s)",
+                       gist, git_fetch_run.status_code)
+        if required:
+            join(git_fetch_run)
+        return False
+
+    # the files mustn't be replaced while the gist is running, though
+    try:
+        with file_lock(gist_lock_file(gist_id), timeout=GIST_LOCK_TIMEOUT):
+            git_reset_run = run(['git', 'reset', '--hard', 'FETCH_HEAD'],
+                                cwd=gist_dir)
+    except LockTimeout:
+        logger.warning("gist %s is still running -- "
+                       "it will be updated later", gist)
+        return False
+    if git_reset_run.status_code != 0:
+        logger.warning("checking out the latest version of gist %s failed "
+                       "(exitcode %s)", gist, git_reset_run.status_code)
+        if required:
+            join(git_reset_run)
+        return False
+
+    # the gist's files may have changed along with its revision
+    get_gist_index().put(gist, fetched_at=time.time(),
+                         **revision_fields(gist_dir))
+    logger.info("gist %s successfully updated", gist)
+
+    return True
+
+#: Arguments to ``git fetch`` that update a gist repository
+#: cloned with given :class:`CloneStrategy`.
+FETCH_ARGS = {
+    CloneStrategy.FULL: [],
+    CloneStrategy.SHALLOW: ['--depth', '1'],
+    CloneStrategy.PARTIAL: [],  # the filter is remembered by the repo
+    CloneStrategy.SPARSE: ['--depth', '1'],
+}
+
+
+def update_raw_gist(gist, required=True):
+    """Bring the gist specified by owner/name string, which has been
+    downloaded without git, to its latest version.
+
+    If a strategy of cloning gists has been given explicitly,
+    the gist is cloned using it instead.
+
+    :param required: Whether failing to update the gist is a fatal error
+    :return: Whether the gist has been successfully updated
+    """
+    gist_id = get_gist_id(gist)
+    gist_dir = GISTS_DIR / gist_id
+    filename = gist.split('/', 1)[1]
+
+    try:
+        gist_json = get_gist_info(gist_id)
+        strategy = getattr(flags, 'clone', None)
+        if strategy is not None and strategy.uses_git:
+            return promote_gist(gist, gist_json, strategy)
+
+        revision = gist_revision(gist_json)
+        if revision and revision == local_revision(gist_dir):
+            logger.debug("gist %s is already up to date", gist)
+            get_gist_index().put(gist, fetched_at=time.time())
+            return True
+        content = gist_file_content(gist_json, filename)
+    except requests.exceptions.HTTPError as e:
+        logger.warning("fetching gist %s failed: %s", gist, e)
+        if required:
+            error("failed to update gist %s", gist, exitcode=os.EX_UNAVAILABLE)
+        return False
+
+    try:
+        with file_lock(gist_lock_file(gist_id), timeout=GIST_LOCK_TIMEOUT):
+            write_raw_gist(gist_dir, filename, content, revision)
+    except LockTimeout:
+        logger.warning("gist %s is still running -- "
+                       "it will be updated later", gist)
+        return False
+
+    get_gist_index().put(gist, **index_entry(gist_json, revision=revision,
+                                             fetched_at=time.time()))
     logger.info("gist %s successfully updated", gist)
 
     return True
+
+
+def promote_gist(gist, gist_json, strategy):
+    """Clone the repository of a gist that's been downloaded without git.
+
+    :param gist: Gist as owner/name string
+    :param gist_json: JSON of the gist from GitHub API
+    :param strategy: :class:`CloneStrategy` to use
+    :return: Whether the gist has been successfully cloned
+    """
+    logger.debug("cloning the repository of gist %s (%s)...", gist, strategy)
+
+    gist_id = str(gist_json['id'])
+    gist_dir = GISTS_DIR / gist_id
+    filename = gist.split('/', 1)[1]
+
+    # clone next to the gist, so that only the repository itself
+    # has to be moved into the gist's directory afterwards
+    temp_dir = Path(tempfile.mkdtemp(dir=str(GISTS_DIR), prefix='.' + gist_id))
+    try:
+        clone_gist_repo(gist_json['git_pull_url'], temp_dir, filename,
+                        strategy=strategy)
+        with file_lock(gist_lock_file(gist_id), timeout=GIST_LOCK_TIMEOUT):
+            (temp_dir / '.git').rename(gist_dir / '.git')
+            get_gist_index().put(gist, clone=strategy.value)
+            git_reset_run = run(['git', 'reset', '--hard', 'HEAD'],
+                                cwd=gist_dir)
+    except LockTimeout:
+        logger.warning("gist %s is still running -- "
+                       "it will be cloned later", gist)
+        return False
+    finally:
+        shutil.rmtree(str(temp_dir), ignore_errors=True)
+    if git_reset_run.status_code != 0:
+        logger.warning("checking out the repository of gist %s failed "
+                       "(exitcode %s)", gist, git_reset_run.status_code)
+        return False
+
+    if (gist_dir / RAW_REVISION_FILE).exists():
+        (gist_dir / RAW_REVISION_FILE).unlink()
+    (gist_dir / filename).chmod(GIST_EXEC_PERMISSIONS)
+    share_gist_objects(gist_dir, strategy)
+    get_gist_index().put(gist, **index_entry(gist_json,
+                                             revision=git_head(gist_dir),
+                                             fetched_at=time.time()))
+    logger.info("gist %s successfully cloned", gist)
+
+    return True
+
+
+def checkout_gist_revision(gist, revision):
+    """Check out given revision of the gist specified by owner/name string,
+    fetching it first if necessary.
+
+    :return: Whether the revision has been successfully checked out
+    """
+    gist_id = get_gist_id(gist)
+    gist_dir = GISTS_DIR / gist_id
+    filename = gist.split('/', 1)[1]
+
+    try:
+        with file_lock(gist_fetch_lock_file(gist_id),
+                       timeout=GIST_FETCH_LOCK_TIMEOUT):
+            if local_revision(gist_dir) == revision:
+                return True
+            logger.debug("checking out revision %s of gist %s ...",
+                         revision, gist)
+
+            entry = get_gist_index().get(gist) or {}
+            strategy = CloneStrategy(
+                entry.get('clone', CloneStrategy.FULL.value))
+            if strategy.uses_git:
+                if not _checkout_repo_revision(gist_dir, revision, strategy):
+                    return False
+            else:
+                gist_json = get_gist_info(gist_id, revision=revision)
+                content = gist_file_content(gist_json, filename)
+                with file_lock(gist_lock_file(gist_id),
+                               timeout=GIST_LOCK_TIMEOUT):
+                    write_raw_gist(gist_dir, filename, content, revision)
+    except LockTimeout:
+        logger.warning("gist %s is being updated or running -- "
+                       "cannot check out revision %s", gist, revision)
+        return False
+    except requests.exceptions.HTTPError as e:
+        logger.warning("fetching revision %s of gist %s failed: %s",
+                       revision, gist, e)
+        return False
+
+    get_gist_index().put(gist, revision=local_revision(gist_dir),
+                         fetched_at=time.time())
+    return True
+
+
+def _checkout_repo_revision(repo_dir, revision, strategy):
+    """Check out given revision in the gist repository, fetching it first
+    if the repository doesn't have it.
+
+    :raise: :class:`LockTimeout` if the gist is running
+    """
+    has_revision_run = run(
+        ['git', 'cat-file', '-e', revision + '^{commit}'], cwd=repo_dir)
+    if has_revision_run.status_code != 0:
+        git_fetch_run = run(['git', 'fetch'] + FETCH_ARGS[strategy] +
+                            ['origin', revision],
+                            cwd=repo_dir, timeout=GIT_FETCH_TIMEOUT)
+        if git_fetch_run.status_code != 0:
+            logger.warning("fetching revision %s into %s failed "
+                           "(exitcode %s)", revision, repo_dir,
+                           git_fetch_run.status_code)
+            return False
+
+    with file_lock(gist_lock_file(repo_dir.name), timeout=GIST_LOCK_TIMEOUT):
+        git_reset_run = run(['git', 'reset', '--hard', revision],
+                            cwd=repo_dir)
+    if git_reset_run.status_code != 0:
+        logger.warning("checking out revision %s in %s failed (exitcode %s)",
+                       revision, repo_dir, git_reset_run.status_code)
+        return False
+    return True
+
+
+def remote_revision(repo_dir):
+    """Return the latest revision of the origin of given git repository,
+    or None if it couldn't be determined.
+    """
+    ls_remote_run = run(['git', 'ls-remote', 'origin', 'HEAD'],
+                        cwd=repo_dir, timeout=LS_REMOTE_TIMEOUT)
+    if ls_remote_run.status_code != 0:
+        logger.debug("git ls-remote failed in %s (exitcode %s)",
+                     repo_dir, ls_remote_run.status_code)
+        return None
+    output = ls_remote_run.std_out.split()
+    return output[0] if output else None
+
+#: How long (in seconds) to wait for the latest revision of a gist.
+LS_REMOTE_TIMEOUT = 30
+
+
+def revision_fields(repo_dir):
+    """Return the index fields that describe the revision checked out
+    in given git repository: the ``revision`` itself, its ``files``,
+    and the time it's been committed at as ``updated_at``.
+
+    Fields which cannot be determined are omitted.
+    """
+    fields = dict(revision=git_head(repo_dir))
+
+    # (the files are listed from the commit rather than the working tree,
+    # which only has some of them in case of sparse clones)
+    ls_tree_run = run(['git', 'ls-tree', '-z', '--name-only', 'HEAD'],
+                      cwd=repo_dir)
+    if ls_tree_run.status_code == 0:
+        fields['files'] = sorted(
+            name for name in ls_tree_run.std_out.split('\0') if name)
+
+    log_run = run(['git', 'log', '-1', '--format=%ct', 'HEAD'], cwd=repo_dir)
+    commit_time = log_run.std_out.strip()
+    if log_run.status_code == 0 and commit_time.isdigit():
+        fields['updated_at'] = datetime.utcfromtimestamp(
+            int(commit_time)).strftime(GITHUB_TIME_FORMAT)
+
+    return fields
+
+#: Format of the times in GitHub API responses.
+GITHUB_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def update_gist_in_background(gist):
+    """Update the gist specified by owner/name string
+    (in a background process), unless it's being updated already.
+    """
+    gist_id = get_gist_id(gist)
+    try:
+        with file_lock(gist_fetch_lock_file(gist_id), timeout=0):
+            # another process may have updated the gist in the meantime
+            get_gist_index().reload()
+            if gist_fresh(gist):
+                return
+            _update_gist(gist, required=False)
+    except LockTimeout:
+        logger.debug("gist %s is already being updated", gist)
+
+
+# Locking
+
+def lock_running_gist(gist):
+    """Prevent the gist specified by owner/name string from being updated
+    until it starts running.
+
+    The lock lasts until the current process ``exec``-s into the gist
+    (or exits). Once the gist is running, its files may be replaced,
+    since git writes new files rather than modifying the existing ones.
+    """
+    if isinstance(gist, Gist):
+        gist = gist.ref
+
+    entry = get_gist_index().get(gist)
+    if entry is None:
+        return
+    try:
+        hold_file_lock(gist_lock_file(entry['id']), shared=True,
+                       timeout=GIST_LOCK_TIMEOUT)
+    except LockTimeout:
+        logger.warning("gist %s is being updated", gist)
+
+
+def gist_lock_file(gist_id):
+    """Return the path to the file which is locked while the gist
+    of given ID is running (shared lock) or its files are replaced
+    (exclusive lock).
+    """
+    return GIST_LOCKS_DIR / (gist_id + '.lock')
+
+
+def gist_fetch_lock_file(gist_id):
+    """Return the path to the file which is locked while the gist
+    of given ID is being downloaded or updated.
+    """
+    return GIST_LOCKS_DIR / (gist_id + '.update')
+
+#: Directory with lock files for the downloaded gists.
+GIST_LOCKS_DIR = APP_DIR / 'locks'
+
+#: How long (in seconds) to wait for another process to finish
+#: downloading or updating a gist.
+GIST_FETCH_LOCK_TIMEOUT = 5 * 60
+
+#: How long (in seconds) to wait for a gist to be updated before running it,
+#: or to finish running before updating it.
+GIST_LOCK_TIMEOUT = 10
@@ -0,0 +1,300 @@
+"""
+Persistent index of the downloaded gists.
+"""
+import json
+import os
+import re
+import tempfile
+
+from gisht import BIN_DIR, GIST_INDEX, GISTS_DIR, logger
+from gisht.data import CloneStrategy
+from gisht.util import ensure_path, file_lock
+
+
+__all__ = [
+    'GistIndex', 'get_gist_index', 'rebuild_gist_index',
+    'index_entry', 'local_revision', 'git_head', 'RAW_REVISION_FILE',
+]
+
+
+class GistIndex(object):
+    """Index of downloaded gists, stored in a JSON file.
+
+    Entries are keyed by gist references (<owner>/<name>) and hold
+    the gist ``id``, its ``files``, the ``revision`` checked out locally,
+    ``git_pull_url``, ``updated_at`` time from GitHub, the ``clone``
+    strategy of the gist's repository, ``fetched_at`` timestamp
+    of when it's been last downloaded or updated, and the revision
+    the gist is ``pinned`` to (if any), which prevents updating it.
+
+    The file is read only once and then looked up in memory.
+    Modifications are written back immediately (and atomically),
+    so that concurrent processes don't lose each other's changes.
+    """
+    #: Version of the index file format.
+    VERSION = 1
+
+    def __init__(self, path):
+        """Constructor.
+
+        :param path: Path to the index file
+        """
+        self.path = path
+        self._entries = None
+
+    @property
+    def entries(self):
+        """Dictionary of all the index entries, keyed by gist references."""
+        # (the entries may be reloaded by another thread at any time)
+        entries = self._entries
+        if entries is None:
+            entries = self._entries = self._load()
+        return entries
+
+    def reload(self):
+        """Discard the entries read so far, so that they're read
+        from the index file again when needed.
+        """
+        self._entries = None
+
+    def exists(self):
+        """Check whether the index file exists."""
+        return self.path.exists()
+
+    def get(self, ref):
+        """Return the index entry for given gist reference, or None."""
+        return self.entries.get(ref)
+
+    def __contains__(self, ref):
+        return ref in self.entries
+
+    def refs(self):
+        """Return the sorted list of references of all indexed gists."""
+        return sorted(self.entries)
+
+    def put(self, ref, **fields):
+        """Add or update the index entry for given gist reference.
+
+        :param fields: Fields of the entry to set; any others
+                       are preserved from the existing entry (if any)
+        """
+        def update(entries):
+            entries.setdefault(ref, {}).update(fields)
+        self._modify(update)
+
+    def remove(self, ref):
+        """Remove given gist reference from the index."""
+        self._modify(lambda entries: entries.pop(ref, None))
+
+    def replace(self, entries):
+        """Replace all the entries in the index with given ones."""
+        def update(current_entries):
+            current_entries.clear()
+            current_entries.update(entries)
+        self._modify(update)
+
+    def _modify(self, func):
+        """Apply given function to the current entries of the index file,
+        and write them back.
+        """
+        ensure_path(self.path.parent)
+        lock_file = self.path.with_name(self.path.name + '.lock')
+        with file_lock(lock_file):
+            entries = self._load()
+            func(entries)
+            self._save(entries)
+        self._entries = entries
+
+    def _load(self):
+        try:
+            with open(str(self.path)) as f:
+                data = json.load(f)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            logger.warning("gist index %s is corrupted", self.path)
+            return {}
+        if data.get('version') != self.VERSION:
+            logger.debug("ignoring gist index %s in unsupported version %s",
+                         self.path, data.get('version'))
+            return {}
+        return data.get('gists', {})
+
+    def _save(self, entries):
+        data = {'version': self.VERSION, 'gists': entries}
+
+        # write to a temporary file first and then atomically rename it,
+        # so that concurrent readers never see a partially written index
+        fd, temp_path = tempfile.mkstemp(dir=str(self.path.parent),
+                                         prefix='.' + self.path.name)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'), sort_keys=True)
+            os.rename(temp_path, str(self.path))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+
+#: Process-wide index of downloaded gists.
+_gist_index = None
+
+
+def get_gist_index():
+    """Return the :class:`GistIndex` of downloaded gists.
+
+    If the index doesn't exist yet (e.g. because the gists have been
+    downloaded by an older version of the application), it is rebuilt.
+    """
+    global _gist_index
+    if _gist_index is None:
+        _gist_index = GistIndex(GIST_INDEX)
+        if not _gist_index.exists() and GISTS_DIR.is_dir():
+            rebuild_gist_index(_gist_index)
+    return _gist_index
+
+
+def rebuild_gist_index(index=None):
+    """Rebuild the index from the gist repositories in :data:`GISTS_DIR`.
+
+    Since the repositories don't know who owns the gists,
+    their owners are found through the links in :data:`BIN_DIR`.
+    Times of the last update on GitHub cannot be recovered,
+    and the last fetch time is only known if ``git fetch`` recorded it.
+
+    :return: Number of indexed gists
+    """
+    index = index or get_gist_index()
+    gists_dir = GISTS_DIR.resolve() if GISTS_DIR.exists() else GISTS_DIR
+
+    entries = {}
+    for gist_link in BIN_DIR.glob('*/*'):
+        if not gist_link.is_symlink() or not gist_link.exists():
+            continue
+        gist_dir = gist_link.resolve().parent
+        if gist_dir.parent != gists_dir:
+            continue
+        gist_ref = '/'.join(gist_link.relative_to(BIN_DIR).parts)
+        entries[gist_ref] = dict(
+            id=gist_dir.name,
+            files=sorted(p.name for p in gist_dir.iterdir()
+                         if p.name not in ('.git', RAW_REVISION_FILE)),
+            revision=local_revision(gist_dir),
+            git_pull_url=_git_pull_url(gist_dir),
+            clone=_clone_strategy(gist_dir).value,
+            fetched_at=_fetch_time(gist_dir),
+            updated_at=None)
+
+    index.replace(entries)
+    logger.debug("rebuilt gist index with %s gist(s)", len(entries))
+    return len(entries)
+
+
+def index_entry(gist_json, **kwargs):
+    """Create the fields of an index entry from gist JSON of GitHub API.
+
+    :param kwargs: Additional fields of the entry, e.g. the ``revision``
+    """
+    entry = dict(id=str(gist_json['id']),
+                 files=sorted(gist_json['files'].keys()),
+                 git_pull_url=gist_json.get('git_pull_url'),
+                 updated_at=gist_json.get('updated_at'))
+    entry.update(kwargs)
+    return entry
+
+
+# Reading the downloaded gist
+
+#: Name of the file that records the revision of a gist
+#: which has been downloaded without git (see :attr:`CloneStrategy.RAW`).
+RAW_REVISION_FILE = '.revision'
+
+
+def local_revision(gist_dir):
+    """Return the revision of the gist downloaded into given directory,
+    or None if it cannot be determined.
+    """
+    if (gist_dir / '.git').exists():
+        return git_head(gist_dir)
+    try:
+        with (gist_dir / RAW_REVISION_FILE).open() as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def git_head(repo_dir):
+    """Return the commit hash checked out in given git repository,
+    or None if it cannot be determined.
+
+    This only reads the repository files, so that it's much cheaper
+    than running ``git rev-parse HEAD``.
+    """
+    git_dir = repo_dir / '.git'
+    try:
+        with (git_dir / 'HEAD').open() as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head or None  # detached HEAD
+
+        ref = head[len('ref: '):]
+        ref_file = git_dir / ref
+        if ref_file.exists():
+            with ref_file.open() as f:
+                return f.read().strip() or None
+
+        with (git_dir / 'packed-refs').open() as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _git_pull_url(repo_dir):
+    """Return the URL of the origin remote of given git repository."""
+    match = GIT_ORIGIN_URL_RE.search(_git_config(repo_dir))
+    return match.group(1) if match else None
+
+
+def _fetch_time(gist_dir):
+    """Return the timestamp of the last fetch into given gist directory,
+    or None if it's unknown.
+    """
+    for path in (gist_dir / '.git' / 'FETCH_HEAD',
+                 gist_dir / RAW_REVISION_FILE):
+        try:
+            return path.stat().st_mtime
+        except (IOError, OSError):
+            pass
+    return None
+
+
+def _clone_strategy(repo_dir):
+    """Return the :class:`CloneStrategy` that the gist in given directory
+    has been downloaded with.
+    """
+    git_dir = repo_dir / '.git'
+    if not git_dir.exists():
+        return CloneStrategy.RAW
+    if (git_dir / 'info' / 'sparse-checkout').exists():
+        return CloneStrategy.SPARSE
+    if (git_dir / 'shallow').exists():
+        return CloneStrategy.SHALLOW
+    if 'partialclonefilter' in _git_config(repo_dir).lower():
+        return CloneStrategy.PARTIAL
+    return CloneStrategy.FULL
+
+
+def _git_config(repo_dir):
+    """Return the content of the config file of given git repository."""
+    try:
+        with (repo_dir / '.git' / 'config').open() as f:
+            return f.read()
+    except (IOError, OSError):
+        return ''
+
+#: Regular expression for the URL of the origin remote in ``.git/config``.
+GIT_ORIGIN_URL_RE = re.compile(r'\[remote "origin"\][^\[]*?\burl\s*=\s*(\S+)')
@@ -0,0 +1,227 @@
+"""
+Installing the gists listed in a manifest file.
+
+A manifest lists one gist per line, as an <owner>/<name> reference
+or a GitHub URL, optionally followed by the revision to pin it to::
+
+    # comments and blank lines are ignored
+    Octocat/hello.sh
+    Octocat/deploy.py 6cad326836d38bd3a7ae6cad326836d38bd3a7ae
+    https://gist.github.com/Octocat/1a2b3c4d5e6f
+
+Installing a manifest records the exact IDs and revisions of its gists
+in a lockfile next to it (``<manifest>.lock``). As long as it exists,
+the gists are installed in those revisions, and the ones which are
+already present locally are skipped without contacting GitHub at all.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+import re
+import tempfile
+
+from gisht import GISTS_DIR, logger
+from gisht.data import Gist, GistError
+from gisht.gists.bulk import (DOWNLOADED, FAILED, format_results,
+                              process_gists, UNCHANGED, UPDATED)
+from gisht.gists.cache import (checkout_gist_revision, download_gist,
+                               gist_exists, gist_name_of, install_gist,
+                               update_gist)
+from gisht.gists.index import get_gist_index, local_revision
+from gisht.github import get_gist_info
+from gisht.util import error
+
+
+__all__ = ['install_manifest']
+
+
+def install_manifest(path):
+    """Install the gists listed in given manifest file,
+    and record their revisions in the manifest's lockfile.
+
+    The gists are processed concurrently, by as many workers
+    as the ``--jobs`` flag specifies.
+
+    :return: Exit code
+    """
+    path = Path(path)
+    try:
+        entries = read_manifest(path)
+    except (IOError, OSError) as e:
+        error("cannot read manifest %s: %s", path, e, exitcode=os.EX_NOINPUT)
+    except ValueError as e:
+        error("invalid manifest %s: %s", path, e, exitcode=os.EX_DATAERR)
+    if not entries:
+        print("Manifest %s lists no gists." % path)
+        return os.EX_OK
+
+    lock_path = lockfile_path(path)
+    lock = read_lockfile(lock_path)
+
+    # entries which fail to install keep whatever was locked for them
+    locked = dict((spec, lock[spec]) for spec in entries if spec in lock)
+
+    def install(spec):
+        status, locked_entry = install_manifest_entry(
+            spec, entries[spec], lock.get(spec))
+        if locked_entry is not None:
+            locked[spec] = locked_entry
+        return status
+
+    results = process_gists(list(entries), install)
+    write_lockfile(lock_path, locked)
+
+    print("Installed %s gist(s) from %s: %s." % (
+        len(entries), path, format_results(results)))
+    return os.EX_UNAVAILABLE if results[FAILED] else os.EX_OK
+
+
+def install_manifest_entry(spec, pinned, locked_entry=None):
+    """Install a single gist listed in the manifest.
+
+    :param spec: Gist reference or URL, as given in the manifest
+    :param pinned: Revision the gist is pinned to in the manifest, or None
+    :param locked_entry: Entry for the gist from the lockfile, if any
+
+    :return: Tuple of the outcome (one of :data:`SYNC_STATUSES`)
+             and the entry for the gist to put in the lockfile
+    """
+    gist = Gist(spec)
+
+    # the revision in the lockfile is only used while it agrees
+    # with the one pinned in the manifest
+    if locked_entry and pinned and locked_entry.get('revision') != pinned:
+        locked_entry = None
+    revision = pinned or (locked_entry or {}).get('revision')
+
+    # if the locked revision is already here, there is nothing to do
+    ref = gist.ref or (locked_entry or {}).get('ref')
+    if ref and revision and gist_exists(ref) and \
+            _local_revision(ref) == revision:
+        _pin_gist(ref, pinned)
+        return UNCHANGED, _lock_entry(ref)
+
+    if gist.url:
+        gist_json = get_gist_info(gist.id)
+        ref = '%s/%s' % (gist_json['owner']['login'], gist_name_of(gist_json))
+        existed = gist_exists(ref)
+        if not existed:
+            install_gist(ref, gist_json, progress=False)
+    else:
+        existed = gist_exists(ref)
+        if not existed and not download_gist(ref, progress=False):
+            logger.error("gist %s not found", ref)
+            return FAILED, None
+
+    previous_revision = get_gist_index().get(ref).get('revision')
+    _pin_gist(ref, None)  # (so that it can be updated)
+    if revision:
+        success = checkout_gist_revision(ref, revision)
+    else:
+        success = not existed or update_gist(ref, required=False)
+    _pin_gist(ref, pinned)
+    if not success:
+        return FAILED, None
+
+    if not existed:
+        return DOWNLOADED, _lock_entry(ref)
+    if get_gist_index().get(ref).get('revision') == previous_revision:
+        return UNCHANGED, _lock_entry(ref)
+    return UPDATED, _lock_entry(ref)
+
+
+def _pin_gist(gist, revision):
+    """Pin the gist to given revision, or unpin it if it's None."""
+    index = get_gist_index()
+    if (index.get(gist) or {}).get('pinned') != revision:
+        index.put(gist, pinned=revision)
+
+
+def _local_revision(gist):
+    """Return the revision of the downloaded gist that's checked out."""
+    return local_revision(GISTS_DIR / get_gist_index().get(gist)['id'])
+
+
+def _lock_entry(gist):
+    """Return the lockfile entry for the downloaded gist."""
+    entry = get_gist_index().get(gist)
+    return {'ref': gist, 'id': entry['id'], 'revision': entry['revision']}
+
+
+# Manifest and lockfile
+
+def read_manifest(path):
+    """Read the manifest file.
+
+    :return: Ordered dictionary mapping the listed gists (as they're given)
+             to the revisions they're pinned to, or None
+    :raise: :exc:`ValueError` if the manifest is invalid
+    """
+    entries = OrderedDict()
+    with open(str(path)) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) > 2 or \
+                    (len(parts) == 2 and not REVISION_RE.match(parts[1])):
+                raise ValueError("line %s: expected a gist, optionally "
+                                 "followed by its revision" % lineno)
+            try:
+                Gist(parts[0])
+            except GistError as e:
+                raise ValueError("line %s: %s" % (lineno, e))
+            entries[parts[0]] = parts[1] if len(parts) == 2 else None
+    return entries
+
+#: Regular expression for gist revisions in the manifest.
+REVISION_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def lockfile_path(manifest_path):
+    """Return the path to the lockfile of given manifest."""
+    return manifest_path.with_name(manifest_path.name + '.lock')
+
+
+def read_lockfile(path):
+    """Read the lockfile, if it exists.
+
+    :return: Dictionary mapping gists (as they're given in the manifest)
+             to their ``ref``, ``id`` and ``revision``
+    """
+    try:
+        with open(str(path)) as f:
+            data = json.load(f)
+    except (IOError, OSError):
+        return {}
+    except ValueError:
+        logger.warning("ignoring corrupted lockfile %s", path)
+        return {}
+    if data.get('version') != LOCKFILE_VERSION:
+        logger.warning("ignoring lockfile %s in unsupported version %s",
+                       path, data.get('version'))
+        return {}
+    return data.get('gists', {})
+
+
+def write_lockfile(path, entries):
+    """Write the lockfile with given entries."""
+    data = {'version': LOCKFILE_VERSION, 'gists': entries}
+
+    fd, temp_path = tempfile.mkstemp(dir=str(path.parent),
+                                     prefix='.' + path.name)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.rename(temp_path, str(path))
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+#: Version of the lockfile format.
+LOCKFILE_VERSION = 1
@@ -8,7 +8,7 @@ import sys
 import webbrowser
 
 from gisht import BIN_DIR, logger
-from gisht.gists.cache import get_gist_id
+from gisht.gists.cache import get_gist_executable, get_gist_id
 from gisht.github import get_gist_info
 from gisht.util import fatal
 
@@ -29,10 +29,9 @@ def print_gist(gist):
     """Print the source code of the gist specified by owner/name string."""
     logger.debug("showing source code for gist %s", gist)
 
-    # resolve the gist exec symlink to find the source file
     # TODO(xion): what about other possible files?
-    gist_exec = (BIN_DIR / gist).resolve()
-    if gist_exec.exists():
+    gist_exec = get_gist_executable(gist)
+    if gist_exec and gist_exec.exists():
         logger.debug("executable for gist %s found at %s", gist, gist_exec)
     else:
         # TODO(xion): inconsistent state; we should detect those and clean up
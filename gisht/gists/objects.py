@@ -0,0 +1,177 @@
+"""
+Git object store shared by the repositories of downloaded gists.
+"""
+from gisht import GIST_OBJECTS_DIR, logger
+from gisht.data import CloneStrategy
+from gisht.util import ensure_path, file_lock, run
+
+
+__all__ = [
+    'reference_args', 'share_gist_objects', 'unshare_gist_objects',
+    'repack_object_store',
+]
+
+
+#: Clone strategies of gist repositories that use the shared object store.
+#:
+#: Full clones add all their objects to the store, but shallow clones only
+#: add the files of their latest revision, since shallow history in it
+#: would appear complete to the other repositories using the store.
+#: Partial and sparse clones omit most of the files' content anyway.
+SHARING_STRATEGIES = (CloneStrategy.FULL, CloneStrategy.SHALLOW)
+
+
+def reference_args(strategy):
+    """Return the arguments to ``git clone`` that make the new repository
+    borrow the objects it needs from the shared object store (if possible).
+
+    :param strategy: :class:`CloneStrategy` of the clone
+    """
+    if strategy not in SHARING_STRATEGIES or not GIST_OBJECTS_DIR.exists():
+        return []
+    return ['--reference-if-able', GIST_OBJECTS_DIR]
+
+
+def share_gist_objects(repo_dir, strategy):
+    """Make given gist repository use the shared object store,
+    and remove its own copies of the objects that are kept there.
+
+    The repository's objects are added to the store first
+    (which is created if necessary), so that other repositories
+    can share them.
+
+    :param strategy: :class:`CloneStrategy` of the repository
+    :return: Whether the repository is now using the shared object store
+    """
+    if strategy not in SHARING_STRATEGIES:
+        return False
+    if not (ensure_object_store() and add_gist_objects(repo_dir, strategy)):
+        return False
+
+    # with the store listed among the alternates, repacking only keeps
+    # the objects that cannot be found there
+    link_object_store(repo_dir)
+    repack_run = run(['git', 'repack', '-a', '-d', '-l', '-q'],
+                     cwd=repo_dir, timeout=GIT_TIMEOUT)
+    if repack_run.status_code != 0:
+        logger.warning("repacking %s failed (exitcode %s)",
+                       repo_dir, repack_run.status_code)
+    return True
+
+
+def add_gist_objects(repo_dir, strategy):
+    """Add the objects of given gist repository to the shared object store.
+
+    :param strategy: :class:`CloneStrategy` of the repository
+    :return: Whether the objects have been added
+    """
+    if strategy == CloneStrategy.FULL:
+        refspec = '+HEAD:refs/gists/' + repo_dir.name
+    else:
+        # only the tree of a shallow clone's commit is added (under its own
+        # namespace of refs), since its history is incomplete; unlike
+        # commits, trees are never offered to the remote by ``git fetch``
+        # as something that the repositories using the store already have
+        rev_parse_run = run(['git', 'rev-parse', '--verify', '--quiet',
+                             'HEAD^{tree}'], cwd=repo_dir)
+        if rev_parse_run.status_code != 0:
+            logger.warning("cannot find the latest revision of %s", repo_dir)
+            return False
+        refspec = '+%s:refs/shallow/%s' % (rev_parse_run.std_out.strip(),
+                                           repo_dir.name)
+
+    fetch_run = run(['git', '--git-dir', GIST_OBJECTS_DIR, 'fetch',
+                     '--quiet', '--no-tags', repo_dir, refspec],
+                    timeout=GIT_TIMEOUT)
+    if fetch_run.status_code != 0:
+        logger.warning("adding objects of %s to the shared store failed "
+                       "(exitcode %s)", repo_dir, fetch_run.status_code)
+        return False
+    return True
+
+
+def unshare_gist_objects(repo_dir):
+    """Make given gist repository independent of the shared object store,
+    by copying the objects it borrows from there into the repository itself.
+
+    :return: Whether the repository no longer uses the shared object store
+    """
+    alternates = alternates_file(repo_dir)
+    if not alternates.exists():
+        return True
+
+    # without -l, repacking includes the objects found through alternates
+    repack_run = run(['git', 'repack', '-a', '-d', '-q'],
+                     cwd=repo_dir, timeout=GIT_TIMEOUT)
+    if repack_run.status_code != 0:
+        logger.warning("repacking %s failed (exitcode %s)",
+                       repo_dir, repack_run.status_code)
+        return False
+    alternates.unlink()
+    return True
+
+
+def link_object_store(repo_dir):
+    """Add the shared object store to the alternates of given repository."""
+    alternates = alternates_file(repo_dir)
+    store_objects = str(GIST_OBJECTS_DIR.resolve() / 'objects')
+    try:
+        with open(str(alternates)) as f:
+            if store_objects in f.read().splitlines():
+                return
+    except (IOError, OSError):
+        ensure_path(alternates.parent)
+    with open(str(alternates), 'a') as f:
+        f.write(store_objects + '\n')
+
+
+def alternates_file(repo_dir):
+    """Return the path to the file listing the alternate object stores
+    of given repository.
+    """
+    return repo_dir / '.git' / 'objects' / 'info' / 'alternates'
+
+
+def ensure_object_store():
+    """Create the shared object store if it doesn't exist yet.
+
+    :return: Whether the store exists
+    """
+    lock_file = GIST_OBJECTS_DIR.with_name(GIST_OBJECTS_DIR.name + '.lock')
+    with file_lock(lock_file):
+        if GIST_OBJECTS_DIR.exists():
+            return True
+        logger.debug("creating shared object store in %s", GIST_OBJECTS_DIR)
+
+        # automatic garbage collection would prune the objects
+        # that only the gist repositories refer to
+        # (and the sample hooks from the template would only take space)
+        for argv in (['git', 'init', '--bare', '--quiet', '--template=',
+                      GIST_OBJECTS_DIR],
+                     ['git', '--git-dir', GIST_OBJECTS_DIR,
+                      'config', 'gc.auto', '0']):
+            git_run = run(argv)
+            if git_run.status_code != 0:
+                logger.warning("creating shared object store failed: %s",
+                               git_run.std_err.strip())
+                return False
+    return True
+
+
+def repack_object_store():
+    """Pack the objects of the shared object store together.
+
+    The objects are never removed from the store, even if its refs
+    no longer point to them, since the gist repositories may still need them.
+    """
+    if not GIST_OBJECTS_DIR.exists():
+        return
+    repack_run = run(['git', '--git-dir', GIST_OBJECTS_DIR, 'repack',
+                      '-a', '-d', '-q', '--keep-unreachable'],
+                     timeout=GIT_TIMEOUT)
+    if repack_run.status_code != 0:
+        logger.warning("repacking the shared object store failed "
+                       "(exitcode %s)", repack_run.status_code)
+
+#: How long (in seconds) may a local git operation on the store take.
+GIT_TIMEOUT = 10 * 60
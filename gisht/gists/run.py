@@ -10,9 +10,9 @@ import requests
 
 from gisht import BIN_DIR, logger
 from gisht.data import Gist
-from gisht.gists.cache import ensure_gist
+from gisht.gists.cache import ensure_gist, gist_name_of, lock_running_gist
 from gisht.github import get_gist_info
-from gisht.util import error
+from gisht.util import detach_pending, error
 
 
 __all__ = ['run_gist']
@@ -50,10 +50,10 @@ def run_gist_url(gist, args=(), local=False):
         logger.warning("gist %s is owned by %s, not %s",
                        gist.id, owner, gist.owner)
 
-    gist_name = list(sorted(gist_info['files'].keys()))[0]
-    actual_gist_ref = '/'.join((owner, gist_name))
+    actual_gist_ref = '/'.join((owner, gist_name_of(gist_info)))
 
-    ensure_gist(actual_gist_ref, local=local)
+    # we already know everything that's needed to download the gist
+    ensure_gist(actual_gist_ref, local=local, gist_json=gist_info)
     return run_named_gist(actual_gist_ref, args)
 
 
@@ -70,6 +70,8 @@ def run_named_gist(gist, args=()):
         gist = gist.ref
 
     logger.info("running gist %s ...", gist)
+    lock_running_gist(gist)
+    detach_pending(wait=True)  # exec'ing the gist would drop them
 
     executable = bytes(BIN_DIR / gist)
     try:
@@ -1,24 +1,41 @@
 """
 Module implementing requests to GitHub API.
 """
-from collections import OrderedDict
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import time
 
+from furl import furl
 import requests
 
-from gisht import CACHE_DIR, flags, logger
+from gisht import APP_DIR, BACKGROUND_LOG, CACHE_DIR, flags, logger
 from gisht.data import GistCommand
-from gisht.ext import CachedHammock
-from gisht.util import error
+from gisht.ext import CachedHammock, create_session
+from gisht.httpcache import SqliteCacheStore
+from gisht.util import (detach_pending, ensure_path, error, file_lock,
+                        LockTimeout)
 
 
-__all__ = ['get_gist_info', 'iter_gists']
+__all__ = [
+    'get_gist_info', 'get_gist_file', 'iter_gists', 'iter_gist_pages',
+    'list_gists', 'RateLimitExceeded',
+]
 
 
-def get_gist_info(gist_id):
+def get_gist_info(gist_id, revision=None):
     """Retrieve information about gist of given ID.
 
     :param gist_id: ID of a GitHub gist
                     (NOT the user-visible <owner>/<name> string!)
+    :param revision: Optional revision of the gist to retrieve,
+                     instead of the latest one
 
     :return: Dictionary with gist information
     :raises: :class:`requests.exception.HTTPError`
@@ -28,11 +45,30 @@ def get_gist_info(gist_id):
         raise ValueError("expected gist ID, not the <owner>/<name> reference!")
 
     github = GitHub()
-    response = github.gists.GET(gist_id)
+    if revision is None:
+        response = github.gists.GET(gist_id)
+    else:
+        response = github.gists.GET(gist_id, str(revision))
     response.raise_for_status()
     return response.json()
 
 
+def get_gist_file(raw_url):
+    """Download the content of a single gist file.
+
+    :param raw_url: URL of the file's raw content, as given in gist JSON
+
+    :return: Content of the file as bytes
+    :raises: :class:`requests.exception.HTTPError`
+    """
+    response = get_session().get(raw_url, timeout=RAW_FILE_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+#: How long (in seconds) to wait for the content of a gist file.
+RAW_FILE_TIMEOUT = 60
+
+
 def iter_gists(owner):
     """Iterate over gists owned by given user.
 
@@ -40,54 +76,562 @@ def iter_gists(owner):
     :return: Iterable (generator) of parsed JSON objects (dictionaries)
     :raises: :class:`requests.exception.HTTPError`
     """
+    pages = iter_gist_pages(owner)
+
+    def generator():
+        try:
+            for page in pages:
+                for gist_json in page:
+                    yield gist_json
+        finally:
+            pages.close()  # stop fetching the remaining pages
+
+    return generator()
+
+
+def iter_gist_pages(owner):
+    """Iterate over pages of the list of gists owned by given user.
+
+    Once the first page reveals how many of them there are, the remaining
+    pages are fetched concurrently (but still yielded in order).
+    Closing the generator early cancels fetching of the outstanding pages.
+
+    :param owner: GitHub user's name
+    :return: Iterable (generator) of lists of parsed JSON objects
+    :raises: :class:`requests.exception.HTTPError`
+    """
     if type(owner).__name__ not in ('str', 'unicode'):
         raise TypeError("expected a string")
 
-    def generator():
-        github = GitHub()
-        gists_url = str(github.users(owner).gists)
-        while gists_url:
-            gists_response = requests.get(
-                gists_url, params={'per_page': GitHub.RESPONSE_PAGE_SIZE})
+    github = GitHub()
+
+    def fetch_page(page):
+        try:
+            # every page is cached (and revalidated) separately
+            gists_response = github.users(owner).gists.GET(params={
+                'per_page': GitHub.RESPONSE_PAGE_SIZE,
+                'page': page,
+            })
             gists_response.raise_for_status()
+            return gists_response
+        except SystemExit as e:
+            # this would kill the worker thread of the pool,
+            # so pass it through to the caller instead
+            return e
+
+    def generator():
+        first_response = fetch_page(1)
+        if isinstance(first_response, SystemExit):
+            raise first_response
+        yield to_json(first_response)
 
-            for gist_json in to_json(gists_response):
-                yield gist_json
+        page_count = last_page(first_response)
+        if page_count is None:
+            # no information about the number of pages,
+            # so just follow the links to the next ones
+            page = next_page(first_response)
+            while page:
+                response = fetch_page(page)
+                if isinstance(response, SystemExit):
+                    raise response
+                yield to_json(response)
+                page = next_page(response)
+            return
+        if page_count <= 1:
+            return  # (a pool for no remaining pages cannot be created)
 
-            gists_url = gists_response.links.get('next', {}).get('url')
+        # only fetch a few pages ahead of the one that has been yielded,
+        # so that not much is wasted if the caller stops early
+        concurrency = min(page_count - 1, GitHub.PAGE_FETCH_CONCURRENCY)
+        pool = ThreadPool(concurrency)
+        pending = deque()
+
+        def next_pending():
+            response = pending.popleft().get()
+            if isinstance(response, SystemExit):
+                raise response
+            return to_json(response)
+
+        try:
+            for page in range(2, page_count + 1):
+                pending.append(pool.apply_async(fetch_page, (page,)))
+                if len(pending) >= concurrency:
+                    yield next_pending()
+            while pending:
+                yield next_pending()
+        finally:
+            pool.terminate()
+            if not pending:
+                pool.join()  # (no page is being fetched anymore)
+            # refreshes of stale pages couldn't be detached by the workers
+            detach_pending()
 
     return generator()
 
 
+def list_gists(owner):
+    """Return the complete list of gists owned by given user.
+
+    The list is only retrieved (from cache or GitHub) once per process,
+    so the same snapshot is shared by all code that needs it.
+
+    :param owner: GitHub user's name
+    :return: List of parsed JSON objects (dictionaries)
+    :raises: :class:`requests.exception.HTTPError`
+    """
+    if owner not in _gist_lists:
+        _gist_lists[owner] = list(iter_gists(owner))
+    return _gist_lists[owner]
+
+#: Lists of gists retrieved so far, keyed by owner names.
+_gist_lists = {}
+
+
 # API client
 
+class RateLimitExceeded(requests.exceptions.HTTPError):
+    """Exception raised when a request to GitHub API cannot be made
+    (or has been refused) because of its rate limit.
+    """
+    def __init__(self, reset_time=None, response=None):
+        """Constructor.
+
+        :param reset_time: Timestamp when the requests will be allowed again
+        """
+        msg = "GitHub API rate limit exceeded"
+        if reset_time:
+            msg += " until %s" % (
+                datetime.fromtimestamp(reset_time).strftime('%H:%M:%S'))
+        if not get_token():
+            msg += " (set %s for a higher limit)" % TOKEN_ENV_VARS[0]
+        super(RateLimitExceeded, self).__init__(msg, response=response)
+        self.reset_time = reset_time
+
+
 class GitHub(CachedHammock):
     """Client for GitHub REST API."""
     API_URL = 'https://api.github.com'
 
     #: Size of the GitHub response page in items (e.g. gists).
-    RESPONSE_PAGE_SIZE = 50
+    #: This is the maximum that the API allows.
+    RESPONSE_PAGE_SIZE = 100
+
+    #: Maximum number of pages of a paginated response
+    #: that are fetched concurrently.
+    PAGE_FETCH_CONCURRENCY = 4
+
+    #: Time-to-live of cached responses from particular API endpoints,
+    #: as pairs of request path regexes and :class:`timedelta`\ s.
+    CACHE_TTLS = [
+        # gist metadata (only --info displays the volatile parts of it)
+        (re.compile(r'^gists/[^/]+$'), timedelta(hours=1)),
+        # list of user's gists (new gists should show up relatively quickly)
+        (re.compile(r'^users/[^/]+/gists(\?|$)'), timedelta(minutes=10)),
+    ]
+
+    #: How long after expiry can a cached response still be served
+    #: while it's being refreshed in the background.
+    CACHE_STALE_TTL = timedelta(days=1)
+
+    #: Maximum number of times a request is repeated
+    #: after GitHub has refused it because of rate limiting.
+    RATE_LIMIT_RETRIES = 2
+
+    # hitting the rate limit is no worse than a network failure
+    # when there is a cached response to fall back on
+    RESCUED_ERRORS = CachedHammock.RESCUED_ERRORS + (RateLimitExceeded,)
 
     def __init__(self, *args, **kwargs):
-        kwargs.setdefault('cache_dir', CACHE_DIR / 'github')
+        """Constructor.
+
+        :param rate_limiter: :class:`RateLimiter` that will schedule
+                             the requests, instead of the shared one
+        """
+        self._rate_limiter = kwargs.pop('rate_limiter', None)
+        if self._rate_limiter is None:
+            self._rate_limiter = get_rate_limiter()
+        if 'cache_dir' not in kwargs:
+            kwargs.setdefault('cache_store', get_cache_store())
+        kwargs.setdefault('cache_stale_ttl', self.CACHE_STALE_TTL)
+        kwargs.setdefault('background_log', BACKGROUND_LOG)
+        kwargs.setdefault('session', get_session())
         super(GitHub, self).__init__(self.API_URL, *args, **kwargs)
 
+    def _send(self, method, *args, **kwargs):
+        # (the token is only sent to the API, not to other GitHub hosts
+        # that the shared session is used for)
+        token = get_token()
+        if token:
+            kwargs.setdefault('auth', TokenAuth(token))
+
+        priority = (RateLimiter.BACKGROUND if self._in_background
+                    else RateLimiter.INTERACTIVE)
+        for _ in range(self.RATE_LIMIT_RETRIES + 1):
+            self._rate_limiter.acquire(priority)
+            response = super(GitHub, self)._send(method, *args, **kwargs)
+            if not self._rate_limiter.update(response):
+                return response
+            # otherwise, the next acquire() will wait for as long
+            # as GitHub has told us to (or give up if that's too long)
+        raise RateLimitExceeded(response=response)
+
+    def _cache_ttl_for(self, path):
+        for path_regex, ttl in self.CACHE_TTLS:
+            if path_regex.match(path):
+                return ttl
+        return super(GitHub, self)._cache_ttl_for(path)
+
+    def _expired(self, path, cached):
+        if getattr(flags, 'local', None):
+            return False  # any cached response is better than none
+        return super(GitHub, self)._expired(path, cached)
+
+    # flags may be missing entirely when we're invoked for autocompletion,
+    # hence all the getattr()s
+
     def _on_cache_miss(self, path):
-        if flags.local:
+        if getattr(flags, 'local', None):
             error("can't access GitHub path /%s in --local mode", path)
 
     def _on_cache_hit(self, path, content):
-        if flags.local is False:
-            return False  # bypass the cache
+        if getattr(flags, 'local', None) is False:
+            return False  # --fetch, so revalidate the cached response
+
+    def _on_cache_stale(self, path, content):
+        if getattr(flags, 'local', None) is False:
+            return False  # --fetch, so revalidate the cached response now
+
+    def _refresh_in_background(self, *args, **kwargs):
+        if getattr(flags, 'local', None):
+            return  # nothing can be fetched in --local mode
+        super(GitHub, self)._refresh_in_background(*args, **kwargs)
 
     def _on_cache_rescue(self, path, content):
-        if flags.command == GistCommand.INFO:
+        if getattr(flags, 'command', None) == GistCommand.INFO:
             logger.warning("could not communicate with GitHub -- "
                            "gist information may be out of date")
 
 
+# HTTP session
+
+#: Process-wide session for requests to GitHub, and the PID of the process
+#: it belongs to (since pooled connections cannot be shared with children).
+_session = None
+_session_pid = None
+
+#: Maximum number of connections to GitHub that are kept open.
+SESSION_POOL_SIZE = 8
+
+#: Maximum number of retries of a GitHub request after transient failures.
+SESSION_RETRIES = 3
+
+
+def get_session():
+    """Return the :class:`requests.Session` shared by all requests to GitHub,
+    so that connections are reused between them.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = create_session(pool_size=SESSION_POOL_SIZE,
+                                  retries=SESSION_RETRIES)
+        _session_pid = os.getpid()
+    return _session
+
+
+#: Environment variables that can hold the GitHub access token,
+#: in the order of precedence.
+TOKEN_ENV_VARS = ('GISHT_GITHUB_TOKEN', 'GITHUB_TOKEN')
+
+
+def get_token():
+    """Return the GitHub access token to authenticate the requests with,
+    or None if there isn't any.
+
+    Authenticated requests are subject to a much higher rate limit.
+    No special scopes are needed for the token, since gisht only reads
+    publicly available data.
+    """
+    for env_var in TOKEN_ENV_VARS:
+        token = os.environ.get(env_var, '').strip()
+        if token:
+            return token
+    return None
+
+
+class TokenAuth(requests.auth.AuthBase):
+    """Authentication of a request to GitHub API with an access token."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, request):
+        request.headers['Authorization'] = 'token %s' % self.token
+        return request
+
+
+# Rate limiting
+
+#: Process-wide scheduler of the requests to GitHub API.
+_rate_limiter = None
+
+#: File with the rate limit state shared by all gisht processes.
+RATE_LIMIT_FILE = APP_DIR / 'ratelimit.json'
+
+
+def get_rate_limiter():
+    """Return the :class:`RateLimiter` for all requests to GitHub API."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(RATE_LIMIT_FILE, identity=_identity())
+    return _rate_limiter
+
+
+def _identity():
+    """Return the identifier of whoever GitHub is charging for our requests.
+
+    Requests authenticated with different tokens (or none at all)
+    are subject to separate rate limits.
+    """
+    token = get_token()
+    if not token:
+        return 'anonymous'
+    return 'token:' + hashlib.sha1(token.encode('utf-8')).hexdigest()[:12]
+
+
+class RateLimiter(object):
+    """Scheduler of requests to GitHub API that keeps them within
+    its rate limit.
+
+    The remaining request budget (as reported by GitHub) is tracked
+    in a state file that's shared by all gisht processes, so they
+    don't deplete it without knowing about each other.
+
+    Interactive requests are only delayed when the limit has actually
+    been exceeded. Background ones are paced evenly over the rate limit
+    window, and never use up the part of the budget that's reserved
+    for interactive requests.
+    """
+    #: Priorities of the requests.
+    INTERACTIVE = 'interactive'
+    BACKGROUND = 'background'
+
+    #: Fraction of the request budget reserved for interactive requests.
+    BACKGROUND_RESERVE = 0.25
+
+    #: Maximum time (in seconds) that requests of given priority
+    #: will be delayed for, before :class:`RateLimitExceeded` is raised.
+    MAX_WAIT = {INTERACTIVE: 30, BACKGROUND: 60}
+
+    #: Delay (in seconds) before retrying a request refused by GitHub
+    #: because of a secondary rate limit, if it didn't say how long to wait.
+    DEFAULT_RETRY_AFTER = 60
+
+    def __init__(self, state_file, identity='anonymous'):
+        """Constructor.
+
+        :param state_file: Path to the file with shared rate limit state
+        :param identity: Identifier of the rate limit that applies
+                         to the requests (e.g. the token they use)
+        """
+        self.state_file = state_file
+        self.identity = identity
+
+    def acquire(self, priority=INTERACTIVE):
+        """Wait until a request of given priority can be made,
+        and account for it in the request budget.
+
+        :raise: :class:`RateLimitExceeded` if the request would have
+                to be delayed for too long
+        """
+        while True:
+            with self._state() as state:
+                now = time.time()
+                wait = self._wait_time(state, priority, now)
+                if wait <= 0:
+                    if state.get('remaining') is not None:
+                        state['remaining'] -= 1
+                    state['last_request_' + priority] = now
+                    return
+
+            if wait > self.MAX_WAIT[priority]:
+                raise RateLimitExceeded(now + wait)
+            logger.debug("waiting %.1fs for GitHub API rate limit", wait)
+            time.sleep(wait)
+
+    def update(self, response):
+        """Update the request budget from given response of GitHub API.
+
+        :return: Whether the request has been refused due to rate limiting
+                 (and should be repeated later)
+        """
+        headers = response.headers
+        with self._state() as state:
+            now = time.time()
+            if 'X-RateLimit-Remaining' in headers:
+                state['limit'] = int(headers.get('X-RateLimit-Limit', 0))
+                state['remaining'] = int(headers['X-RateLimit-Remaining'])
+                state['reset'] = int(headers.get('X-RateLimit-Reset', 0))
+
+            if response.status_code not in (403, 429):
+                return False
+            retry_after = headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                state['blocked_until'] = now + int(retry_after)
+            elif state.get('remaining') == 0:
+                state['blocked_until'] = state.get('reset', now)
+            elif response.status_code == 429 or \
+                    'rate limit' in response.text.lower():
+                state['blocked_until'] = now + self.DEFAULT_RETRY_AFTER
+            else:
+                return False  # some other kind of 403 Forbidden
+            return True
+
+    def _wait_time(self, state, priority, now):
+        """Return how long must a request of given priority wait
+        before it can be made.
+        """
+        blocked_until = state.get('blocked_until', 0)
+        if blocked_until > now:
+            return blocked_until - now
+
+        remaining = state.get('remaining')
+        reset = state.get('reset', 0)
+        if remaining is None or reset <= now:
+            return 0  # the budget is unknown or has been renewed
+
+        reserve = 0
+        if priority == self.BACKGROUND:
+            reserve = max(1, int(state.get('limit', 0) *
+                                 self.BACKGROUND_RESERVE))
+        if remaining <= reserve:
+            return reset - now
+        if priority == self.INTERACTIVE:
+            return 0
+
+        # spread the background requests evenly until the budget renews
+        interval = (reset - now) / float(remaining - reserve)
+        last_request = state.get('last_request_' + priority, 0)
+        return last_request + interval - now
+
+    @contextmanager
+    def _state(self):
+        """Context manager for exclusive access to the rate limit state
+        of our identity, which is saved afterwards.
+        """
+        ensure_path(self.state_file.parent)
+        lock_file = self.state_file.with_name(self.state_file.name + '.lock')
+        with file_lock(lock_file):
+            try:
+                with open(str(self.state_file)) as f:
+                    all_states = json.load(f)
+            except (IOError, OSError, ValueError):
+                all_states = {}
+
+            state = all_states.setdefault(self.identity, {})
+            try:
+                yield state
+            finally:
+                with open(str(self.state_file), 'w') as f:
+                    json.dump(all_states, f)
+
+
+# Response cache
+
+#: Process-wide store for cached responses from GitHub API.
+_cache_store = None
+
+#: Path to the database file of the GitHub response cache.
+CACHE_DB = CACHE_DIR / 'github.sqlite'
+
+#: Directory with lock files that prevent multiple processes
+#: from fetching the same GitHub URL at the same time.
+CACHE_LOCKS_DIR = CACHE_DIR / 'locks'
+
+#: Maximum total size (in bytes) of the GitHub response cache.
+CACHE_MAX_SIZE = 32 * 1024 * 1024
+
+#: Maximum number of responses in the GitHub response cache.
+CACHE_MAX_ENTRIES = 10000
+
+#: How long do cached responses remain in the cache after they had been
+#: last revalidated; after that, they are purged by ``--cache-gc``.
+CACHE_RETENTION = timedelta(days=30)
+
+#: Directory of the GitHub response cache from previous versions
+#: of the application, where every response was stored in a separate file.
+LEGACY_CACHE_DIR = CACHE_DIR / 'github'
+
+
+def get_cache_store():
+    """Return the :class:`CacheStore` for responses from GitHub API.
+
+    The first time this is called, any responses cached by previous versions
+    of the application are also removed.
+    """
+    global _cache_store
+    if _cache_store is None:
+        _cache_store = SqliteCacheStore(CACHE_DB,
+                                        max_size=CACHE_MAX_SIZE,
+                                        max_entries=CACHE_MAX_ENTRIES,
+                                        lock_dir=CACHE_LOCKS_DIR)
+        remove_legacy_cache()
+    return _cache_store
+
+
+def remove_legacy_cache():
+    """Remove the GitHub responses cached by previous versions
+    of the application.
+
+    Those were pickled :class:`requests.Response` objects,
+    which aren't worth the risk of unpickling them just to convert them;
+    the responses will simply be fetched again.
+    """
+    if not LEGACY_CACHE_DIR.is_dir():
+        return
+    try:
+        # if another process holds the lock, it's removing the cache already
+        with file_lock(CACHE_LOCKS_DIR / 'legacy', timeout=0):
+            if not LEGACY_CACHE_DIR.is_dir():
+                return
+            # the directory is moved out of the way first, so that anyone
+            # still reading the files can finish doing so
+            removed_dir = LEGACY_CACHE_DIR.with_name(
+                '.%s.%s' % (LEGACY_CACHE_DIR.name, os.getpid()))
+            os.rename(str(LEGACY_CACHE_DIR), str(removed_dir))
+            shutil.rmtree(str(removed_dir), ignore_errors=True)
+    except LockTimeout:
+        return
+    except OSError as e:
+        logger.warning("cannot remove the old GitHub response cache %s: %s",
+                       LEGACY_CACHE_DIR, e)
+        return
+    logger.debug("removed the old GitHub response cache %s", LEGACY_CACHE_DIR)
+
+
 # Utility functions
 
 def to_json(response):
     """Interpret given Requests' response object as JSON."""
     return response.json(object_pairs_hook=OrderedDict)
+
+
+def next_page(response):
+    """Return the number of the next page of a paginated GitHub response,
+    or None if it's the last one.
+    """
+    return _linked_page(response, 'next')
+
+
+def last_page(response):
+    """Return the number of the last page of a paginated GitHub response,
+    or None if it's not known.
+    """
+    return _linked_page(response, 'last')
+
+
+def _linked_page(response, rel):
+    url = response.links.get(rel, {}).get('url')
+    if not url:
+        return None
+    page = furl(url).args.get('page')
+    return int(page) if page else None
@@ -0,0 +1,687 @@
+"""
+Module implementing the storage of cached HTTP responses.
+"""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from gisht.util import ensure_path, file_lock, remove_lock_file
+
+
+__all__ = [
+    'CacheRecord', 'CacheRecordError',
+    'CacheStore', 'DirectoryCacheStore', 'SqliteCacheStore',
+]
+
+
+class CacheRecord(object):
+    """Cached HTTP response.
+
+    Unlike a pickled :class:`requests.Response`, the record only holds
+    the parts of the response that we actually use, and can be (de)serialized
+    without importing :module:`requests` at all.
+
+    Records also mimic the :class:`requests.Response` interface closely enough
+    so that they can be returned from :class:`gisht.ext.CachedHammock`
+    in lieu of actual responses.
+    """
+    __slots__ = ('url', 'status_code', 'headers', 'content', 'timestamp')
+
+    #: Version of the serialized record format.
+    #: Records of other versions are treated as invalid.
+    VERSION = 1
+
+    #: Response headers that are retained in the cache record.
+    HEADERS = ('Cache-Control', 'Content-Type', 'Date', 'ETag', 'Expires',
+               'Last-Modified', 'Link')
+
+    #: Minimum size of the response body (in bytes) for it to be compressed.
+    COMPRESSION_THRESHOLD = 512
+
+    def __init__(self, url, status_code, headers=None, content=b'',
+                 timestamp=None):
+        """Constructor.
+
+        :param timestamp: UNIX timestamp of when the response has been
+                          obtained (or last revalidated) from the server
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = Headers(headers or {})
+        self.content = content
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @classmethod
+    def from_response(cls, response):
+        """Create the record from :class:`requests.Response` object."""
+        headers = dict((name, response.headers[name])
+                       for name in cls.HEADERS if name in response.headers)
+        return cls(response.url, response.status_code,
+                   headers=headers, content=response.content)
+
+    # Serialization
+
+    @classmethod
+    def loads(cls, data):
+        """Deserialize the record from given bytes.
+
+        The data consists of a single line of JSON metadata,
+        followed by the (possibly compressed) response body.
+
+        :raise: :class:`CacheRecordError` if the data is not a valid record
+        """
+        header, sep, body = data.partition(b'\n')
+        try:
+            meta = json.loads(header.decode('utf-8'))
+            if not isinstance(meta, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            raise CacheRecordError("malformed cache record: %s" % e)
+        if not sep or meta.get('v') != cls.VERSION:
+            raise CacheRecordError(
+                "unsupported cache record version: %r" % (meta.get('v'),))
+
+        if meta.get('z'):
+            try:
+                body = zlib.decompress(body)
+            except zlib.error as e:
+                raise CacheRecordError("corrupted cache record: %s" % e)
+
+        return cls(meta['url'], meta['status'], headers=meta['headers'],
+                   content=body, timestamp=meta['ts'])
+
+    def dumps(self):
+        """Serialize the record to bytes."""
+        body = self.content
+        compressed = len(body) >= self.COMPRESSION_THRESHOLD
+        if compressed:
+            body = zlib.compress(body)
+
+        meta = {'v': self.VERSION, 'url': self.url, 'status': self.status_code,
+                'headers': dict(self.headers), 'z': compressed,
+                'ts': self.timestamp}
+        header = json.dumps(meta, separators=(',', ':'), sort_keys=True)
+        return header.encode('utf-8') + b'\n' + body
+
+    # Response interface
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def encoding(self):
+        content_type = self.headers.get('Content-Type', '')
+        for param in content_type.split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'charset':
+                return value.strip('"\'')
+        return 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    @property
+    def links(self):
+        link_header = self.headers.get('Link')
+        if not link_header:
+            return {}
+
+        from requests.utils import parse_header_links
+        result = {}
+        for link in parse_header_links(link_header):
+            result[link.get('rel') or link.get('url')] = link
+        return result
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def raise_for_status(self):
+        if self.ok:
+            return
+        # only now it's worth it to create an actual response object
+        response = self.to_response()
+        response.raise_for_status()
+
+    def to_response(self):
+        """Convert the record to a :class:`requests.Response` object."""
+        import requests
+
+        response = requests.Response()
+        response.url = self.url
+        response.status_code = self.status_code
+        response.headers.update(self.headers)
+        response._content = self.content
+        response.encoding = self.encoding
+        return response
+
+    # Cache management
+
+    def refresh(self, response):
+        """Refresh the record after the server has confirmed
+        (with 304 Not Modified) that it is still valid.
+
+        :param response: The 304 :class:`requests.Response`
+        """
+        for name in self.HEADERS:
+            value = response.headers.get(name)
+            if value:
+                self.headers[name] = value
+        self.timestamp = time.time()
+
+
+class CacheRecordError(ValueError):
+    """Exception raised when a cache record cannot be deserialized."""
+
+
+class Headers(dict):
+    """Dictionary of HTTP headers with case-insensitive lookup."""
+
+    def __init__(self, headers):
+        super(Headers, self).__init__(
+            (name.title(), value) for name, value in headers.items())
+
+    def __contains__(self, name):
+        return super(Headers, self).__contains__(name.title())
+
+    def __getitem__(self, name):
+        return super(Headers, self).__getitem__(name.title())
+
+    def __setitem__(self, name, value):
+        super(Headers, self).__setitem__(name.title(), value)
+
+    def get(self, name, default=None):
+        return super(Headers, self).get(name.title(), default)
+
+
+# Storage backends
+
+class CacheStore(object):
+    """Base class for storage backends of :class:`CacheRecord` objects.
+
+    Records are stored under string keys, which are typically
+    the request paths (without leading slash).
+
+    The store can optionally be bounded in size, in which case
+    least recently used records are evicted whenever a new one is stored.
+    """
+    def __init__(self, max_size=None, max_entries=None, lock_dir=None):
+        """Constructor.
+
+        :param max_size: Maximum total size of stored records in bytes
+        :param max_entries: Maximum number of stored records
+        :param lock_dir: Directory for files used to lock individual keys
+                         across processes (see :meth:`lock`)
+        """
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.lock_dir = None if lock_dir is None else Path(lock_dir)
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        """Context manager that holds an exclusive, inter-process lock
+        on given key for the duration of the ``with`` block.
+
+        This doesn't prevent any store operations. It is merely a way
+        to coordinate multiple processes that want to update the same record.
+        If the store doesn't have a ``lock_dir``, this does nothing.
+
+        :raise: :class:`gisht.util.LockTimeout`
+        """
+        if self.lock_dir is None:
+            yield
+            return
+
+        lock_file = self.lock_dir / self._lock_name(key)
+        with file_lock(lock_file, timeout=timeout):
+            try:
+                os.utime(str(lock_file), None)  # see purge_locks()
+            except OSError:
+                pass
+            yield
+
+    def purge_locks(self, max_age):
+        """Remove the files used to lock the keys which are no longer
+        in the store, or haven't been locked for given time.
+
+        Files that are currently locked are left alone.
+
+        :param max_age: :class:`timedelta`
+        :return: Number of removed files
+        """
+        if self.lock_dir is None or not self.lock_dir.is_dir():
+            return 0
+
+        current_locks = set(self._lock_name(key)
+                            for key, _, _ in self.entries())
+        oldest_mtime = time.time() - max_age.total_seconds()
+
+        count = 0
+        for lock_file in self.lock_dir.iterdir():
+            try:
+                mtime = lock_file.stat().st_mtime
+            except OSError:
+                continue  # deleted in the meantime
+            if lock_file.name in current_locks and mtime >= oldest_mtime:
+                continue
+            if remove_lock_file(lock_file):
+                count += 1
+        return count
+
+    def _lock_name(self, key):
+        """Return the name of the file used to lock given key."""
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Retrieve the record stored under given key.
+        :return: :class:`CacheRecord`, or None if it's missing or invalid
+        """
+        raise NotImplementedError()
+
+    def put(self, key, record):
+        """Store the record under given key, replacing any previous one.
+
+        If this makes the store go over its budget, the least recently used
+        records are evicted.
+        """
+        self._put(key, record)
+        if self.max_size is not None or self.max_entries is not None:
+            self.evict()
+
+    def _put(self, key, record):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Delete the record stored under given key, if any."""
+        raise NotImplementedError()
+
+    def items(self):
+        """Iterate over all the stored records.
+        :return: Iterable of (key, :class:`CacheRecord`) pairs
+        """
+        raise NotImplementedError()
+
+    def entries(self):
+        """Iterate over metadata of all the stored records.
+        :return: Iterable of (key, size, last access timestamp) tuples
+        """
+        raise NotImplementedError()
+
+    def expired(self, timestamp):
+        """Iterate over keys of records which have been stored
+        (or revalidated) before given UNIX ``timestamp``.
+        """
+        return [key for key, record in self.items()
+                if record.timestamp < timestamp]
+
+    def invalidate(self, prefix):
+        """Delete all records whose keys start with given prefix.
+        :return: Number of deleted records
+        """
+        keys = [key for key, _ in self.items() if key.startswith(prefix)]
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+    def stats(self):
+        """Return the number of stored records and their total size."""
+        count = size = 0
+        for _, entry_size, _ in self.entries():
+            count += 1
+            size += entry_size
+        return count, size
+
+    def evict(self, max_size=None, max_entries=None):
+        """Evict the least recently used records until the store
+        is within given budget (or its own budget, by default).
+
+        :return: Number of evicted records and their total size
+        """
+        max_size = self.max_size if max_size is None else max_size
+        max_entries = self.max_entries if max_entries is None else max_entries
+
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        count = len(entries)
+        size = sum(entry_size for _, entry_size, _ in entries)
+
+        evicted_count = evicted_size = 0
+        for key, entry_size, _ in entries:
+            if not ((max_size is not None and size > max_size) or
+                    (max_entries is not None and count > max_entries)):
+                break
+            self.delete(key)
+            count -= 1
+            size -= entry_size
+            evicted_count += 1
+            evicted_size += entry_size
+        return evicted_count, evicted_size
+
+    def compact(self):
+        """Reclaim the disk space freed by deleted records, if possible."""
+
+    def disk_usage(self):
+        """Return the amount of disk space (in bytes) taken by the store."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Release any resources held by the store."""
+
+
+class DirectoryCacheStore(CacheStore):
+    """Cache store that keeps every record in a separate file,
+    inside a directory tree mirroring the record keys.
+
+    Modification times of the files are used as their last access times.
+    """
+    def __init__(self, path, **kwargs):
+        super(DirectoryCacheStore, self).__init__(**kwargs)
+        self.path = Path(path)
+
+    def get(self, key):
+        cache_file = self.path / key
+        try:
+            with cache_file.open('rb') as f:
+                record = CacheRecord.loads(f.read())
+        except (IOError, OSError):
+            return None
+        except CacheRecordError:
+            # probably a leftover from older version of the application
+            # (which used to store pickled responses); just overwrite it
+            return None
+
+        try:
+            os.utime(str(cache_file), None)  # mark as recently used
+        except OSError:
+            pass
+        return record
+
+    def _put(self, key, record):
+        cache_file = self.path / key
+        ensure_path(cache_file.parent)
+
+        # write to a temporary file first and then atomically rename it,
+        # so that concurrent readers never see a partially written record
+        fd, temp_path = tempfile.mkstemp(dir=str(cache_file.parent),
+                                         prefix='.' + cache_file.name)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(record.dumps())
+            os.rename(temp_path, str(cache_file))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            (self.path / key).unlink()
+        except OSError:
+            pass
+
+    def items(self):
+        for key, _, _ in self.entries():
+            record = self.get(key)
+            if record is not None:
+                yield key, record
+
+    def entries(self):
+        for dirpath, _, filenames in os.walk(str(self.path)):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue  # unfinished write
+                cache_file = Path(dirpath) / filename
+                try:
+                    stat = cache_file.stat()
+                except OSError:
+                    continue  # deleted in the meantime
+                key = '/'.join(cache_file.relative_to(self.path).parts)
+                yield key, stat.st_size, stat.st_mtime
+
+    def compact(self):
+        # remove empty directories, deepest first
+        for dirpath, _, _ in sorted(os.walk(str(self.path)), reverse=True):
+            if dirpath != str(self.path):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass  # not empty
+
+    def disk_usage(self):
+        return self.stats()[1]
+
+
+class SqliteCacheStore(CacheStore):
+    """Cache store that keeps all the records in a single SQLite database.
+
+    Lookups, expiry scans, LRU eviction and invalidation by key prefix
+    are all served by the database indexes. The total count and size
+    of the records are kept up to date by triggers, so that checking
+    whether anything needs to be evicted doesn't require a full scan.
+    """
+    #: Version of the database schema.
+    #: Since it's just a cache, databases with different version are
+    #: simply recreated from scratch.
+    SCHEMA_VERSION = 3
+
+    #: How long (in seconds) to wait for other processes
+    #: to release their lock on the database.
+    BUSY_TIMEOUT = 10
+
+    SCHEMA = [
+        """CREATE TABLE responses (
+            key TEXT PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            accessed REAL NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )""",
+        """CREATE INDEX responses_timestamp ON responses (timestamp)""",
+        """CREATE INDEX responses_accessed ON responses (accessed)""",
+        """CREATE TABLE stats (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            count INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        )""",
+        """INSERT INTO stats (id, count, size) VALUES (0, 0, 0)""",
+        """CREATE TRIGGER responses_insert AFTER INSERT ON responses BEGIN
+            UPDATE stats SET count = count + 1, size = size + NEW.size;
+        END""",
+        """CREATE TRIGGER responses_delete AFTER DELETE ON responses BEGIN
+            UPDATE stats SET count = count - 1, size = size - OLD.size;
+        END""",
+        """CREATE TRIGGER responses_update AFTER UPDATE OF size ON responses
+        BEGIN
+            UPDATE stats SET size = size - OLD.size + NEW.size;
+        END""",
+    ]
+
+    def __init__(self, path, **kwargs):
+        super(SqliteCacheStore, self).__init__(**kwargs)
+        self.path = Path(path)
+        self._db = None
+        self._thread_lock = threading.RLock()
+        self._pid = os.getpid()
+
+    @property
+    def _db_lock(self):
+        """Lock serializing the access to database connection
+        between threads.
+        """
+        if self._pid != os.getpid():
+            # neither SQLite connections nor thread locks can be used
+            # across fork(), so the child process needs to make its own
+            self._db = None
+            self._thread_lock = threading.RLock()
+            self._pid = os.getpid()
+        return self._thread_lock
+
+    @property
+    def db(self):
+        """Connection to the database, opened on first use.
+        Must be accessed while holding :attr:`_db_lock`.
+        """
+        if self._db is None:
+            ensure_path(self.path.parent)
+            db = sqlite3.connect(str(self.path), timeout=self.BUSY_TIMEOUT,
+                                 check_same_thread=False,
+                                 isolation_level=None)  # autocommit
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            # (so that the rows removed by INSERT OR REPLACE are accounted for)
+            db.execute('PRAGMA recursive_triggers=ON')
+
+            schema_version, = db.execute('PRAGMA user_version').fetchone()
+            if schema_version != self.SCHEMA_VERSION:
+                db.execute('BEGIN IMMEDIATE')
+                # check again, as other process may have beaten us to it
+                schema_version, = db.execute('PRAGMA user_version').fetchone()
+                if schema_version != self.SCHEMA_VERSION:
+                    db.execute('DROP TABLE IF EXISTS responses')
+                    db.execute('DROP TABLE IF EXISTS stats')
+                    for statement in self.SCHEMA:
+                        db.execute(statement)
+                    db.execute(
+                        'PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+                db.execute('COMMIT')
+
+            self._db = db
+        return self._db
+
+    def get(self, key):
+        with self._db_lock:
+            row = self.db.execute(
+                'SELECT data FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                            (time.time(), key))
+        try:
+            return CacheRecord.loads(bytes(row[0]))
+        except CacheRecordError:
+            return None
+
+    def _put(self, key, record):
+        data = record.dumps()
+        with self._db_lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, timestamp, accessed, size, data) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, record.timestamp, time.time(), len(data),
+                 sqlite3.Binary(data)))
+
+    def delete(self, key):
+        with self._db_lock:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def items(self):
+        with self._db_lock:
+            rows = self.db.execute(
+                'SELECT key, data FROM responses ORDER BY key').fetchall()
+        for key, data in rows:
+            try:
+                yield key, CacheRecord.loads(bytes(data))
+            except CacheRecordError:
+                continue
+
+    def entries(self):
+        with self._db_lock:
+            return self.db.execute(
+                'SELECT key, size, accessed FROM responses').fetchall()
+
+    def expired(self, timestamp):
+        with self._db_lock:
+            rows = self.db.execute(
+                'SELECT key FROM responses WHERE timestamp < ?',
+                (timestamp,)).fetchall()
+        return [key for key, in rows]
+
+    def invalidate(self, prefix):
+        if not prefix:
+            where, params = '', ()
+        else:
+            # express the prefix match as key range, so that it uses the index
+            prefix_end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            where, params = ' WHERE key >= ? AND key < ?', (prefix, prefix_end)
+        with self._db_lock:
+            cursor = self.db.execute('DELETE FROM responses' + where, params)
+        return cursor.rowcount
+
+    def stats(self):
+        with self._db_lock:
+            count, size = self.db.execute(
+                'SELECT count, size FROM stats').fetchone()
+        return count, size
+
+    def evict(self, max_size=None, max_entries=None):
+        max_size = self.max_size if max_size is None else max_size
+        max_entries = self.max_entries if max_entries is None else max_entries
+
+        def over_budget(count, size):
+            return ((max_size is not None and size > max_size) or
+                    (max_entries is not None and count > max_entries))
+
+        with self._db_lock:
+            # (most of the time the store is within its budget,
+            # which can be found out without locking the database)
+            if not over_budget(*self.stats()):
+                return 0, 0
+
+            # the records are chosen and deleted in a single transaction,
+            # so that other processes cannot change them in the meantime
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                count, size = self.stats()
+
+                # walk the records from least recently used, and find out
+                # which of them must go to fit within the budget
+                evicted_keys = []
+                evicted_size = 0
+                if over_budget(count, size):
+                    cursor = self.db.execute(
+                        'SELECT key, size FROM responses '
+                        'ORDER BY accessed, key')
+                    for key, entry_size in cursor:
+                        if not over_budget(count, size):
+                            break
+                        count -= 1
+                        size -= entry_size
+                        evicted_keys.append(key)
+                        evicted_size += entry_size
+                    cursor.close()
+
+                self.db.executemany('DELETE FROM responses WHERE key = ?',
+                                    [(key,) for key in evicted_keys])
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        return len(evicted_keys), evicted_size
+
+    def compact(self):
+        with self._db_lock:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.db.execute('VACUUM')
+
+    def disk_usage(self):
+        total = 0
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                total += os.stat(str(self.path) + suffix).st_size
+            except OSError:
+                pass
+        return total
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
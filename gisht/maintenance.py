@@ -0,0 +1,108 @@
+"""
+Maintenance of the application's local data.
+"""
+from __future__ import print_function
+
+from datetime import datetime
+import os
+import time
+
+from gisht import GIST_OBJECTS_DIR, GISTS_DIR, logger
+from gisht.data import CloneStrategy
+from gisht.gists.index import get_gist_index, rebuild_gist_index
+from gisht.gists.objects import repack_object_store, share_gist_objects
+from gisht.github import CACHE_RETENTION, get_cache_store
+
+
+__all__ = ['collect_cache_garbage', 'rebuild_index', 'repack_gists']
+
+
+def collect_cache_garbage():
+    """Purge stale responses from the GitHub response cache,
+    evict the least recently used ones if it's over budget, and compact it.
+    """
+    store = get_cache_store()
+    disk_usage_before = store.disk_usage()
+
+    retention_start = datetime.now() - CACHE_RETENTION
+    expired_keys = store.expired(time.mktime(retention_start.timetuple()))
+    for key in expired_keys:
+        store.delete(key)
+    logger.debug("purged %s expired response(s) from the cache",
+                 len(expired_keys))
+
+    evicted_count, _ = store.evict()
+    logger.debug("evicted %s response(s) to fit the cache budget",
+                 evicted_count)
+
+    # files for locking the cached responses are left behind otherwise
+    lock_count = store.purge_locks(CACHE_RETENTION)
+    logger.debug("removed %s unused lock file(s) of the cache", lock_count)
+
+    store.compact()
+    disk_usage_after = store.disk_usage()
+
+    count, size = store.stats()
+    print("Removed %s cached response(s), reclaimed %s." % (
+        len(expired_keys) + evicted_count,
+        format_size(max(0, disk_usage_before - disk_usage_after))))
+    print("Cache now holds %s response(s) (%s)." % (count, format_size(size)))
+
+
+def rebuild_index():
+    """Rebuild the index of downloaded gists from their repositories."""
+    count = rebuild_gist_index()
+    print("Indexed %s downloaded gist(s)." % count)
+
+
+def repack_gists():
+    """Move the objects of downloaded gists' repositories
+    to the shared object store, so that each is only stored once.
+    """
+    disk_usage_before = _disk_usage(GISTS_DIR) + _disk_usage(GIST_OBJECTS_DIR)
+
+    # full clones go first, so that the shallow ones can then drop
+    # the objects which the former have added to the store
+    repos = {}
+    for entry in get_gist_index().entries.values():
+        gist_dir = GISTS_DIR / entry['id']
+        if (gist_dir / '.git').is_dir():
+            repos[gist_dir] = CloneStrategy(
+                entry.get('clone', CloneStrategy.FULL.value))
+
+    shared_count = 0
+    for gist_dir, strategy in sorted(
+            repos.items(), key=lambda item: item[1] != CloneStrategy.FULL):
+        if share_gist_objects(gist_dir, strategy):
+            shared_count += 1
+    repack_object_store()
+
+    disk_usage_after = _disk_usage(GISTS_DIR) + _disk_usage(GIST_OBJECTS_DIR)
+    print("Repacked %s gist repositories, reclaimed %s." % (
+        shared_count,
+        format_size(max(0, disk_usage_before - disk_usage_after))))
+
+
+# Utility functions
+
+def format_size(size):
+    """Format given size in bytes as a human-readable string."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'GiB'
+    return ("%d %s" if unit == 'B' else "%.1f %s") % (size, unit)
+
+
+def _disk_usage(path):
+    """Return the total size of the files inside given directory."""
+    size = 0
+    for dirpath, _, filenames in os.walk(str(path)):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
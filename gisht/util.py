@@ -1,19 +1,25 @@
 """
 Module with utility functions used throughout the code.
 """
+import atexit
+from contextlib import contextmanager
+import errno
+import fcntl
 import logging
 import os
 from pathlib import Path
+import subprocess
 import sys
-
-import envoy
+import threading
+import time
 
 from gisht import logger
 
 
 __all__ = [
     'ensure_path', 'path_vector',
-    'run', 'join',
+    'file_lock', 'hold_file_lock', 'remove_lock_file', 'LockTimeout',
+    'detach', 'detach_pending', 'run', 'ProcessResult', 'join',
     'error', 'fatal',
 ]
 
@@ -53,26 +59,349 @@ def path_vector(from_, to):
     return Path(*([os.path.pardir] * pardir_count)) / target_wrt_prefix
 
 
+# File locks
+
+@contextmanager
+def file_lock(path, shared=False, timeout=None):
+    """Context manager that holds an advisory lock on given file
+    (which is created if necessary) for the duration of the ``with`` block.
+
+    :param shared: Whether to acquire a shared lock rather than exclusive one
+    :param timeout: Maximum time to wait for the lock (in seconds),
+                    or None to wait indefinitely
+
+    :raise: :class:`LockTimeout` if the lock couldn't be acquired in time
+    """
+    path = Path(path)
+    ensure_path(path.parent)
+
+    while True:
+        with path.open('a') as f:
+            _flock(f.fileno(), path, shared, timeout)
+            if not _same_file(f.fileno(), path):
+                continue  # removed by remove_lock_file() in the meantime
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            return
+
+
+def hold_file_lock(path, shared=False, timeout=None):
+    """Acquire an advisory lock on given file (which is created
+    if necessary) that's held until the process exits.
+
+    The lock is released when the process ``exec``-s into another program,
+    too, so that neither the program nor its children inherit it.
+
+    :param shared: Whether to acquire a shared lock rather than exclusive one
+    :param timeout: Maximum time to wait for the lock (in seconds),
+                    or None to wait indefinitely
+
+    :return: File descriptor that holds the lock
+    :raise: :class:`LockTimeout` if the lock couldn't be acquired in time
+    """
+    path = Path(path)
+    ensure_path(path.parent)
+
+    fd = os.open(str(path), os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        _flock(fd, path, shared, timeout)
+    except Exception:
+        os.close(fd)
+        raise
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fd
+
+
+def remove_lock_file(path):
+    """Remove given lock file, unless someone is holding a lock on it.
+
+    :return: Whether the file has been removed
+    """
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        # (whoever is waiting for this lock will notice that
+        # the file is gone once they get it, and create a new one)
+        os.unlink(str(path))
+        return True
+    finally:
+        os.close(fd)
+
+
+def _same_file(fd, path):
+    """Check whether given file descriptor refers to the file at given path.
+    """
+    try:
+        stat = os.stat(str(path))
+    except OSError:
+        return False
+    fd_stat = os.fstat(fd)
+    return (stat.st_dev, stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino)
+
+
+def _flock(fd, path, shared, timeout):
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if timeout is None:
+        fcntl.flock(fd, operation)
+        return
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if time.time() >= deadline:
+            raise LockTimeout("timed out waiting for lock on %s" % path)
+        time.sleep(LOCK_POLL_INTERVAL)
+
+#: How often (in seconds) to check if the file lock has been released.
+LOCK_POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    """Exception raised when a file lock couldn't be acquired in time."""
+
+
 # Processes
 
-def run(cmd, *args, **kwargs):
-    """Wrapper around ``envoy.run`` that ensures the passed command string
-    is NOT Unicode string, but a plain buffer of bytes.
+def detach(func, *args, **kwargs):
+    """Call given function in a detached background process.
+
+    The calling process continues immediately. The background one is
+    a grandchild that belongs to a new session, so it is never left
+    as a zombie even if the caller ``exec``-s into something else.
 
-    This is necessary to fix some Envoy's command parsing malfeasances.
+    Forking a process while other threads are running could deadlock
+    the child on locks that they held at the time. In that case,
+    the call is postponed until :func:`detach_pending` is invoked
+    once the other threads have finished, or until the process exits.
+
+    :param log_file: File to append the output of the background process to
     """
-    return envoy.run(bytes(cmd), *args, **kwargs)
+    if threading.active_count() > 1:
+        _pending_detached_calls.append((func, args, kwargs))
+        return
+
+    log_file = str(kwargs.pop('log_file', os.devnull))
+
+    # flush the standard streams so their buffers aren't output twice
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    exitcode = 1
+    try:
+        os.setsid()
+        if os.fork():
+            exitcode = 0
+            return
+
+        ensure_path(Path(log_file).parent)
+        with open(os.devnull, 'rb') as devnull:
+            os.dup2(devnull.fileno(), sys.stdin.fileno())
+        with open(log_file, 'ab') as log:
+            os.dup2(log.fileno(), sys.stdout.fileno())
+            os.dup2(log.fileno(), sys.stderr.fileno())
+
+        func(*args, **kwargs)
+        exitcode = 0
+    except SystemExit as e:
+        exitcode = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        logger.exception("background process %s failed", os.getpid())
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exitcode)
+
+
+def detach_pending(wait=False):
+    """Make the calls to :func:`detach` that have been postponed
+    because other threads were running, unless they still are.
+
+    :param wait: Whether to make the calls in the current process
+                 if other threads are still running, rather than
+                 postpone them further (e.g. because it's about to exit)
+    """
+    if threading.active_count() > 1 and not wait:
+        return
+    while _pending_detached_calls:
+        func, args, kwargs = _pending_detached_calls.pop(0)
+        if threading.active_count() == 1:
+            detach(func, *args, **kwargs)
+            continue
+        kwargs.pop('log_file', None)
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("postponed call to %r failed", func)
+
+#: Calls to :func:`detach` that have been postponed until there are
+#: no other threads running.
+_pending_detached_calls = []
+
+# (the calls that are still pending at exit mustn't be lost)
+atexit.register(detach_pending, wait=True)
+
+
+def run(argv, cwd=None, timeout=None, forward_output=False):
+    """Run a command and wait for it to finish.
+
+    The output of the command is read as it's produced, but only its tail
+    (up to :data:`MAX_OUTPUT_SIZE` bytes of every stream) is retained.
+    If the calling process is interrupted while waiting (e.g. by Ctrl+C),
+    the command is terminated as well.
+
+    :param argv: Command to run, as a list of program name and arguments
+    :param cwd: Working directory for the command
+    :param timeout: Maximum time (in seconds) that the command may take
+                    before it's terminated, or None for no limit
+    :param forward_output: Whether to also pass the output of the command
+                           to our own standard streams as soon as it arrives
+
+    :return: :class:`ProcessResult`
+    """
+    argv = [str(arg) for arg in argv]
+    logger.debug("running command: %s", ' '.join(argv))
+
+    with open(os.devnull, 'rb') as devnull:
+        process = subprocess.Popen(argv, cwd=None if cwd is None else str(cwd),
+                                   stdin=devnull, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True)
+    result = ProcessResult(argv, forwarded=forward_output)
+
+    readers = [
+        threading.Thread(target=_read_output, args=(
+            process.stdout, result._std_out,
+            sys.stdout if forward_output else None)),
+        threading.Thread(target=_read_output, args=(
+            process.stderr, result._std_err,
+            sys.stderr if forward_output else None)),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        # the readers finish once the command closes its output,
+        # which normally means it has exited
+        for reader in readers:
+            while reader.is_alive():
+                if deadline is not None and time.time() >= deadline:
+                    logger.warning("command timed out after %ss: %s",
+                                   timeout, ' '.join(argv))
+                    result.timed_out = True
+                    _terminate(process)
+                    deadline = None
+                reader.join(RUN_POLL_INTERVAL)
+        process.wait()
+    except BaseException:
+        _terminate(process)
+        raise
+
+    result.status_code = process.returncode
+    return result
+
+#: Maximum size (in bytes) of the output of every standard stream
+#: that's retained from a command ran by :func:`run`.
+MAX_OUTPUT_SIZE = 64 * 1024
+
+#: How often (in seconds) to check whether a command has timed out.
+RUN_POLL_INTERVAL = 0.05
+
+#: How long (in seconds) to wait for a terminated command to exit
+#: before killing it.
+TERMINATE_GRACE_PERIOD = 5
+
+
+class ProcessResult(object):
+    """Result of a command ran by :func:`run`."""
+
+    def __init__(self, argv, forwarded=False):
+        self.argv = argv
+        self.status_code = None
+        self.timed_out = False
+        self.forwarded = forwarded
+        self._std_out = bytearray()
+        self._std_err = bytearray()
+
+    @property
+    def std_out(self):
+        """The (tail of) command's standard output, as text."""
+        return self._std_out.decode('utf-8', 'replace')
+
+    @property
+    def std_err(self):
+        """The (tail of) command's standard error output, as text."""
+        return self._std_err.decode('utf-8', 'replace')
+
+
+def _read_output(pipe, buffer, forward_to=None):
+    """Read the output of a command from given pipe, until it's closed.
+
+    :param buffer: :class:`bytearray` to keep the tail of the output in
+    :param forward_to: Optional stream to pass the output to
+    """
+    forward_to = getattr(forward_to, 'buffer', forward_to)  # Python 3
+    try:
+        for chunk in iter(lambda: os.read(pipe.fileno(), 4096), b''):
+            buffer.extend(chunk)
+            if len(buffer) > MAX_OUTPUT_SIZE:
+                del buffer[:-MAX_OUTPUT_SIZE]
+            if forward_to is not None:
+                forward_to.write(chunk)
+                forward_to.flush()
+    finally:
+        pipe.close()
+
+
+def _terminate(process):
+    """Terminate given process, or kill it if it doesn't exit in time."""
+    if process.poll() is not None:
+        return
+    process.terminate()
+    deadline = time.time() + TERMINATE_GRACE_PERIOD
+    while process.poll() is None:
+        if time.time() >= deadline:
+            process.kill()
+            process.wait()
+            break
+        time.sleep(RUN_POLL_INTERVAL)
 
 
 def join(process):
     """Join the process, i.e. pipe its output to our own standard stream
     and relay its exit code back to the system.
 
-    :param process: envoy's process result object
+    :param process: :class:`ProcessResult` of the command
     """
-    sys.stdout.write(process.std_out)
-    sys.stderr.write(process.std_err)
-    raise SystemExit(process.status_code)
+    if not process.forwarded:
+        sys.stdout.write(process.std_out)
+        sys.stderr.write(process.std_err)
+
+    exitcode = process.status_code
+    if exitcode < 0:
+        exitcode = 128 - exitcode  # killed by a signal, like in the shell
+    raise SystemExit(exitcode)
 
 
 # Error handling
@@ -2,13 +2,14 @@
 Tests for command-line handling code.
 """
 import argparse
+from datetime import timedelta
 import sys
 
 from taipan.testing import before, expectedFailure, skipIf, skipUnless
 
 import gisht.args as __unit__
 from gisht.args.parser import LogLevelAction
-from gisht.data import GistCommand
+from gisht.data import CloneStrategy, GistCommand, MaintenanceCommand
 from tests import TestCase
 
 
@@ -107,6 +108,82 @@ class ParseArgv(TestCase):
         quiet_level = self._invoke('-q', self.GIST).log_level
         self.assertGreater(quiet_level, self.DEFAULT_LOG_LEVEL)
 
+    def test_clone__default(self):
+        self.assertIsNone(self._invoke(self.GIST).clone)
+
+    def test_clone__strategy(self):
+        args = self._invoke('--clone', 'sparse', self.GIST)
+        self.assertEquals(CloneStrategy.SPARSE, args.clone)
+
+    def test_clone__invalid(self):
+        with self.assertExit(2) as r:
+            self._invoke('--clone', 'deep', self.GIST)
+        self.assertIn("invalid clone strategy", r.stderr)
+
+    def test_max_age(self):
+        args = self._invoke('--max-age', '12h', self.GIST)
+        self.assertEquals(timedelta(hours=12), args.max_age)
+
+    def test_max_age__seconds(self):
+        args = self._invoke('--max-age', '90', self.GIST)
+        self.assertEquals(timedelta(seconds=90), args.max_age)
+
+    def test_max_age__invalid(self):
+        with self.assertExit(2) as r:
+            self._invoke('--max-age', 'soon', self.GIST)
+        self.assertIn("invalid duration", r.stderr)
+
+    def test_background_update__default(self):
+        self.assertTrue(self._invoke(self.GIST).background_update)
+
+    def test_no_background_update(self):
+        args = self._invoke('--no-background-update', self.GIST)
+        self.assertFalse(args.background_update)
+
+    def test_maintenance__cache_gc(self):
+        args = self._invoke('--cache-gc')
+        self.assertEquals(MaintenanceCommand.CACHE_GC, args.maintenance)
+        self.assertIsNone(args.gist)
+
+    def test_maintenance__reindex(self):
+        args = self._invoke('--reindex')
+        self.assertEquals(MaintenanceCommand.REINDEX, args.maintenance)
+
+    def test_maintenance__sync(self):
+        args = self._invoke('--sync', 'Example', '-j', '8')
+        self.assertEquals(MaintenanceCommand.SYNC, args.maintenance)
+        self.assertEquals('Example', args.maintenance_arg)
+        self.assertEquals(8, args.jobs)
+
+    def test_maintenance__sync__invalid_jobs(self):
+        with self.assertExit(2) as r:
+            self._invoke('--sync', 'Example', '-j', '0')
+        self.assertIn("expected a positive number", r.stderr)
+
+    def test_maintenance__update_all(self):
+        args = self._invoke('--update-all', '--max-age', '1h')
+        self.assertEquals(MaintenanceCommand.UPDATE_ALL, args.maintenance)
+        self.assertEquals(timedelta(hours=1), args.max_age)
+
+    def test_maintenance__install(self):
+        args = self._invoke('--install', 'gists.txt')
+        self.assertEquals(MaintenanceCommand.INSTALL, args.maintenance)
+        self.assertEquals('gists.txt', args.maintenance_arg)
+
+    def test_maintenance__export_bundle(self):
+        args = self._invoke('--export-bundle', 'gists.tar.gz',
+                            '--only', 'Example/*', '--only', 'Other/foo')
+        self.assertEquals(MaintenanceCommand.EXPORT_BUNDLE, args.maintenance)
+        self.assertEquals('gists.tar.gz', args.maintenance_arg)
+        self.assertEquals(['Example/*', 'Other/foo'], args.only)
+
+    def test_maintenance__with_gist(self):
+        with self.assertExit(2) as r:
+            self._invoke('--cache-gc', self.GIST)
+
+        self.assertIn("usage", r.stderr)
+        self.assertIn('--cache-gc', r.stderr)
+
     # TODO(xion): add more tests for real argument sets
 
     def _invoke(self, *args):
@@ -129,3 +206,7 @@ class CreateArgvParser(TestCase):
         self.assertNotIn("-h", self.result.usage)
         self.assertNotIn("--help", self.result.usage)
         self.assertNotIn("--version", self.result.usage)
+
+    def test_usage__omits_maintenance(self):
+        self.assertNotIn("--sync", self.result.usage)
+        self.assertNotIn("--jobs", self.result.usage)
@@ -0,0 +1,164 @@
+"""
+Tests for the extensions to third party libraries.
+"""
+import shutil
+import tempfile
+
+import mock
+import responses
+from taipan.testing import before, after, TestCase
+
+import gisht.ext as __unit__
+from gisht.httpcache import CacheRecord
+
+
+class CachedHammock(TestCase):
+    URL = 'http://example.com'
+    PATH = 'foo'
+
+    ETAG = '"abcdef"'
+    BODY = 'cached body'
+
+    @before
+    def create_cache_dir(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    @after
+    def delete_cache_dir(self):
+        shutil.rmtree(self.cache_dir)
+
+    @before
+    def activate_responses(self):
+        responses.mock.__enter__()
+
+    @after
+    def deactivate_responses(self):
+        responses.mock.__exit__()
+
+    def test_hit(self):
+        self._stub_response(body=self.BODY)
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        response = self._hammock().GET(self.PATH)
+
+        self.assertIsInstance(response, CacheRecord)
+        self.assertEquals(self.BODY, response.text)
+        self.assertEmpty(responses.calls)
+
+    def test_revalidation__not_modified(self):
+        self._stub_response(body=self.BODY, headers={'ETag': self.ETAG})
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        self._stub_response(status=304)
+        response = self._hammock(expired=True).GET(self.PATH)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(self.BODY, response.text)
+        self.assertEquals(
+            self.ETAG, responses.calls[0].request.headers['If-None-Match'])
+
+    def test_revalidation__modified(self):
+        self._stub_response(body=self.BODY, headers={'ETag': self.ETAG})
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        self._stub_response(body='new body', headers={'ETag': '"123456"'})
+        response = self._hammock(expired=True).GET(self.PATH)
+
+        self.assertEquals('new body', response.text)
+
+    def test_revalidation__no_validators(self):
+        self._stub_response(body=self.BODY)
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        self._stub_response(body=self.BODY)
+        self._hammock(expired=True).GET(self.PATH)
+
+        self.assertNotIn('If-None-Match', responses.calls[0].request.headers)
+
+    def test_cache_key__query_params(self):
+        self._stub_response(body='page 1')
+        self._stub_response(body='page 2')
+        hammock = self._hammock()
+
+        first_page = hammock.GET(self.PATH, params={'page': 1})
+        second_page = hammock.GET(self.PATH, params={'page': 2})
+
+        self.assertEquals('page 1', first_page.text)
+        self.assertEquals('page 2', second_page.text)
+
+    def test_server_error__not_cached(self):
+        self._stub_response(status=502)
+        self._stub_response(body=self.BODY)
+        hammock = self._hammock()
+
+        self.assertEquals(502, hammock.GET(self.PATH).status_code)
+        response = hammock.GET(self.PATH)
+
+        self.assertEquals(self.BODY, response.text)
+        self.assertEquals(2, len(responses.calls))
+
+    def test_server_error__cached_response_kept(self):
+        self._stub_response(body=self.BODY)
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        self._stub_response(status=502)
+        response = self._hammock(expired=True).GET(self.PATH)
+        self.assertEquals(self.BODY, response.text)
+
+        responses.reset()
+        response = self._hammock().GET(self.PATH)
+        self.assertEquals(self.BODY, response.text)
+        self.assertEmpty(responses.calls)
+
+    @mock.patch.object(__unit__, 'detach')
+    def test_stale__within_grace_period(self, mock_detach):
+        self._stub_response(body=self.BODY)
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        response = self._hammock(expired=True, stale_ttl=1).GET(self.PATH)
+
+        self.assertEquals(self.BODY, response.text)
+        self.assertEmpty(responses.calls)
+        self.assertEquals(1, mock_detach.call_count)
+
+    @mock.patch.object(__unit__, 'detach')
+    def test_stale__past_grace_period(self, mock_detach):
+        self._stub_response(body=self.BODY)
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        self._stub_response(body='new body')
+        response = self._hammock(expired=True, stale_ttl=0).GET(self.PATH)
+
+        self.assertEquals('new body', response.text)
+        self.assertFalse(mock_detach.called)
+
+    def test_stale__past_grace_period__offline(self):
+        self._stub_response(body=self.BODY)
+        self._hammock().GET(self.PATH)
+
+        responses.reset()
+        self._stub_response(body=__unit__.requests.ConnectionError())
+        hammock = self._hammock(expired=True, stale_ttl=0)
+        with mock.patch.object(hammock, '_on_cache_miss') as mock_on_miss:
+            response = hammock.GET(self.PATH)
+
+        self.assertEquals(self.BODY, response.text)
+        self.assertFalse(mock_on_miss.called)
+
+    # Utility functions
+
+    def _hammock(self, expired=False, stale_ttl=0):
+        ttl = __unit__.timedelta(0 if expired else 1)
+        return __unit__.CachedHammock(
+            self.URL, cache_dir=self.cache_dir, cache_ttl=ttl,
+            cache_stale_ttl=__unit__.timedelta(stale_ttl))
+
+    def _stub_response(self, **kwargs):
+        responses.add(responses.GET, self.URL + '/' + self.PATH, **kwargs)
@@ -0,0 +1,102 @@
+"""
+Tests for downloading many gists at once.
+"""
+import mock
+from taipan.testing import TestCase
+
+import gisht.gists.bulk as __unit__
+
+
+class ListOwnerGists(TestCase):
+    OWNER = 'JohnDoe'
+
+    @mock.patch.object(__unit__, 'iter_gists')
+    def test_duplicate_names(self, mock_iter_gists):
+        mock_iter_gists.return_value = iter([
+            {'id': '1', 'files': {'foo': {}}},
+            {'id': '2', 'files': {'bar': {}, 'foo': {}}},
+            {'id': '3', 'files': {'foo': {}, 'zzz': {}}},
+        ])
+        gists = __unit__.list_owner_gists(self.OWNER)
+
+        self.assertEquals(['JohnDoe/foo', 'JohnDoe/bar'], list(gists))
+        self.assertEquals('1', gists['JohnDoe/foo']['id'])
+
+
+@mock.patch.object(__unit__, 'install_gist')
+@mock.patch.object(__unit__, 'update_gist')
+class SyncGist(TestCase):
+    GIST = 'JohnDoe/foo'
+    GIST_JSON = {'id': '42', 'updated_at': '2017-01-01T00:00:00Z',
+                 'files': {'foo': {}}}
+
+    @mock.patch.object(__unit__, 'gist_exists', return_value=False)
+    def test_new(self, _, mock_update_gist, mock_install_gist):
+        self.assertEquals(__unit__.DOWNLOADED, self._sync_gist({}))
+        mock_install_gist.assert_called_once_with(
+            self.GIST, self.GIST_JSON, progress=False)
+        self.assertFalse(mock_update_gist.called)
+
+    @mock.patch.object(__unit__, 'gist_exists', return_value=True)
+    def test_unchanged(self, _, mock_update_gist, __):
+        entry = {'id': '42', 'updated_at': self.GIST_JSON['updated_at']}
+        self.assertEquals(__unit__.UNCHANGED, self._sync_gist(entry))
+        self.assertFalse(mock_update_gist.called)
+
+    @mock.patch.object(__unit__, 'gist_exists', return_value=True)
+    def test_changed(self, _, mock_update_gist, __):
+        entry = {'id': '42', 'updated_at': '2016-01-01T00:00:00Z'}
+        self._sync_gist(entry)
+        mock_update_gist.assert_called_once_with(self.GIST, required=False)
+
+    @mock.patch.object(__unit__, 'gist_exists', return_value=True)
+    def test_different_id(self, _, mock_update_gist, __):
+        entry = {'id': '13', 'updated_at': '2016-01-01T00:00:00Z'}
+        with mock.patch.object(__unit__, 'get_gist_index') as mock_index:
+            mock_index.return_value.get.return_value = entry
+            self.assertEquals(__unit__.FAILED,
+                              __unit__.sync_gist(self.GIST, self.GIST_JSON))
+            self.assertFalse(mock_index.return_value.put.called)
+        self.assertFalse(mock_update_gist.called)
+
+    def _sync_gist(self, entry):
+        with mock.patch.object(__unit__, 'get_gist_index') as mock_index:
+            mock_index.return_value.get.return_value = entry
+            return __unit__.sync_gist(self.GIST, self.GIST_JSON)
+
+
+@mock.patch.object(__unit__, 'gist_exists', return_value=True)
+@mock.patch.object(__unit__, 'update_gist', return_value=True)
+class UpdateAllGists(TestCase):
+    FRESH_GIST = 'JohnDoe/foo'
+    STALE_GIST = 'JohnDoe/bar'
+
+    @mock.patch.object(__unit__, 'gist_fresh')
+    def test_only_stale(self, mock_gist_fresh, mock_update_gist, _):
+        mock_gist_fresh.side_effect = lambda gist: gist == self.FRESH_GIST
+        with mock.patch.object(__unit__, 'get_gist_index') as mock_index:
+            mock_index.return_value.refs.return_value = [self.FRESH_GIST,
+                                                         self.STALE_GIST]
+            mock_index.return_value.get.return_value = {}
+            self.assertEquals(0, __unit__.update_all_gists())
+
+        mock_update_gist.assert_called_once_with(self.STALE_GIST,
+                                                 required=False)
+
+
+class ProcessGists(TestCase):
+    GISTS = ['JohnDoe/foo', 'JohnDoe/bar', 'JohnDoe/baz']
+
+    def test_results(self):
+        def func(gist):
+            if gist.endswith('foo'):
+                raise SystemExit(1)
+            if gist.endswith('bar'):
+                raise ValueError()
+            return __unit__.UPDATED
+
+        with mock.patch.object(__unit__, 'get_gist_index'):
+            results = __unit__.process_gists(self.GISTS, func)
+
+        self.assertEquals(2, results[__unit__.FAILED])
+        self.assertEquals(1, results[__unit__.UPDATED])
@@ -0,0 +1,189 @@
+"""
+Tests for exporting and importing bundles of gists.
+"""
+import io
+import json
+import os
+from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+import time
+
+import mock
+from taipan.testing import after, before, TestCase
+
+from gisht import flags
+from gisht.gists.index import GistIndex
+import gisht.github
+from gisht.httpcache import CacheRecord, SqliteCacheStore
+import gisht.gists.bundle as __unit__
+
+
+class CheckMember(TestCase):
+
+    def test_gist_file(self):
+        __unit__.check_member(self._member('gists/42/foo'))
+
+    def test_link(self):
+        member = self._member('bin/JohnDoe/foo', type=tarfile.SYMTYPE,
+                              linkname='../../gists/42/foo')
+        __unit__.check_member(member)
+
+    def test_outside(self):
+        for name in ('/etc/passwd', '../foo', 'gists/../../foo', 'foo'):
+            with self.assertRaises(__unit__.BundleError):
+                __unit__.check_member(self._member(name))
+
+    def test_link_outside(self):
+        for linkname in ('/etc/passwd', '../../../.bashrc'):
+            member = self._member('bin/JohnDoe/foo', type=tarfile.SYMTYPE,
+                                  linkname=linkname)
+            with self.assertRaises(__unit__.BundleError):
+                __unit__.check_member(member)
+
+    def test_device(self):
+        member = self._member('gists/42/foo', type=tarfile.CHRTYPE)
+        with self.assertRaises(__unit__.BundleError):
+            __unit__.check_member(member)
+
+    def _member(self, name, type=tarfile.REGTYPE, linkname=''):
+        member = tarfile.TarInfo(name)
+        member.type = type
+        member.linkname = linkname
+        return member
+
+
+class ReadMetadata(TestCase):
+    GISTS = {'JohnDoe/foo': {'id': '42'}}
+
+    def test_cache(self):
+        cache = {'gists/42/abc': 'a' * 40}
+        metadata = self._read_metadata(gists=self.GISTS, cache=cache)
+        self.assertEquals(cache, metadata['cache'])
+
+    def test_cache__invalid(self):
+        for cache in ({'gists/42': '../../foo'},
+                      {'gists/13': 'a' * 40},
+                      {'gists/42/../../foo': 'a' * 40}):
+            with self.assertRaises(__unit__.BundleError):
+                self._read_metadata(gists=self.GISTS, cache=cache)
+
+    def _read_metadata(self, **metadata):
+        metadata.setdefault('version', __unit__.BUNDLE_VERSION)
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            __unit__.add_metadata(tar, metadata)
+        data.seek(0)
+        with tarfile.open(fileobj=data) as tar:
+            return __unit__.read_metadata(tar)
+
+
+class ExportImport(TestCase):
+    GIST = 'JohnDoe/foo'
+    GIST_ID = '42'
+    REVISION = 'c5818e5fa3a45f2dd95bbe5bb61a735e1c7ef082'
+
+    @before
+    def create_temp_dir(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.bundle = self.temp_dir / 'gists.tar.gz'
+        self.cache_stores = []
+
+    @after
+    def delete_temp_dir(self):
+        for cache_store in self.cache_stores:
+            cache_store.close()
+        shutil.rmtree(str(self.temp_dir))
+
+    def test_roundtrip(self):
+        source = self._app_dir('source')
+        with self._patch(source):
+            self._add_gist(source)
+            source['cache'].put('gists/42', CacheRecord(
+                'https://api.github.com/gists/42', 200, content=b'{}'))
+            source['cache'].put('gists/42/' + self.REVISION, CacheRecord(
+                'https://api.github.com/gists/42/' + self.REVISION, 200,
+                content=b'{"history": []}'))
+            source['cache'].put('gists/13', CacheRecord(
+                'https://api.github.com/gists/13', 200, content=b'{}'))
+
+            self.assertEquals(os.EX_OK, __unit__.export_bundle(self.bundle))
+
+        target = self._app_dir('target')
+        with self._patch(target):
+            self.assertEquals(os.EX_OK, __unit__.import_bundle(self.bundle))
+
+        with open(str(target['bin'] / self.GIST)) as f:
+            self.assertEquals("echo foo\n", f.read())
+        self.assertEquals(self.GIST_ID, target['index'].get(self.GIST)['id'])
+        self.assertEquals(b'{}', target['cache'].get('gists/42').content)
+        self.assertEquals(
+            b'{"history": []}',
+            target['cache'].get('gists/42/' + self.REVISION).content)
+        self.assertIsNone(target['cache'].get('gists/13'))
+        self.assertEquals([], [p for p in os.listdir(str(target['app']))
+                               if p.startswith('.import-')])
+
+    def test_roundtrip__local(self):
+        gist_json = {'id': self.GIST_ID, 'files': {'foo': {}}}
+        source = self._app_dir('source')
+        with self._patch(source):
+            self._add_gist(source)
+            source['cache'].put('gists/42', CacheRecord(
+                'https://api.github.com/gists/42', 200,
+                content=json.dumps(gist_json).encode('utf-8'),
+                timestamp=time.time() - 30 * 24 * 60 * 60))
+            __unit__.export_bundle(self.bundle)
+
+        target = self._app_dir('target')
+        with self._patch(target):
+            __unit__.import_bundle(self.bundle)
+
+        # the air-gapped host can only use the responses from the bundle,
+        # no matter how old they are
+        with mock.patch.multiple(gisht.github,
+                                 get_cache_store=lambda: target['cache'],
+                                 get_rate_limiter=mock.DEFAULT), \
+                mock.patch.object(gisht.github.GitHub, '_send') as mock_send, \
+                mock.patch.object(flags, 'local', True, create=True):
+            self.assertEquals(gist_json,
+                              gisht.github.get_gist_info(self.GIST_ID))
+        self.assertFalse(mock_send.called)
+
+    def _add_gist(self, app_dir):
+        gist_dir = app_dir['gists'] / self.GIST_ID
+        os.makedirs(str(gist_dir))
+        with open(str(gist_dir / 'foo'), 'w') as f:
+            f.write("echo foo\n")
+        os.makedirs(str(app_dir['bin'] / 'JohnDoe'))
+        (app_dir['bin'] / self.GIST).symlink_to('../../gists/42/foo')
+        app_dir['index'].put(self.GIST, id=self.GIST_ID, clone='raw')
+
+    def _app_dir(self, name):
+        app_dir = self.temp_dir / name
+        os.makedirs(str(app_dir))
+        cache_store = SqliteCacheStore(app_dir / 'github.sqlite',
+                                       lock_dir=app_dir / 'locks')
+        self.cache_stores.append(cache_store)
+        return {'app': app_dir,
+                'gists': app_dir / 'gists', 'bin': app_dir / 'bin',
+                'index': GistIndex(app_dir / 'index.json'),
+                'cache': cache_store}
+
+    def _patch(self, app_dir):
+        def gist_exists(gist):
+            entry = app_dir['index'].get(gist)
+            return entry is not None and (
+                app_dir['gists'] / entry['id'] / gist.split('/')[1]).exists()
+
+        def gist_fetch_lock_file(gist_id):
+            return app_dir['app'] / 'locks' / gist_id
+
+        return mock.patch.multiple(
+            __unit__, APP_DIR=app_dir['app'],
+            GISTS_DIR=app_dir['gists'], BIN_DIR=app_dir['bin'],
+            get_gist_index=lambda: app_dir['index'],
+            get_cache_store=lambda: app_dir['cache'],
+            gist_exists=gist_exists,
+            gist_fetch_lock_file=gist_fetch_lock_file)
@@ -1,30 +1,131 @@
 """
 Tests for the functions for downloading gists and caching them locally.
 """
+from datetime import timedelta
+import time
+
 import mock
 from taipan.testing import TestCase
 
+from gisht.data import CloneStrategy
 import gisht.gists.cache as __unit__
 
 
+class EnsureGist(TestCase):
+    GIST = 'JohnDoe/foo'
+
+    @mock.patch.object(__unit__, 'download_gist')
+    @mock.patch.object(__unit__, 'install_gist')
+    @mock.patch.object(__unit__, 'gist_exists', return_value=False)
+    def test_gist_json(self, _, mock_install_gist, mock_download_gist):
+        gist_json = {'id': '42', 'files': {'foo': {}}}
+        __unit__.ensure_gist(self.GIST, gist_json=gist_json)
+
+        mock_install_gist.assert_called_once_with(self.GIST, gist_json)
+        self.assertFalse(mock_download_gist.called)
+
+    @mock.patch.object(__unit__, 'install_gist')
+    @mock.patch.object(__unit__, 'gist_exists', return_value=False)
+    def test_gist_json__local(self, _, mock_install_gist):
+        with self.assertRaises(SystemExit):
+            __unit__.ensure_gist(self.GIST, local=True, gist_json={})
+        self.assertFalse(mock_install_gist.called)
+
+
+@mock.patch.object(__unit__, 'gist_exists', return_value=True)
+@mock.patch.object(__unit__, 'update_gist')
+class EnsureGistUpdate(TestCase):
+    GIST = 'JohnDoe/foo'
+
+    @mock.patch.object(__unit__, 'gist_fresh', return_value=True)
+    def test_fresh(self, _, mock_update_gist, __):
+        __unit__.ensure_gist(self.GIST, local=None)
+        self.assertFalse(mock_update_gist.called)
+
+    @mock.patch.object(__unit__, 'detach')
+    @mock.patch.object(__unit__, 'gist_fresh', return_value=False)
+    def test_stale(self, _, mock_detach, mock_update_gist, __):
+        __unit__.ensure_gist(self.GIST, local=None)
+
+        self.assertFalse(mock_update_gist.called)
+        mock_detach.assert_called_once_with(
+            __unit__.update_gist_in_background, self.GIST,
+            log_file=mock.ANY)
+
+    @mock.patch.object(__unit__.flags, 'background_update', False,
+                       create=True)
+    @mock.patch.object(__unit__, 'detach')
+    @mock.patch.object(__unit__, 'gist_fresh', return_value=False)
+    def test_stale__no_background_update(self, _, mock_detach,
+                                         mock_update_gist, __):
+        __unit__.ensure_gist(self.GIST, local=None)
+
+        mock_update_gist.assert_called_once_with(self.GIST, required=False)
+        self.assertFalse(mock_detach.called)
+
+    @mock.patch.object(__unit__, 'gist_fresh', return_value=True)
+    def test_fetch(self, _, mock_update_gist, __):
+        __unit__.ensure_gist(self.GIST, local=False)
+        mock_update_gist.assert_called_once_with(self.GIST)
+
+    @mock.patch.object(__unit__, 'gist_fresh', return_value=True)
+    def test_fetch__gist_running(self, _, mock_update_gist, __):
+        mock_update_gist.return_value = False
+        __unit__.ensure_gist(self.GIST, local=False)  # doesn't exit
+
+    @mock.patch.object(__unit__, 'gist_fresh', return_value=False)
+    def test_local(self, _, mock_update_gist, __):
+        __unit__.ensure_gist(self.GIST, local=True)
+        self.assertFalse(mock_update_gist.called)
+
+
+class GistFresh(TestCase):
+    GIST = 'JohnDoe/foo'
+
+    def test_never_fetched(self):
+        self.assertFalse(self._gist_fresh({}))
+
+    def test_recently_fetched(self):
+        self.assertTrue(self._gist_fresh({'fetched_at': time.time() - 60}))
+
+    def test_fetched_long_ago(self):
+        fetched_at = time.time() - 2 * 24 * 60 * 60
+        self.assertFalse(self._gist_fresh({'fetched_at': fetched_at}))
+
+    @mock.patch.object(__unit__.flags, 'max_age', timedelta(0), create=True)
+    def test_max_age(self):
+        self.assertFalse(self._gist_fresh({'fetched_at': time.time() - 60}))
+
+    def test_pinned(self):
+        self.assertTrue(self._gist_fresh({'pinned': 'a' * 40}))
+
+    def _gist_fresh(self, entry):
+        with mock.patch.object(__unit__, 'get_gist_index') as mock_index:
+            mock_index.return_value.get.return_value = entry
+            return __unit__.gist_fresh(self.GIST)
+
+
 class DownloadGist(TestCase):
     GIST = 'JohnDoe/foo'
 
-    @mock.patch.object(__unit__, 'iter_gists')
-    def test_not_found__no_gists(self, mock_iter_gists):
-        mock_iter_gists.return_value = ()
+    @mock.patch.object(__unit__, 'iter_gist_pages')
+    def test_not_found__no_gists(self, mock_iter_gist_pages):
+        mock_iter_gist_pages.return_value = self._pages()
         self.assertFalse(__unit__.download_gist(self.GIST))
 
-    @mock.patch.object(__unit__, 'iter_gists')
-    def test_not_found__not_present(self, mock_iter_gists):
-        mock_iter_gists.return_value = [
+    @mock.patch.object(__unit__, 'iter_gist_pages')
+    def test_not_found__not_present(self, mock_iter_gist_pages):
+        mock_iter_gist_pages.return_value = self._pages([
             self._gist_json('foo', 'bar'),
             self._gist_json('abc', 'xyz'),
-        ]
+        ])
         self.assertFalse(__unit__.download_gist(self.GIST))
 
     # TODO(xion): write tests for the (semi-)successful cases
 
+    def _pages(self, *pages):
+        return (page for page in pages)
+
     def _gist_json(self, owner, name, **kwargs):
         # there has to be an entry in the 'files' dictionary
         # that corresponds to gist name; the actual content of it is not used
@@ -34,3 +135,223 @@ class DownloadGist(TestCase):
         result = kwargs.copy()
         result['files'] = files
         return result
+
+
+class RawGist(TestCase):
+    REVISION = 'a' * 40
+    RAW_URL = ('https://gist.githubusercontent.com/JohnDoe/42/raw/%s/foo'
+               % REVISION)
+
+    def test_revision__history(self):
+        gist_json = {'history': [{'version': self.REVISION}], 'files': {}}
+        self.assertEquals(self.REVISION, __unit__.gist_revision(gist_json))
+
+    def test_revision__raw_url(self):
+        gist_json = {'files': {'foo': {'raw_url': self.RAW_URL}}}
+        self.assertEquals(self.REVISION, __unit__.gist_revision(gist_json))
+
+    @mock.patch.object(__unit__, 'get_gist_file')
+    def test_file_content__inline(self, mock_get_gist_file):
+        gist_json = {'files': {'foo': {'content': u'echo foo',
+                                       'raw_url': self.RAW_URL}}}
+        self.assertEquals(b'echo foo',
+                          __unit__.gist_file_content(gist_json, 'foo'))
+        self.assertFalse(mock_get_gist_file.called)
+
+    @mock.patch.object(__unit__, 'get_gist_file')
+    def test_file_content__truncated(self, mock_get_gist_file):
+        gist_json = {'files': {'foo': {'content': u'echo', 'truncated': True,
+                                       'raw_url': self.RAW_URL}}}
+        __unit__.gist_file_content(gist_json, 'foo')
+        mock_get_gist_file.assert_called_once_with(self.RAW_URL)
+
+
+class CloneGistRepo(TestCase):
+    URL = 'https://gist.github.com/42.git'
+    FILENAME = 'foo'
+
+    @mock.patch.object(__unit__, 'run')
+    def test_shallow(self, mock_run):
+        mock_run.return_value.status_code = 0
+        __unit__.clone_gist_repo(self.URL, self.gist_dir, self.FILENAME,
+                                 strategy=CloneStrategy.SHALLOW)
+
+        argv = mock_run.call_args[0][0]
+        self.assertIn('--depth', argv)
+        self.assertEquals([self.URL, self.gist_dir], argv[-2:])
+
+    @mock.patch.object(__unit__, 'run')
+    def test_sparse(self, mock_run):
+        mock_run.return_value.status_code = 0
+        __unit__.clone_gist_repo(self.URL, self.gist_dir, self.FILENAME,
+                                 strategy=CloneStrategy.SPARSE)
+
+        cmds = [c[0][0] for c in mock_run.call_args_list]
+        self.assertIn('--no-checkout', cmds[0])
+        self.assertEquals(['git', 'sparse-checkout', 'set', '--no-cone',
+                           '/' + self.FILENAME], cmds[1])
+        self.assertEquals(['git', 'checkout'], cmds[-1])
+
+    def test_sparse_checkout_pattern(self):
+        pattern = __unit__.sparse_checkout_pattern
+        self.assertEquals('/foo.sh', pattern('foo.sh'))
+        self.assertEquals(r'/\#\!foo', pattern('#!foo'))
+        self.assertEquals(r'/foo\*\?\[1]', pattern('foo*?[1]'))
+        self.assertEquals(r'/foo\\bar', pattern(r'foo\bar'))
+        self.assertEquals(r'/foo bar\ \ ', pattern('foo bar  '))
+
+    @mock.patch.object(__unit__, 'join', side_effect=SystemExit)
+    @mock.patch.object(__unit__, 'run')
+    def test_failure(self, mock_run, _):
+        mock_run.return_value.status_code = 128
+        with self.assertRaises(SystemExit):
+            __unit__.clone_gist_repo(self.URL, self.gist_dir, self.FILENAME)
+
+    @property
+    def gist_dir(self):
+        return __unit__.GISTS_DIR / '42'
+
+
+@mock.patch.object(__unit__, 'get_gist_index', new=mock.Mock(
+    **{'return_value.get.return_value': {'clone': 'shallow'}}))
+@mock.patch.object(__unit__, 'get_gist_id', new=mock.Mock(return_value='42'))
+@mock.patch.object(__unit__, 'file_lock', new=mock.MagicMock())
+class UpdateGist(TestCase):
+    GIST = 'JohnDoe/foo'
+    REVISION = 'a' * 40
+
+    @mock.patch.object(__unit__, 'git_head')
+    @mock.patch.object(__unit__, 'run')
+    def test_up_to_date(self, mock_run, mock_git_head):
+        mock_git_head.return_value = self.REVISION
+        mock_run.return_value = self._git_run(
+            std_out=self.REVISION + '\tHEAD\n')
+
+        self.assertTrue(__unit__.update_gist(self.GIST))
+        mock_run.assert_called_once_with(
+            ['git', 'ls-remote', 'origin', 'HEAD'],
+            cwd=mock.ANY, timeout=mock.ANY)
+
+    @mock.patch.object(__unit__, 'git_head')
+    @mock.patch.object(__unit__, 'run')
+    def test_outdated(self, mock_run, mock_git_head):
+        mock_git_head.return_value = self.REVISION
+        mock_run.return_value = self._git_run(std_out='b' * 40 + '\tHEAD\n')
+
+        self.assertTrue(__unit__.update_gist(self.GIST))
+        cmds = [c[0][0] for c in mock_run.call_args_list]
+        self.assertEquals(['git', 'fetch', '--depth', '1', 'origin', 'HEAD'],
+                          cmds[1])
+        self.assertEquals(['git', 'reset', '--hard', 'FETCH_HEAD'], cmds[2])
+
+    @mock.patch.object(__unit__, 'git_head')
+    @mock.patch.object(__unit__, 'run')
+    def test_outdated__index_refreshed(self, mock_run, mock_git_head):
+        mock_git_head.return_value = self.REVISION
+        mock_run.side_effect = [
+            self._git_run(std_out='b' * 40 + '\tHEAD\n'),  # ls-remote
+            self._git_run(), self._git_run(),  # fetch, reset
+            self._git_run(std_out='foo\0bar baz\0'),  # ls-tree
+            self._git_run(std_out='1483228800\n'),  # log
+        ]
+
+        self.assertTrue(__unit__.update_gist(self.GIST))
+        __unit__.get_gist_index.return_value.put.assert_called_with(
+            self.GIST, revision=self.REVISION, fetched_at=mock.ANY,
+            files=['bar baz', 'foo'], updated_at='2017-01-01T00:00:00Z')
+
+    @mock.patch.object(__unit__, 'git_head')
+    @mock.patch.object(__unit__, 'run')
+    def test_failed__not_required(self, mock_run, mock_git_head):
+        mock_git_head.return_value = self.REVISION
+        mock_run.return_value = self._git_run(status_code=128)
+
+        self.assertFalse(__unit__.update_gist(self.GIST, required=False))
+
+    @mock.patch.object(__unit__, 'git_head')
+    @mock.patch.object(__unit__, 'run')
+    def test_gist_running(self, mock_run, mock_git_head):
+        mock_git_head.return_value = self.REVISION
+        mock_run.return_value = self._git_run(std_out='b' * 40 + '\tHEAD\n')
+        # the update lock is acquired, but the gist's files are locked
+        __unit__.file_lock.side_effect = [mock.MagicMock(),
+                                          __unit__.LockTimeout()]
+
+        try:
+            self.assertFalse(__unit__.update_gist(self.GIST))
+        finally:
+            __unit__.file_lock.side_effect = None
+        cmds = [c[0][0] for c in mock_run.call_args_list]
+        self.assertIn(['git', 'fetch', '--depth', '1', 'origin', 'HEAD'], cmds)
+        self.assertNotIn(['git', 'reset', '--hard', 'FETCH_HEAD'], cmds)
+
+    @mock.patch.object(__unit__, 'run')
+    def test_updated_concurrently(self, mock_run):
+        entry = {'clone': 'shallow', 'fetched_at': time.time() + 60}
+        with mock.patch.object(__unit__, 'get_gist_index') as mock_index:
+            mock_index.return_value.get.return_value = entry
+            self.assertTrue(__unit__.update_gist(self.GIST))
+        self.assertFalse(mock_run.called)
+
+    @mock.patch.object(__unit__, 'run')
+    def test_being_updated(self, mock_run):
+        __unit__.file_lock.side_effect = __unit__.LockTimeout()
+        try:
+            self.assertFalse(__unit__.update_gist(self.GIST))
+        finally:
+            __unit__.file_lock.side_effect = None
+        self.assertFalse(mock_run.called)
+
+    def _git_run(self, status_code=0, std_out=''):
+        git_run = mock.Mock(status_code=status_code)
+        git_run.std_out = std_out
+        return git_run
+
+
+@mock.patch.object(__unit__, 'get_gist_index', new=mock.Mock(
+    **{'return_value.get.return_value': {'clone': 'raw'}}))
+@mock.patch.object(__unit__, 'get_gist_id', new=mock.Mock(return_value='42'))
+@mock.patch.object(__unit__, 'file_lock', new=mock.MagicMock())
+@mock.patch.object(__unit__, 'run')
+@mock.patch.object(__unit__, 'get_gist_info')
+class UpdateRawGist(TestCase):
+    GIST = 'JohnDoe/foo'
+    REVISION = 'a' * 40
+
+    @mock.patch.object(__unit__, 'write_raw_gist')
+    @mock.patch.object(__unit__, 'local_revision')
+    def test_up_to_date(self, mock_local_revision, mock_write_raw_gist,
+                        mock_get_gist_info, mock_run):
+        mock_local_revision.return_value = self.REVISION
+        mock_get_gist_info.return_value = self._gist_json(self.REVISION)
+
+        self.assertTrue(__unit__.update_gist(self.GIST))
+        self.assertFalse(mock_write_raw_gist.called)
+        self.assertFalse(mock_run.called)
+
+    @mock.patch.object(__unit__, 'write_raw_gist')
+    @mock.patch.object(__unit__, 'local_revision')
+    def test_outdated(self, mock_local_revision, mock_write_raw_gist,
+                      mock_get_gist_info, mock_run):
+        mock_local_revision.return_value = self.REVISION
+        mock_get_gist_info.return_value = self._gist_json('b' * 40)
+
+        self.assertTrue(__unit__.update_gist(self.GIST))
+        mock_write_raw_gist.assert_called_once_with(
+            mock.ANY, 'foo', b'echo foo', 'b' * 40)
+        self.assertFalse(mock_run.called)
+
+    @mock.patch.object(__unit__.flags, 'clone', CloneStrategy.SHALLOW,
+                       create=True)
+    @mock.patch.object(__unit__, 'promote_gist')
+    def test_promoted(self, mock_promote_gist, mock_get_gist_info, _):
+        gist_json = self._gist_json(self.REVISION)
+        mock_get_gist_info.return_value = gist_json
+
+        __unit__.update_gist(self.GIST)
+        mock_promote_gist.assert_called_once_with(
+            self.GIST, gist_json, CloneStrategy.SHALLOW)
+
+    def _gist_json(self, revision):
+        return {'id': '42', 'history': [{'version': revision}],
+                'files': {'foo': {'content': u'echo foo'}}}
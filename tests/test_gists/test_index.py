@@ -0,0 +1,112 @@
+"""
+Tests for the index of downloaded gists.
+"""
+from pathlib import Path
+import shutil
+import tempfile
+
+import mock
+from taipan.testing import before, after, TestCase
+
+import gisht.gists.index as __unit__
+
+
+class _Index(TestCase):
+    """Base class for test cases that operate on the gist index."""
+    GIST = 'JohnDoe/foo.py'
+    GIST_ID = '42'
+    REVISION = 'a' * 40
+
+    @before
+    def create_app_dir(self):
+        self.app_dir = Path(tempfile.mkdtemp())
+        self.index = __unit__.GistIndex(self.app_dir / 'index.json')
+
+    @after
+    def delete_app_dir(self):
+        shutil.rmtree(str(self.app_dir))
+
+
+class GistIndex(_Index):
+
+    def test_get__missing(self):
+        self.assertFalse(self.index.exists())
+        self.assertIsNone(self.index.get(self.GIST))
+
+    def test_put_get(self):
+        self.index.put(self.GIST, id=self.GIST_ID)
+        self.assertEquals(self.GIST_ID, self.index.get(self.GIST)['id'])
+        self.assertIn(self.GIST, self.index)
+
+    def test_put__merges_fields(self):
+        self.index.put(self.GIST, id=self.GIST_ID)
+        self.index.put(self.GIST, revision=self.REVISION)
+        self.assertEquals({'id': self.GIST_ID, 'revision': self.REVISION},
+                          self.index.get(self.GIST))
+
+    def test_persistence(self):
+        self.index.put(self.GIST, id=self.GIST_ID)
+        other = __unit__.GistIndex(self.index.path)
+        self.assertEquals([self.GIST], other.refs())
+
+    def test_remove(self):
+        self.index.put(self.GIST, id=self.GIST_ID)
+        self.index.remove(self.GIST)
+        self.assertNotIn(self.GIST, self.index)
+
+    def test_load__corrupted(self):
+        with open(str(self.index.path), 'w') as f:
+            f.write('{not json')
+        self.assertEquals([], self.index.refs())
+
+
+class RebuildGistIndex(_Index):
+
+    @before
+    def create_gist(self):
+        self.gists_dir = self.app_dir / 'gists'
+        self.bin_dir = self.app_dir / 'bin'
+
+        gist_dir = self.gists_dir / self.GIST_ID
+        (gist_dir / '.git' / 'refs' / 'heads').mkdir(parents=True)
+        (gist_dir / 'foo.py').touch()
+        self._write(gist_dir / '.git' / 'HEAD', 'ref: refs/heads/master\n')
+        self._write(gist_dir / '.git' / 'refs' / 'heads' / 'master',
+                    self.REVISION + '\n')
+        self._write(gist_dir / '.git' / 'config',
+                    '[remote "origin"]\n'
+                    '\turl = https://gist.github.com/42.git\n')
+
+        owner, name = self.GIST.split('/')
+        (self.bin_dir / owner).mkdir(parents=True)
+        (self.bin_dir / owner / name).symlink_to(gist_dir / name)
+
+    def test_rebuild(self):
+        with mock.patch.multiple(__unit__, BIN_DIR=self.bin_dir,
+                                 GISTS_DIR=self.gists_dir):
+            self.assertEquals(1, __unit__.rebuild_gist_index(self.index))
+
+        entry = self.index.get(self.GIST)
+        self.assertEquals(self.GIST_ID, entry['id'])
+        self.assertEquals(['foo.py'], entry['files'])
+        self.assertEquals(self.REVISION, entry['revision'])
+        self.assertEquals('https://gist.github.com/42.git',
+                          entry['git_pull_url'])
+
+    def test_rebuild__raw(self):
+        gist_dir = self.gists_dir / self.GIST_ID
+        shutil.rmtree(str(gist_dir / '.git'))
+        self._write(gist_dir / __unit__.RAW_REVISION_FILE, self.REVISION)
+
+        with mock.patch.multiple(__unit__, BIN_DIR=self.bin_dir,
+                                 GISTS_DIR=self.gists_dir):
+            __unit__.rebuild_gist_index(self.index)
+
+        entry = self.index.get(self.GIST)
+        self.assertEquals(['foo.py'], entry['files'])
+        self.assertEquals(self.REVISION, entry['revision'])
+        self.assertEquals('raw', entry['clone'])
+
+    def _write(self, path, content):
+        with open(str(path), 'w') as f:
+            f.write(content)
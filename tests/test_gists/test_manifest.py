@@ -0,0 +1,117 @@
+"""
+Tests for installing gists from a manifest file.
+"""
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import mock
+from taipan.testing import after, before, TestCase
+
+import gisht.gists.manifest as __unit__
+
+
+REVISION = 'c5818e5fa3a45f2dd95bbe5bb61a735e1c7ef082'
+OTHER_REVISION = '6cad326836d38bd3a7ae6cad326836d38bd3a7ae'
+
+
+class _TempDir(TestCase):
+
+    @before
+    def create_temp_dir(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+
+    @after
+    def delete_temp_dir(self):
+        shutil.rmtree(str(self.temp_dir))
+
+    def _write(self, name, content):
+        path = self.temp_dir / name
+        with open(str(path), 'w') as f:
+            f.write(content)
+        return path
+
+
+class ReadManifest(_TempDir):
+
+    def test_valid(self):
+        path = self._write('gists.txt', '\n'.join([
+            "# some comment",
+            "JohnDoe/foo",
+            "",
+            "JohnDoe/bar  %s  # pinned" % REVISION,
+            "https://gist.github.com/JohnDoe/42",
+        ]))
+        entries = __unit__.read_manifest(path)
+        self.assertEquals(
+            ['JohnDoe/foo', 'JohnDoe/bar',
+             'https://gist.github.com/JohnDoe/42'], list(entries))
+        self.assertIsNone(entries['JohnDoe/foo'])
+        self.assertEquals(REVISION, entries['JohnDoe/bar'])
+
+    def test_invalid_revision(self):
+        path = self._write('gists.txt', "JohnDoe/foo master\n")
+        with self.assertRaises(ValueError) as r:
+            __unit__.read_manifest(path)
+        self.assertIn("line 1", str(r.exception))
+
+    def test_invalid_gist(self):
+        path = self._write('gists.txt', "JohnDoe/foo\nfoo\n")
+        with self.assertRaises(ValueError) as r:
+            __unit__.read_manifest(path)
+        self.assertIn("line 2", str(r.exception))
+
+
+class Lockfile(_TempDir):
+
+    def test_roundtrip(self):
+        path = __unit__.lockfile_path(self.temp_dir / 'gists.txt')
+        self.assertEquals('gists.txt.lock', path.name)
+
+        entries = {'JohnDoe/foo': {'ref': 'JohnDoe/foo', 'id': '42',
+                                   'revision': REVISION}}
+        __unit__.write_lockfile(path, entries)
+        self.assertEquals(entries, __unit__.read_lockfile(path))
+        self.assertEquals(['gists.txt.lock'], os.listdir(str(self.temp_dir)))
+
+    def test_missing(self):
+        path = self.temp_dir / 'gists.txt.lock'
+        self.assertEquals({}, __unit__.read_lockfile(path))
+
+    def test_unsupported_version(self):
+        path = self._write('gists.txt.lock', '{"version": 999, "gists": {}}')
+        self.assertEquals({}, __unit__.read_lockfile(path))
+
+
+@mock.patch.object(__unit__, 'get_gist_info')
+@mock.patch.object(__unit__, 'checkout_gist_revision', return_value=True)
+@mock.patch.object(__unit__, 'gist_exists', return_value=True)
+class InstallManifestEntry(TestCase):
+    GIST = 'JohnDoe/foo'
+    LOCKED_ENTRY = {'ref': GIST, 'id': '42', 'revision': REVISION}
+
+    def test_locked_revision_present(self, _, mock_checkout, mock_info):
+        status, entry = self._install(None, self.LOCKED_ENTRY, REVISION)
+
+        self.assertEquals(__unit__.UNCHANGED, status)
+        self.assertEquals(self.LOCKED_ENTRY, entry)
+        self.assertFalse(mock_checkout.called)
+        self.assertFalse(mock_info.called)
+
+    def test_locked_revision_missing(self, _, mock_checkout, __):
+        self._install(None, self.LOCKED_ENTRY, OTHER_REVISION)
+        mock_checkout.assert_called_once_with(self.GIST, REVISION)
+
+    def test_pin_overrides_lockfile(self, _, mock_checkout, __):
+        self._install(OTHER_REVISION, self.LOCKED_ENTRY, REVISION)
+        mock_checkout.assert_called_once_with(self.GIST, OTHER_REVISION)
+
+    def _install(self, pinned, locked_entry, local_revision):
+        index_entry = {'id': '42', 'revision': REVISION}
+        with mock.patch.object(__unit__, 'get_gist_index') as mock_index, \
+                mock.patch.object(__unit__, 'local_revision',
+                                  return_value=local_revision):
+            mock_index.return_value.get.return_value = index_entry
+            return __unit__.install_manifest_entry(
+                self.GIST, pinned, locked_entry)
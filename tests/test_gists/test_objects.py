@@ -0,0 +1,125 @@
+"""
+Tests for the git object store shared by gist repositories.
+"""
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+
+import mock
+from taipan.testing import after, before, TestCase
+
+from gisht.data import CloneStrategy
+from gisht.gists.cache import clone_gist_repo
+import gisht.gists.objects as __unit__
+
+
+class ReferenceArgs(TestCase):
+
+    def test_no_store(self):
+        with self._store(exists=False):
+            self.assertEquals(
+                [], __unit__.reference_args(CloneStrategy.FULL))
+
+    def test_shallow(self):
+        with self._store(exists=True):
+            args = __unit__.reference_args(CloneStrategy.SHALLOW)
+        self.assertEquals('--reference-if-able', args[0])
+
+    def test_partial(self):
+        with self._store(exists=True):
+            self.assertEquals(
+                [], __unit__.reference_args(CloneStrategy.PARTIAL))
+
+    def _store(self, exists):
+        store = mock.Mock(spec=Path)
+        store.exists.return_value = exists
+        return mock.patch.object(__unit__, 'GIST_OBJECTS_DIR', new=store)
+
+
+@mock.patch.object(__unit__, 'link_object_store', new=mock.Mock())
+@mock.patch.object(__unit__, 'ensure_object_store',
+                   new=mock.Mock(return_value=True))
+@mock.patch.object(__unit__, 'run')
+class ShareGistObjects(TestCase):
+    REPO_DIR = Path('/tmp/gists/42')
+
+    def test_full(self, mock_run):
+        mock_run.return_value.status_code = 0
+        self.assertTrue(__unit__.share_gist_objects(self.REPO_DIR,
+                                                    CloneStrategy.FULL))
+
+        fetch_argv, repack_argv = [c[0][0] for c in mock_run.call_args_list]
+        self.assertIn('+HEAD:refs/gists/42', fetch_argv)
+        self.assertIn('-l', repack_argv)
+
+    def test_shallow(self, mock_run):
+        tree = 'a' * 40
+        mock_run.return_value.status_code = 0
+        mock_run.return_value.std_out = tree + '\n'
+        self.assertTrue(__unit__.share_gist_objects(self.REPO_DIR,
+                                                    CloneStrategy.SHALLOW))
+
+        # shallow history must never be added to the store,
+        # only the files of the latest revision
+        _, fetch_argv, repack_argv = [
+            c[0][0] for c in mock_run.call_args_list]
+        self.assertIn('+%s:refs/shallow/42' % tree, fetch_argv)
+        self.assertIn('-l', repack_argv)
+
+    def test_sparse(self, mock_run):
+        self.assertFalse(__unit__.share_gist_objects(self.REPO_DIR,
+                                                     CloneStrategy.SPARSE))
+        self.assertFalse(mock_run.called)
+
+
+class SharedShallowClones(TestCase):
+
+    @before
+    def create_repos(self):
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.origin = self.temp_dir / 'origin'
+        self._git('init', '--quiet', self.origin)
+        with (self.origin / 'foo').open('w') as f:
+            f.write(u"echo foo\n")
+        self._git('add', 'foo', cwd=self.origin)
+        self._git('-c', 'user.name=John Doe', '-c', 'user.email=john@doe',
+                  'commit', '--quiet', '-m', 'foo', cwd=self.origin)
+
+        self.store_patcher = mock.patch.object(
+            __unit__, 'GIST_OBJECTS_DIR', new=self.temp_dir / 'objects.git')
+        self.store_patcher.start()
+
+    @after
+    def delete_repos(self):
+        self.store_patcher.stop()
+        shutil.rmtree(str(self.temp_dir))
+
+    def test_objects_shared(self):
+        strategy = CloneStrategy.default()
+        repo_dirs = [self.temp_dir / gist_id for gist_id in ('13', '42')]
+        for repo_dir in repo_dirs:
+            clone_gist_repo(self.origin.as_uri(), repo_dir, 'foo',
+                            strategy=strategy, progress=False)
+            self.assertTrue(__unit__.share_gist_objects(repo_dir, strategy))
+
+        # both repositories only keep their commit, and borrow
+        # the files' objects from the store
+        blob = self._git('rev-parse', 'HEAD:foo', cwd=self.origin).strip()
+        self._git('--git-dir', __unit__.GIST_OBJECTS_DIR,
+                  'cat-file', '-e', blob)
+        for repo_dir in repo_dirs:
+            self.assertEquals(1, self._local_object_count(repo_dir))
+            self._git('fsck', '--no-progress', cwd=repo_dir)
+        with (repo_dirs[1] / 'foo').open() as f:
+            self.assertEquals(u"echo foo\n", f.read())
+
+    def _local_object_count(self, repo_dir):
+        stats = dict(line.split(': ') for line in self._git(
+            'count-objects', '-v', cwd=repo_dir).splitlines())
+        return int(stats['count']) + int(stats['in-pack'])
+
+    def _git(self, *args, **kwargs):
+        return subprocess.check_output(
+            ['git'] + [str(arg) for arg in args],
+            cwd=str(kwargs.get('cwd', self.temp_dir))).decode('utf-8')
@@ -79,6 +79,21 @@ class RunGistUrl(TestCase):
 
         mock_run_named_gist.assert_called_once_with(GIST, ARGS)
 
+    @mock.patch.object(__unit__, 'run_named_gist', new=mock.Mock())
+    @mock.patch.object(__unit__, 'get_gist_info')
+    def test_success__gist_info_reused(self, mock_get_gist_info):
+        gist_info = {
+            'owner': {'login': OWNER},
+            'files': {NAME: '__unused__'},
+        }
+        mock_get_gist_info.return_value = gist_info
+
+        gist = self._url(OWNER, self.GIST_ID)
+        __unit__.run_gist_url(gist)
+
+        __unit__.ensure_gist.assert_called_with(
+            GIST, local=False, gist_json=gist_info)
+
     # Utility functions
 
     def _url(self, owner, gist_id):
@@ -86,6 +101,7 @@ class RunGistUrl(TestCase):
 
 
 @mock.patch.dict(__unit__.COMMON_INTERPRETERS, {EXTENSION: INTERPRETER_ARGV})
+@mock.patch.object(__unit__, 'lock_running_gist', new=mock.Mock())
 class RunNamedGist(TestCase):
     EXECUTABLE = BIN_DIR / GIST
 
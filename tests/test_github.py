@@ -3,7 +3,15 @@ GitHub API tests.
 """
 from contextlib import contextmanager
 import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
 
+from furl import furl
+import mock
+import requests
 from requests.exceptions import HTTPError
 import responses
 from taipan.collections import dicts
@@ -11,10 +19,41 @@ from taipan.strings import is_string
 from taipan.testing import before, after, TestCase
 
 from gisht import flags
+from gisht.httpcache import CacheRecord, SqliteCacheStore
+from gisht.util import file_lock
 import gisht.github as __unit__
 
 
-class _GitHubApi(TestCase):
+class _GitHubClient(TestCase):
+    """Base class for test cases that create :class:`GitHub` clients.
+
+    The clients are given a response cache and a rate limiter
+    in a temporary directory, rather than in the application's one.
+    """
+    @before
+    def create_app_dir(self):
+        self.app_dir = Path(tempfile.mkdtemp())
+        self.cache_store = SqliteCacheStore(self.app_dir / 'github.sqlite',
+                                            lock_dir=self.app_dir / 'locks')
+        rate_limiter = __unit__.RateLimiter(self.app_dir / 'ratelimit.json')
+        self.patchers = [
+            mock.patch.object(__unit__, 'get_cache_store',
+                              return_value=self.cache_store),
+            mock.patch.object(__unit__, 'get_rate_limiter',
+                              return_value=rate_limiter),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    @after
+    def delete_app_dir(self):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        self.cache_store.close()
+        shutil.rmtree(str(self.app_dir))
+
+
+class _GitHubApi(_GitHubClient):
     """Base class for test cases for code interacting with GitHub API."""
     MIME_TYPE = 'application/vnd.github.v3+json'
 
@@ -35,7 +74,7 @@ class _GitHubApi(TestCase):
     def deactivate_responses(self):
         responses.mock.__exit__()
 
-    def _stub_response(self, url, response_json, status=None):
+    def _stub_response(self, url, response_json, status=None, headers=None):
         if not is_string(response_json):
             response_json = json.dumps(response_json)
 
@@ -43,6 +82,7 @@ class _GitHubApi(TestCase):
             'body': response_json,
             'content_type': self.MIME_TYPE,
             'status': status or dicts.ABSENT,
+            'headers': headers or dicts.ABSENT,
         })
         responses.add(responses.GET, str(url), **kwargs)
 
@@ -63,6 +103,21 @@ class GetGistInfo(_GitHubApi):
         with self._assert404():
             __unit__.get_gist_info(self.GIST_ID)
 
+    def test_local__old_response(self):
+        flags.local = True
+        gist_json = {'id': self.GIST_ID, 'files': {}}
+        url = str(__unit__.GitHub().gists(self.GIST_ID))
+        self.cache_store.put('gists/' + self.GIST_ID, CacheRecord(
+            url, 200, content=json.dumps(gist_json).encode('utf-8'),
+            timestamp=time.time() - 30 * 24 * 60 * 60))
+
+        self.assertEquals(gist_json, __unit__.get_gist_info(self.GIST_ID))
+
+    def test_local__not_cached(self):
+        flags.local = True
+        with self.assertRaises(SystemExit):
+            __unit__.get_gist_info(self.GIST_ID)
+
     def _stub_gist_response(self, gist_id, response_json, status=None):
         self._stub_response(__unit__.GitHub().gists(gist_id),
                             response_json, status)
@@ -86,8 +141,207 @@ class IterGists(_GitHubApi):
         self._stub_gists_response(self.USER, [])
         self.assertEmpty(__unit__.iter_gists(self.USER))
 
-    # TODO(xion): add tests for typical case when user has gists
+    def test_single_page(self):
+        gists = [{'id': '1'}, {'id': '2'}]
+        self._stub_gists_response(self.USER, gists)
+        self.assertEquals(gists, list(__unit__.iter_gists(self.USER)))
+
+    def test_multiple_pages(self):
+        first_page, second_page = [{'id': '1'}], [{'id': '2'}]
+        self._stub_gists_pages(self.USER, {1: first_page, 2: second_page},
+                               links={1: self._link(page=2)})
+
+        self.assertEquals(first_page + second_page,
+                          list(__unit__.iter_gists(self.USER)))
+        self.assertEquals([1, 2], self.requested_pages)
+
+    def test_multiple_pages__concurrent(self):
+        pages = dict((i, [{'id': str(i)}]) for i in range(1, 5))
+        self._stub_gists_pages(self.USER, pages, links={
+            1: ', '.join((self._link(page=2),
+                          self._link(page=4, rel='last'))),
+        })
+
+        # pages are fetched in any order, but yielded in the right one
+        self.assertEquals(sum((pages[i] for i in sorted(pages)), []),
+                          list(__unit__.iter_gists(self.USER)))
+        self.assertItemsEqual(pages, self.requested_pages)
+
+    def test_multiple_pages__last_is_first(self):
+        first_page = [{'id': '1'}]
+        self._stub_gists_pages(self.USER, {1: first_page}, links={
+            1: self._link(page=1, rel='last'),
+        })
+
+        self.assertEquals(first_page, list(__unit__.iter_gists(self.USER)))
+        self.assertEquals([1], self.requested_pages)
 
     def _stub_gists_response(self, user, response_json, status=None):
-        self._stub_response(__unit__.GitHub().users(user).gists,
-                            response_json, status)
+        url = furl(__unit__.GitHub().users(user).gists)
+        self._stub_response(url, response_json, status)
+
+    def _stub_gists_pages(self, user, pages, links=None):
+        """Stub the responses with pages of the list of user's gists.
+
+        :param pages: Dictionary mapping page numbers to their JSONs
+        :param links: Dictionary mapping page numbers
+                      to their ``Link`` headers
+        """
+        self.requested_pages = []
+
+        def callback(request):
+            page = int(furl(request.url).args.get('page', 1))
+            self.requested_pages.append(page)
+            headers = {}
+            if page in (links or {}):
+                headers['Link'] = links[page]
+            return 200, headers, json.dumps(pages[page])
+
+        url = furl(__unit__.GitHub().users(user).gists)
+        responses.add_callback(responses.GET, str(url), callback=callback,
+                               content_type=self.MIME_TYPE)
+
+    def _link(self, page, rel='next'):
+        url = furl(__unit__.GitHub().users(self.USER).gists)
+        url.args['page'] = page
+        return '<%s>; rel="%s"' % (url, rel)
+
+
+class CacheTtl(_GitHubClient):
+    GIST_ID = '42'
+    USER = 'JohnDoe'
+
+    def test_gist(self):
+        github = __unit__.GitHub()
+        self.assertLess(self._ttl_of('gists/' + self.GIST_ID),
+                        github._cache_ttl)
+
+    def test_user_gists(self):
+        ttl = self._ttl_of('users/%s/gists' % self.USER)
+        self.assertLess(ttl, self._ttl_of('gists/' + self.GIST_ID))
+
+    def test_other(self):
+        github = __unit__.GitHub()
+        self.assertEquals(github._cache_ttl, self._ttl_of('rate_limit'))
+
+    def _ttl_of(self, path):
+        return __unit__.GitHub()._cache_ttl_for(path)
+
+
+class RemoveLegacyCache(TestCase):
+
+    @before
+    def create_cache_dir(self):
+        self.cache_dir = Path(tempfile.mkdtemp())
+        self.legacy_dir = self.cache_dir / 'github'
+        os.makedirs(str(self.legacy_dir / 'gists'))
+        with (self.legacy_dir / 'gists' / '42').open('wb') as f:
+            f.write(b'pickled response')
+
+        self.patcher = mock.patch.multiple(
+            __unit__, LEGACY_CACHE_DIR=self.legacy_dir,
+            CACHE_LOCKS_DIR=self.cache_dir / 'locks')
+        self.patcher.start()
+
+    @after
+    def delete_cache_dir(self):
+        self.patcher.stop()
+        shutil.rmtree(str(self.cache_dir))
+
+    def test_removed(self):
+        __unit__.remove_legacy_cache()
+        self.assertEquals(['locks'], os.listdir(str(self.cache_dir)))
+
+    def test_being_removed(self):
+        with file_lock(self.cache_dir / 'locks' / 'legacy'):
+            __unit__.remove_legacy_cache()
+        self.assertTrue(self.legacy_dir.is_dir())
+
+
+class GetSession(_GitHubClient):
+
+    def test_shared(self):
+        self.assertIs(__unit__.get_session(), __unit__.get_session())
+
+    def test_used_by_client(self):
+        self.assertIs(__unit__.get_session(), __unit__.GitHub()._session)
+
+    @mock.patch.dict('os.environ', {'GISHT_GITHUB_TOKEN': 'abc123'})
+    def test_token__api(self):
+        url = str(__unit__.GitHub().rate_limit)
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, url, body='{}')
+            __unit__.GitHub().rate_limit.GET(cache=False)
+            request = rsps.calls[0].request
+        self.assertEquals('token abc123', request.headers['Authorization'])
+
+    @mock.patch.dict('os.environ', {'GISHT_GITHUB_TOKEN': 'abc123'})
+    def test_token__raw_file(self):
+        url = 'https://gist.githubusercontent.com/JohnDoe/42/raw/foo'
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, url, body='echo foo')
+            __unit__.get_gist_file(url)
+            request = rsps.calls[0].request
+        self.assertNotIn('Authorization', request.headers)
+
+
+class RateLimiter(TestCase):
+    LIMIT = 60
+
+    @before
+    def create_rate_limiter(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.rate_limiter = __unit__.RateLimiter(
+            Path(self.state_dir) / 'ratelimit.json')
+
+    @after
+    def delete_state_dir(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_acquire__unknown_budget(self):
+        self.rate_limiter.acquire()
+        self.rate_limiter.acquire(__unit__.RateLimiter.BACKGROUND)
+
+    def test_update__ok(self):
+        self.assertFalse(self.rate_limiter.update(self._response(remaining=1)))
+        self.rate_limiter.acquire()
+
+    def test_update__exhausted(self):
+        self.assertTrue(self.rate_limiter.update(
+            self._response(403, remaining=0)))
+        with self.assertRaises(__unit__.RateLimitExceeded):
+            self.rate_limiter.acquire()
+
+    def test_update__retry_after(self):
+        self.assertTrue(self.rate_limiter.update(
+            self._response(429, headers={'Retry-After': '3600'})))
+        with self.assertRaises(__unit__.RateLimitExceeded):
+            self.rate_limiter.acquire()
+
+    def test_update__forbidden(self):
+        self.assertFalse(self.rate_limiter.update(self._response(403)))
+
+    def test_acquire__reserved_for_interactive(self):
+        self.rate_limiter.update(self._response(remaining=self.LIMIT // 10))
+        self.rate_limiter.acquire(__unit__.RateLimiter.INTERACTIVE)
+        with self.assertRaises(__unit__.RateLimitExceeded):
+            self.rate_limiter.acquire(__unit__.RateLimiter.BACKGROUND)
+
+    def test_acquire__shared(self):
+        self.rate_limiter.update(self._response(403, remaining=0))
+        other = __unit__.RateLimiter(self.rate_limiter.state_file)
+        with self.assertRaises(__unit__.RateLimitExceeded):
+            other.acquire()
+
+    def _response(self, status=200, remaining=None, headers=None):
+        response = requests.Response()
+        response.status_code = status
+        response._content = b'{}'
+        if remaining is not None:
+            response.headers.update({
+                'X-RateLimit-Limit': str(self.LIMIT),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(int(time.time()) + 3600),
+            })
+        response.headers.update(headers or {})
+        return response
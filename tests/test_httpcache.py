@@ -0,0 +1,195 @@
+"""
+Tests for the storage format of cached HTTP responses.
+"""
+from datetime import timedelta
+import os
+import shutil
+import tempfile
+
+import mock
+from taipan.testing import before, after, TestCase
+
+import gisht.httpcache as __unit__
+
+
+class CacheRecord(TestCase):
+    URL = 'https://api.github.com/gists/42'
+    ETAG = '"abcdef"'
+    CONTENT_TYPE = 'application/json; charset=utf-8'
+
+    def test_roundtrip__small(self):
+        record = self._record(b'{"id": "42"}')
+        result = __unit__.CacheRecord.loads(record.dumps())
+
+        self.assertEquals(record.url, result.url)
+        self.assertEquals(record.status_code, result.status_code)
+        self.assertEquals(record.content, result.content)
+        self.assertEquals(record.timestamp, result.timestamp)
+        self.assertEquals(self.ETAG, result.headers['etag'])
+
+    def test_roundtrip__compressed(self):
+        content = b'[' + b','.join([b'{"id": "42"}'] * 1000) + b']'
+        record = self._record(content)
+
+        data = record.dumps()
+        self.assertLess(len(data), len(content))
+        self.assertEquals(content, __unit__.CacheRecord.loads(data).content)
+
+    def test_loads__garbage(self):
+        with self.assertRaises(__unit__.CacheRecordError):
+            __unit__.CacheRecord.loads(b'\x80\x02crequests.models')
+
+    def test_loads__unsupported_version(self):
+        data = self._record(b'{}').dumps().replace(b'"v":1', b'"v":0')
+        with self.assertRaises(__unit__.CacheRecordError):
+            __unit__.CacheRecord.loads(data)
+
+    def test_json(self):
+        record = self._record(b'{"id": "42"}')
+        self.assertEquals({'id': '42'}, record.json())
+
+    def test_links(self):
+        next_url = self.URL + '?page=2'
+        record = self._record(b'[]', headers={
+            'Link': '<%s>; rel="next"' % next_url,
+        })
+        self.assertEquals(next_url, record.links['next']['url'])
+
+    def test_raise_for_status(self):
+        from requests.exceptions import HTTPError
+
+        record = self._record(b'{}', status_code=404)
+        with self.assertRaises(HTTPError) as r:
+            record.raise_for_status()
+        self.assertEquals(404, r.exception.response.status_code)
+
+    # Utility functions
+
+    def _record(self, content, status_code=200, headers=None):
+        headers = dict(headers or {},
+                       ETag=self.ETAG, **{'Content-Type': self.CONTENT_TYPE})
+        return __unit__.CacheRecord(self.URL, status_code,
+                                    headers=headers, content=content)
+
+
+class _CacheStore(TestCase):
+    """Base class for test cases for cache storage backends."""
+    KEY = 'gists/42'
+
+    @before
+    def create_cache_dir(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    @after
+    def delete_cache_dir(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _record(self, timestamp=None):
+        return __unit__.CacheRecord('https://api.github.com/' + self.KEY, 200,
+                                    content=b'{}', timestamp=timestamp)
+
+
+class SqliteCacheStore(_CacheStore):
+
+    def test_get__missing(self):
+        self.assertIsNone(self._store().get(self.KEY))
+
+    def test_put_get(self):
+        store = self._store()
+        store.put(self.KEY, self._record())
+        self.assertEquals(b'{}', store.get(self.KEY).content)
+
+    def test_delete(self):
+        store = self._store()
+        store.put(self.KEY, self._record())
+        store.delete(self.KEY)
+        self.assertIsNone(store.get(self.KEY))
+
+    def test_expired(self):
+        store = self._store()
+        store.put('gists/1', self._record(timestamp=1))
+        store.put('gists/2', self._record(timestamp=2))
+        self.assertItemsEqual(['gists/1'], store.expired(2))
+
+    def test_invalidate(self):
+        store = self._store()
+        store.put('users/foo/gists', self._record())
+        store.put('users/foo/gists?page=2', self._record())
+        store.put('users/fop/gists', self._record())
+
+        self.assertEquals(2, store.invalidate('users/foo/'))
+        self.assertItemsEqual(['users/fop/gists'],
+                              [key for key, _ in store.items()])
+
+    def test_put__evicts_least_recently_used(self):
+        store = self._store(max_entries=2)
+        store.put('gists/1', self._record())
+        store.put('gists/2', self._record())
+        store.get('gists/1')
+        store.put('gists/3', self._record())
+
+        self.assertIsNotNone(store.get('gists/1'))
+        self.assertIsNone(store.get('gists/2'))
+
+    def test_stats(self):
+        store = self._store(max_entries=3)
+        for i in range(5):
+            store.put('gists/%s' % i, self._record())
+        store.put('gists/4', self._record(timestamp=1))  # different size
+        store.delete('gists/3')
+        store.invalidate('users/')
+
+        entries = store.entries()
+        self.assertEquals(
+            (len(entries), sum(size for _, size, _ in entries)),
+            store.stats())
+
+    def test_purge_locks(self):
+        store = self._store(lock_dir=self.cache_dir + '/locks')
+        store.put('gists/1', self._record())
+        for key in ('gists/1', 'gists/2', 'gists/3'):
+            with store.lock(key):
+                pass
+
+        with store.lock('gists/3'):
+            self.assertEquals(1, store.purge_locks(timedelta(days=1)))
+        self.assertEquals(2, len(os.listdir(self.cache_dir + '/locks')))
+
+        for name in os.listdir(self.cache_dir + '/locks'):
+            os.utime(os.path.join(self.cache_dir, 'locks', name), (0, 0))
+        self.assertEquals(2, store.purge_locks(timedelta(days=1)))
+        self.assertEquals([], os.listdir(self.cache_dir + '/locks'))
+
+    def test_evict__size(self):
+        store = self._store()
+        for i in range(4):
+            # (same timestamps, so that all records are of the same size)
+            store.put('gists/%s' % i, self._record(timestamp=1))
+        _, size = store.stats()
+
+        evicted_count, evicted_size = store.evict(max_size=size // 2)
+        self.assertEquals(2, evicted_count)
+        self.assertEquals((2, size - evicted_size), store.stats())
+
+    def test_evict__same_access_time(self):
+        store = self._store()
+        with mock.patch.object(__unit__.time, 'time', return_value=1000):
+            for i in reversed(range(4)):
+                store.put('gists/%s' % i, __unit__.CacheRecord(
+                    'https://api.github.com/gists/%s' % i, 200,
+                    content=b'x' * (i + 1) * 10, timestamp=1))
+        sizes = dict((key, size) for key, size, _ in store.entries())
+        _, size = store.stats()
+
+        evicted_count, evicted_size = store.evict(max_entries=2)
+
+        # ties are broken by the key
+        self.assertEquals(2, evicted_count)
+        self.assertEquals(sizes['gists/0'] + sizes['gists/1'], evicted_size)
+        self.assertItemsEqual(['gists/2', 'gists/3'],
+                              [key for key, _, _ in store.entries()])
+        self.assertEquals((2, size - evicted_size), store.stats())
+
+    def _store(self, **kwargs):
+        return __unit__.SqliteCacheStore(self.cache_dir + '/cache.sqlite',
+                                         **kwargs)
@@ -1,6 +1,15 @@
 """
 Tests for utility functions.
 """
+from contextlib import contextmanager
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import mock
 from taipan.testing import TestCase
 
 import gisht.util as __unit__
@@ -12,3 +21,138 @@ class PathVector(TestCase):
     def test_noop(self):
         result = __unit__.path_vector(self.PATH, self.PATH)
         self.assertEquals('.', str(result))
+
+
+class FileLock(TestCase):
+
+    def test_exclusive__timeout(self):
+        with self._lock_file() as path:
+            with __unit__.file_lock(path):
+                with self.assertRaises(__unit__.LockTimeout):
+                    with __unit__.file_lock(path, timeout=0):
+                        pass
+
+    def test_shared(self):
+        with self._lock_file() as path:
+            with __unit__.file_lock(path, shared=True):
+                with __unit__.file_lock(path, shared=True, timeout=0):
+                    pass
+
+    def test_released(self):
+        with self._lock_file() as path:
+            with __unit__.file_lock(path):
+                pass
+            with __unit__.file_lock(path, timeout=0):
+                pass
+
+    def test_hold(self):
+        with self._lock_file() as path:
+            fd = __unit__.hold_file_lock(path, shared=True)
+            try:
+                with __unit__.file_lock(path, shared=True, timeout=0):
+                    pass
+                with self.assertRaises(__unit__.LockTimeout):
+                    with __unit__.file_lock(path, timeout=0):
+                        pass
+            finally:
+                os.close(fd)
+            with __unit__.file_lock(path, timeout=0):
+                pass
+
+    def test_hold__not_inherited(self):
+        with self._lock_file() as path:
+            fd = __unit__.hold_file_lock(path)
+            try:
+                fd_flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                self.assertTrue(fd_flags & fcntl.FD_CLOEXEC)
+            finally:
+                os.close(fd)
+
+    def test_remove(self):
+        with self._lock_file() as path:
+            with __unit__.file_lock(path):
+                self.assertFalse(__unit__.remove_lock_file(path))
+            self.assertTrue(__unit__.remove_lock_file(path))
+            self.assertFalse(os.path.exists(path))
+
+    @contextmanager
+    def _lock_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            yield os.path.join(temp_dir, 'lock')
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+@mock.patch.object(__unit__, '_pending_detached_calls', new_callable=list)
+@mock.patch.object(__unit__.os, 'waitpid')
+@mock.patch.object(__unit__.os, 'fork', return_value=42)
+class Detach(TestCase):
+
+    def test_no_threads(self, mock_fork, _, __):
+        __unit__.detach(self._func)
+        self.assertTrue(mock_fork.called)
+
+    def test_other_thread(self, mock_fork, _, pending_calls):
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        try:
+            __unit__.detach(self._func)
+            __unit__.detach_pending()
+            self.assertFalse(mock_fork.called)
+        finally:
+            release.set()
+            thread.join()
+
+        __unit__.detach_pending()
+        self.assertTrue(mock_fork.called)
+        self.assertEquals([], pending_calls)
+
+    def test_other_thread__wait(self, mock_fork, _, pending_calls):
+        func = mock.Mock()
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+        try:
+            __unit__.detach(func, 'foo', log_file='/dev/null')
+            __unit__.detach_pending(wait=True)
+        finally:
+            release.set()
+            thread.join()
+
+        func.assert_called_once_with('foo')
+        self.assertFalse(mock_fork.called)
+        self.assertEquals([], pending_calls)
+
+    def _func(self):
+        pass
+
+
+class Run(TestCase):
+
+    def test_output(self):
+        result = self._run('import sys; print("foo"); sys.exit(3)')
+        self.assertEquals(3, result.status_code)
+        self.assertEquals('foo', result.std_out.strip())
+        self.assertFalse(result.timed_out)
+
+    def test_output__bounded(self):
+        size = __unit__.MAX_OUTPUT_SIZE * 2
+        result = self._run('import sys; sys.stderr.write("x" * %s)' % size)
+        self.assertEquals(__unit__.MAX_OUTPUT_SIZE, len(result.std_err))
+
+    def test_timeout(self):
+        result = self._run('import time; time.sleep(10)', timeout=0.1)
+        self.assertTrue(result.timed_out)
+        self.assertNotEquals(0, result.status_code)
+
+    def test_join__signal(self):
+        result = __unit__.ProcessResult(['foo'], forwarded=True)
+        result.status_code = -15
+        with self.assertRaises(SystemExit) as r:
+            __unit__.join(result)
+        self.assertEquals(128 + 15, r.exception.code)
+
+    def _run(self, code, **kwargs):
+        return __unit__.run([sys.executable, '-c', code], **kwargs)